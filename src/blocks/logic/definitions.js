@@ -1,5 +1,25 @@
+import { createChainBlock } from "../../plugins/chains.js";
+
 const logicColor = "#98b8d8";
 
+const boolOps = [
+    ['and', 'And'],
+    ['or', 'Or']
+];
+
+const compareOps = [
+    ['==', 'Eq'],
+    ['!=', 'NotEq'],
+    ['<', 'Lt'],
+    ['<=', 'LtE'],
+    ['>', 'Gt'],
+    ['>=', 'GtE'],
+    ['in', 'In'],
+    ['not in', 'NotIn'],
+    ['is', 'Is'],
+    ['is not', 'IsNot']
+];
+
 const bool = {
 	init: function() {
 	  this.appendDummyInput()
@@ -19,10 +39,7 @@ const BoolOp = {
     init: function() {
       this.appendValueInput('left');
       this.appendDummyInput('')
-        .appendField(new Blockly.FieldDropdown([
-            ['and', 'And'],
-            ['or', 'Or']
-          ]), 'op');
+        .appendField(new Blockly.FieldDropdown(boolOps), 'op');
       this.appendValueInput('right');
       this.setInputsInline(true)
 	    this.setOutput(true, "BoolOp");
@@ -30,6 +47,9 @@ const BoolOp = {
     }
   };
 Blockly.common.defineBlocks({BoolOp: BoolOp});
+
+const BoolOpChain = createChainBlock(boolOps, logicColor);
+Blockly.common.defineBlocks({BoolOpChain: BoolOpChain});
   
 const Not = {
   init: function() {
@@ -47,18 +67,7 @@ const Compare = {
   init: function() {
     this.appendValueInput('left');
     this.appendDummyInput('')
-      .appendField(new Blockly.FieldDropdown([
-          ['==', 'Eq'],
-          ['!=', 'NotEq'],
-          ['<', 'Lt'],
-          ['<=', 'LtE'],
-          ['>', 'Gt'],
-          ['>=', 'GtE'],
-          ['in', 'In'],
-          ['not in', 'NotIn'],
-          ['is', 'Is'],
-          ['is not', 'IsNot']
-        ]), 'op');
+      .appendField(new Blockly.FieldDropdown(compareOps), 'op');
     this.appendValueInput('right');
     this.setInputsInline(true)
     this.setOutput(true, "Compare");
@@ -67,6 +76,9 @@ const Compare = {
 };
 Blockly.common.defineBlocks({Compare: Compare});
 
+const CompareChain = createChainBlock(compareOps, logicColor, true);
+Blockly.common.defineBlocks({CompareChain: CompareChain});
+
 const IfExp = {
   init: function() {
     this.appendValueInput('body');
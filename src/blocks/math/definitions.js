@@ -1,5 +1,23 @@
+import { createChainBlock } from "../../plugins/chains.js";
+
 const mathColour = "#97a2d8";
 
+const binOps = [
+    ['+', 'Add'],
+    ['-', 'Sub'],
+    ['*', 'Mult'],
+    ['/', 'Div'],
+    ['//', 'FloorDiv'],
+    ['%', 'Mod'],
+    ['**', 'Pow'],
+    ['<<', 'LShift'],
+    ['>>', 'RShift'],
+    ['&', 'BitAnd'],
+    ['|', 'BitOr'],
+    ['^', 'BitXor'],
+    ['@', 'MatMult']
+];
+
 const int = {
   init: function() {
     this.appendDummyInput()
@@ -15,21 +33,7 @@ const BinOp = {
   init: function() {
     this.appendValueInput('left');
     this.appendDummyInput('')
-      .appendField(new Blockly.FieldDropdown([
-          ['+', 'Add'],
-          ['-', 'Sub'],
-          ['*', 'Mult'],
-          ['/', 'Div'],
-          ['//', 'FloorDiv'],
-          ['%', 'Mod'],
-          ['**', 'Pow'],
-          ['<<', 'LShift'],
-          ['>>', 'RShift'],
-          ['&', 'BitAnd'],
-          ['|', 'BitOr'],
-          ['^', 'BitXor'],
-          ['@', 'MatMult']
-        ]), 'op');
+      .appendField(new Blockly.FieldDropdown(binOps), 'op');
     this.appendValueInput('right');
     this.setInputsInline(true)
     this.setOutput(true, null);
@@ -38,6 +42,9 @@ const BinOp = {
 };
 Blockly.common.defineBlocks({BinOp: BinOp});
 
+const BinOpChain = createChainBlock(binOps, mathColour);
+Blockly.common.defineBlocks({BinOpChain: BinOpChain});
+
 const UnaryOp = {
   init: function() {
     this.appendDummyInput()
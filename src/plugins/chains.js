@@ -0,0 +1,84 @@
+/*
+Blocks for flattened chains of operations, such as `a and b and c` or
+`0 < a < b < c`, with any number of items (set via the `items` extra state).
+
+The op between each pair of items is either a single `op` field shared by the
+whole chain (for BoolOp and BinOp chains), or a separate `op_NNNNNN` field
+between items NNNNNN and NNNNNN + 1 (for Compare chains).
+*/
+export function createChainBlock(ops, colour, op_per_item=false) {
+    return {
+        init: function() {
+            this.itemCount = 0;
+            this.setInputsInline(true);
+            this.setOutput(true, null);
+            this.setColour(colour);
+        },
+
+        saveExtraState: function() {
+            return {
+                items: this.itemCount,
+            }
+        },
+
+        loadExtraState: function(state) {
+            this.updateShape(parseInt(state.items));
+        },
+
+        updateShape: function(targetCount) {
+            while (this.itemCount < targetCount) {
+                this.addItem();
+            }
+            while (this.itemCount > targetCount) {
+                this.removeItem();
+            }
+        },
+
+        addItem: function() {
+            this.itemCount++;
+            const count = this.itemCount.toString().padStart(6, '0');
+            const input = this.appendValueInput(`input_${count}`);
+            if (this.itemCount == 1) {
+                return;
+            }
+            if (op_per_item) {
+                const previous = (this.itemCount - 1).toString().padStart(6, '0');
+                input.appendField(new Blockly.FieldDropdown(ops), `op_${previous}`);
+            }
+            else if (this.itemCount == 2) {
+                // The shared op, whose label is repeated between later items.
+                input.appendField(
+                    new Blockly.FieldDropdown(ops, (value) => {
+                        this.updateLabels(value);
+                        return value;
+                    }),
+                    'op'
+                );
+            }
+            else {
+                input.appendField(
+                    new Blockly.FieldLabel(this.opLabel(this.getFieldValue('op'))),
+                    `label_${count}`
+                );
+            }
+        },
+
+        removeItem: function() {
+            const count = this.itemCount.toString().padStart(6, '0');
+            this.removeInput(`input_${count}`);
+            this.itemCount--;
+        },
+
+        opLabel: function(value) {
+            const option = ops.find((op) => op[1] == value);
+            return option ? option[0] : value;
+        },
+
+        updateLabels: function(value) {
+            for (let i = 3; i <= this.itemCount; i++) {
+                const count = i.toString().padStart(6, '0');
+                this.setFieldValue(this.opLabel(value), `label_${count}`);
+            }
+        },
+    };
+}
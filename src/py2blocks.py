@@ -11,13 +11,29 @@ For more information about the Blockly JSON serialization format, see:
 https://developers.google.com/blockly/guides/configure/web/serialization
 """
 
+import array
 import ast
+import bisect
 import json
 import copy
+import difflib
+import hashlib
+import itertools
+import keyword
+import re
+import sys
+import threading
+import time
+import tokenize
+import zlib
+from collections import ChainMap, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import GeneratorType
 
 
 # Contains definitions of built-in functions and their corresponding block
-# templates.
+# templates. These are shared by all conversions (see Converter), so should
+# only be changed (via register_builtin_block) before converting any code.
 BUILTIN_BLOCKS = {
     "print": {
         "type": "print_block",
@@ -28,670 +44,4178 @@ BUILTIN_BLOCKS = {
 }
 
 
-# Contains definitions of user-defined functions and their corresponding block
-# templates. This dictionary is populated by the user-defined functions in the
-# Python code. Functions defined in this dictionary allow us to ensure the user
-# doesn't try to call non-existent functions. The key is the function name and
-# the value is the blockly id and metadata needed to generate a valid block for
-# the function.
-USER_DEFINED_FUNCTIONS = {}
+# Contains the builders compiled from the templates in BUILTIN_BLOCKS. The key
+# is the function name and the value is a (template, builder) tuple, so a
+# builder is recompiled if its template is replaced. See compile_template.
+BUILTIN_BUILDERS = {}
 
 
-def py2blocks(code):
+# Contains the fingerprints of the templates in BUILTIN_BLOCKS (or registered
+# with a session). The key is the function name and the value is a (template,
+# fingerprint, bits) tuple, so a fingerprint is only computed again if its
+# template is replaced. See template_fingerprint.
+TEMPLATE_FINGERPRINTS = {}
+
+
+def py2blocks(
+    code,
+    engine="recursive",
+    flatten=False,
+    ids=False,
+    cache=None,
+    tree=None,
+    parse_cache=None,
+):
     """
-    Convert Python code to Blockly JSON.
+    Convert Python code to Blockly JSON, in a new conversion session (see
+    Converter).
 
     Args:
         code (str): The Python code to convert.
+        engine (str): The name of the traversal engine to use (see ENGINES).
+        flatten (bool): If True, flatten long chains of operations into
+            single blocks (see Converter).
+        ids (bool): If True, give every block a stable id (see Converter).
+        cache (DiskCache): If given, the persistent cache to get the JSON
+            from, if the same code has been converted before (in the same
+            way), or to add it to.
+        tree (ast.Module): If given, the AST already parsed from the code,
+            so the code isn't parsed again.
+        parse_cache (ParseCache): If given, the cache of ASTs to get the
+            AST for the code from (or add it to), if no tree is given.
 
     Returns:
         str: The Blockly JSON representation of the Python code.
     """
-    try:
-        # Parse the Python code into an AST.
-        tree = ast.parse(code)
-        # Traverse the AST to generate the Blockly JSON.
-        return json.dumps(traverse(tree))
-    except SyntaxError as e:
-        # Return some helpful context for the syntax error.
-        context = {
-            "lineno": e.lineno,
-            "offset": e.offset,
-            "text": e.text,
-            "message": e.msg,
-        }
-        return json.dumps({"error": context})
-    except Exception as e:
-        # Catch all for all other errors.
-        return json.dumps({"error": str(e)})
+    if cache is not None:
+        return cache.convert(code, engine, flatten, ids, tree, parse_cache)
+    converter = Converter(engine, flatten, ids=ids, parse_cache=parse_cache)
+    return converter.convert(code, tree=tree)
 
 
-def traverse(tree):
+def py2blocks_dict(
+    code,
+    engine="recursive",
+    flatten=False,
+    ids=False,
+    tree=None,
+    parse_cache=None,
+):
     """
-    Traverse the AST and generate the Blockly JSON.
+    Convert Python code to Blockly JSON, in the same way as py2blocks, but
+    return it as a dict (the same as json.loads of the result of py2blocks)
+    rather than encoding it as a string. For example, {"blocks": {...}}, or
+    {"error": {"lineno": ..., "offset": ..., "text": ..., "message": ...}}
+    for a syntax error (or {"error": message} for any other error).
+
+    In Pyodide, hand the dict to JavaScript without a string round trip via
+    pyodide.ffi.to_js(result, dict_converter=js.Object.fromEntries), which
+    builds the JavaScript objects directly.
 
     Args:
-        tree (ast.AST): The AST to traverse.
+        code (str): The Python code to convert.
+        engine (str): The name of the traversal engine to use (see ENGINES).
+        flatten (bool): If True, flatten long chains of operations into
+            single blocks (see Converter).
+        ids (bool): If True, give every block a stable id (see Converter).
+        tree (ast.Module): If given, the AST already parsed from the code.
+        parse_cache (ParseCache): If given, the cache of ASTs to get the
+            AST for the code from (or add it to), if no tree is given.
 
     Returns:
-        dict: The Blockly JSON representation of the AST.
+        dict: The Blockly JSON representation of the Python code.
     """
-    # The root of the Blockly JSON.
-    blocks = {
-        "blocks": [],
-    }
-    # Traverse the AST and generate the Blockly JSON.
-    previous_node = None
-    for node in tree.body:
-        current_node = traverse_node(node)
-        if previous_node:
-            # We're recursing into the node tree so add the next block
-            # to the previous node.
-            previous_node["next"] = {"block": current_node}
-        else:
-            # The first block in the tree. Set it as the root.
-            blocks["blocks"].append(current_node)
-        previous_node = current_node
-    return {
-        "blocks": blocks,
-    }
+    converter = Converter(engine, flatten, ids=ids, parse_cache=parse_cache)
+    return converter.convert_dict(code, tree=tree)
 
 
-def traverse_body(body):
+def py2blocks_into(
+    code,
+    buffer,
+    engine="recursive",
+    flatten=False,
+    ids=False,
+    tree=None,
+    parse_cache=None,
+):
     """
-    Traverse the body of a node in the AST and generate the Blockly JSON.
+    Convert Python code to Blockly JSON, in a new conversion session, and
+    write it into the buffer, rather than returning it (see
+    Converter.write). The JSON is exactly the same as from py2blocks, but
+    only the blocks for one top level statement are in memory at a time.
+
+    Args:
+        code (str): The Python code to convert.
+        buffer (io.StringIO or bytearray): The buffer to write the JSON to
+            (as UTF-8, for a bytearray), replacing its contents, so the
+            same buffer can be reused for each conversion.
+        engine (str): The name of the traversal engine to use (see ENGINES).
+        flatten (bool): If True, flatten long chains of operations into
+            single blocks (see Converter).
+        ids (bool): If True, give every block a stable id (see Converter).
+        tree (ast.Module): If given, the AST already parsed from the code.
+        parse_cache (ParseCache): If given, the cache of ASTs to get the
+            AST for the code from (or add it to), if no tree is given.
+
+    Returns:
+        The buffer.
     """
-    node = body[0]
-    the_rest = body[1:]
-    block = traverse_node(node)
-    if the_rest:
-        block["next"] = (
-            {"block": traverse_body(the_rest)} if the_rest else None
-        )
-    return block
+    converter = Converter(engine, flatten, ids=ids, parse_cache=parse_cache)
+    return converter.write(code, buffer, tree=tree)
 
 
-def register_builtin_block(name, template):
+def py2blocks_binary(
+    code,
+    engine="recursive",
+    flatten=False,
+    ids=False,
+    tree=None,
+    parse_cache=None,
+    dedup=False,
+):
     """
-    Register a new built-in function with its block template.
+    Convert Python code to Blockly JSON, in the same way as py2blocks_dict,
+    but return it in the compact binary encoding (see encode_blocks), which
+    is smaller than the JSON and can be handed from a worker to the main
+    thread as a single transferable buffer.
 
     Args:
-        name (str): The name of the built-in function (e.g., 'print' or 'invent.publish').
-        template (dict): The template to use for this function.
+        code (str): The Python code to convert.
+        engine (str): The name of the traversal engine to use (see ENGINES).
+        flatten (bool): If True, flatten long chains of operations into
+            single blocks (see Converter).
+        ids (bool): If True, give every block a stable id (see Converter).
+        tree (ast.Module): If given, the AST already parsed from the code.
+        parse_cache (ParseCache): If given, the cache of ASTs to get the
+            AST for the code from (or add it to), if no tree is given.
+        dedup (bool): If True, encode each repeated subtree (such as the
+            block for a repeated expression) once (see encode_blocks).
+
+    Returns:
+        bytes: The encoded Blockly JSON (see decode_blocks), or the encoded
+        {"error": details} if the code couldn't be converted or encoded.
     """
-    BUILTIN_BLOCKS[name] = template
+    result = py2blocks_dict(code, engine, flatten, ids, tree, parse_cache)
+    try:
+        return encode_blocks(result, dedup)
+    except Exception as e:
+        # Return the details of the error, as py2blocks does.
+        return encode_blocks(_error(e))
 
 
-def get_function_key(node):
+def stream_blocks(
+    code, engine="recursive", flatten=False, ids=False, tree=None
+):
     """
-    Get the function key for the BUILTIN_BLOCKS dictionary.
-    For module.function calls, combines the module and function name.
+    Convert Python code to Blockly JSON one top level statement at a time,
+    in a new conversion session (see Converter.iter_blocks), generating the
+    JSON (str) for the block for each statement (without its "next") as
+    soon as it has been converted. The blocks aren't kept, so the memory
+    used doesn't grow with the size of the code (other than for the AST).
+
+    Use write_blocks to write the JSON for the whole of the code, for
+    example to a file or socket, as the chunks are generated.
 
     Args:
-        node (ast.Call): The function call node.
+        code (str): The Python code to convert.
+        engine (str): The name of the traversal engine to use (see ENGINES).
+        flatten (bool): If True, flatten long chains of operations into
+            single blocks (see Converter).
+        ids (bool): If True, give every block a stable id (see Converter).
+        tree (ast.Module): If given, the AST already parsed from the code.
 
-    Returns:
-        str or None: The function key or None if it's not a simple name or attribute.
+    Raises:
+        SyntaxError: If the code can't be parsed (before anything is
+            generated).
     """
-    if isinstance(node.func, ast.Name):
-        return node.func.id
-    elif isinstance(node.func, ast.Attribute) and isinstance(
-        node.func.value, ast.Name
-    ):
-        # Handle module.function style calls (e.g., invent.subscribe)
-        return f"{node.func.value.id}.{node.func.attr}"
-    return None
+    return Converter(engine, flatten, ids=ids)._stream_blocks(code, tree)
 
 
-def is_builtin_function(function_key):
+def write_blocks(chunks, file):
     """
-    Check if a function key is in the built-in collection.
+    Write the Blockly JSON for the blocks for a sequence of top level
+    statements (the JSON for each, such as from stream_blocks) to the file,
+    a chunk at a time. The blocks are chained together via "next", so the
+    JSON written is the same as from py2blocks for the same code.
+
+    If the chunks can't be generated (for example, because of a syntax
+    error), the JSON for the error is written instead, as for py2blocks. An
+    error after the first chunk has been written is raised, since the JSON
+    written so far can't be finished.
 
     Args:
-        function_key (str): The function key to check.
+        chunks (iterable): The JSON (str) for the block for each statement,
+            without its "next".
+        file: The file (or any object with a write method) to write the
+            JSON (str) to.
+    """
+    _write_chunks(chunks, file.write)
 
-    Returns:
-        bool: True if the function is a built-in, False otherwise.
+
+def _write_chunks(chunks, write):
     """
-    return function_key in BUILTIN_BLOCKS
+    Write the Blockly JSON for the chunks (see write_blocks) by calling the
+    write function with each piece of it.
+    """
+    chunks = iter(chunks)
+    try:
+        chunk = next(chunks, None)
+    except Exception as e:
+        write(json.dumps(_error(e)))
+        return
+    if chunk is None:
+        write(json.dumps({"blocks": {"blocks": []}}))
+        return
+    write('{"blocks": {"blocks": [')
+    depth = 0
+    for next_chunk in chunks:
+        # Leave the block open, so the next block goes in its "next".
+        write(chunk[:-1])
+        write(', "next": {"block": ')
+        depth += 1
+        chunk = next_chunk
+    write(chunk)
+    # Close the "next" and the block it's in, for every block but the last.
+    while depth:
+        count = min(depth, 4096)
+        write("}}" * count)
+        depth -= count
+    write("]}}")
 
 
-def extract_constant_value(arg_block):
+def traverse(tree, engine="recursive", source=None, flatten=False, ids=False):
     """
-    Extract a constant value from an argument block if possible.
+    Traverse the AST and generate the Blockly JSON, in a new conversion
+    session (see Converter).
 
     Args:
-        arg_block (dict): The block representing an argument.
+        tree (ast.AST): The AST to traverse.
+        engine (str): The name of the traversal engine to use (see ENGINES).
+        source (str): The source code the AST was parsed from, if available,
+            used for the code in catch_all blocks.
+        flatten (bool): If True, flatten long chains of operations into
+            single blocks (see Converter).
+        ids (bool): If True, give every block a stable id (see Converter).
 
     Returns:
-        Any: The constant value if it can be extracted, otherwise None.
+        dict: The Blockly JSON representation of the AST.
     """
-    # Check if the block is a constant type
-    if (
-        arg_block
-        and "type" in arg_block
-        and "fields" in arg_block
-        and "value" in arg_block["fields"]
-    ):
-        # Basic types: int, float, str, bool, etc.
-        return arg_block["fields"]["value"]
-    return None
+    return Converter(engine, flatten, ids=ids).traverse(tree, source)
 
 
-def get_function_name(node):
+def convert_many(
+    sources,
+    workers=1,
+    engine="recursive",
+    flatten=False,
+    executor="thread",
+    chunksize=None,
+    ids=False,
+):
     """
-    Get a simple representation of the function name for function_call blocks.
+    Convert many independent pieces of Python code to Blockly JSON, each in
+    its own conversion session (see Converter), across a pool of workers.
+
+    With the "thread" executor, the sessions share no mutable state, so the
+    conversions run in parallel on a free-threaded (no GIL) build of Python.
+    With the GIL, they are still correct, just no faster than converting each
+    piece of code in turn.
+
+    With the "process" executor, the code is converted by a warm pool of
+    worker processes (see get_process_pool), so the conversions run in
+    parallel with the GIL too. The code is sent to the workers in chunks, and
+    the JSON for each chunk comes back in a shared memory buffer (or, on
+    Windows, with the rest of the worker's result; see SHARED_MEMORY).
 
     Args:
-        node (ast.Call): The call node.
+        sources (iterable): The pieces of Python code (str) to convert.
+        workers (int): The number of threads or processes to convert them
+            with. If 1 (with the "thread" executor), the code is converted
+            in the calling thread (without a pool).
+        engine (str): The name of the traversal engine to use (see ENGINES).
+        flatten (bool): If True, flatten long chains of operations into
+            single blocks (see Converter).
+        executor (str): Either "thread" or "process".
+        chunksize (int): The number of pieces of code sent to a worker
+            process at a time. By default, there are about four chunks per
+            worker.
+        ids (bool): If True, give every block a stable id (see Converter).
 
     Returns:
-        str or None: A string representation of the function name if simple, None if complex.
+        list: The Blockly JSON (str) for each piece of code, in order.
     """
-    if isinstance(node.func, ast.Name):
-        # Simple function name
-        return node.func.id
-    elif isinstance(node.func, ast.Attribute) and isinstance(
-        node.func.value, ast.Name
-    ):
-        # Module.function style
-        return f"{node.func.value.id}.{node.func.attr}"
-    return None
+    if executor == "process":
+        sources = list(sources)
+        if chunksize is None:
+            chunksize = max(1, -(-len(sources) // (workers * 4)))
+        pool = get_process_pool(workers)
+        futures = [
+            pool.submit(
+                _convert_chunk,
+                sources[i : i + chunksize],
+                engine,
+                flatten,
+                ids,
+                SHARED_MEMORY,
+            )
+            for i in range(0, len(sources), chunksize)
+        ]
+        results = []
+        read = 0
+        try:
+            for future in futures:
+                results.extend(_read_chunk(*future.result()))
+                read += 1
+        finally:
+            # If a chunk failed, the buffers of the chunks after it must
+            # still be unlinked.
+            for future in futures[read:]:
+                _discard_chunk(future)
+        return results
+    elif executor != "thread":
+        raise ValueError(f"Unknown executor: {executor}")
 
+    def convert(code):
+        return Converter(engine, flatten, ids=ids).convert(code)
 
-def catch_all(node, block):
-    """
-    If the node is not supported, we need to provide enough context for a
-    catch-all block that just contains arbitrary code.
-    """
-    block["type"] = "catch_all"
-    block["fields"] = {"code": ast.unparse(node)}
-    return block
+    if workers == 1:
+        return [convert(code) for code in sources]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(convert, sources))
 
 
-def apply_template(template, arg_blocks, kwarg_blocks):
+# The warm pool of worker processes used by convert_many, as a (pool, workers,
+# fingerprint) tuple, where fingerprint is the builtin_fingerprint of
+# BUILTIN_BLOCKS when the pool was started. Guarded by PROCESS_POOL_LOCK.
+PROCESS_POOL = None
+PROCESS_POOL_LOCK = threading.Lock()
+# If True, the worker processes used by convert_many send the JSON back in a
+# shared memory buffer, which this process unlinks once it has read it. On
+# Windows, a shared memory buffer is destroyed as soon as the last process
+# using it closes it (so it's gone before this process can open it), and the
+# JSON is sent back with the rest of the worker's result (which is pickled)
+# instead.
+SHARED_MEMORY = sys.platform != "win32"
+
+
+def get_process_pool(workers):
     """
-    Apply arguments to a template following a consistent pattern.
-    This function makes a deep copy of the template and fills in placeholders.
+    Get the warm pool of worker processes with the given number of workers,
+    starting it if there isn't one, or if the existing one has a different
+    number of workers or was started before BUILTIN_BLOCKS changed.
+
+    Each worker registers the built-in templates (see register_builtin_block)
+    once, when it starts. Node handlers are only available to the workers if
+    they are registered when py2blocks is imported (or, if the workers are
+    forked, before the pool is started).
 
     Args:
-        template (dict): The template to fill.
-        arg_blocks (list): List of blocks for positional arguments.
-        kwarg_blocks (list): List of (name, block) tuples for keyword arguments.
+        workers (int): The number of worker processes.
 
     Returns:
-        dict: A new block with the arguments applied to the template.
+        concurrent.futures.ProcessPoolExecutor: The pool.
     """
-    # Create a deep copy of the template to avoid modifying the original
-    result = copy.deepcopy(template)
+    global PROCESS_POOL
+    # Multiprocessing isn't available in all environments (e.g. Pyodide).
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import resource_tracker
 
-    # First, handle field mappings if present
-    if "field_mapping" in result:
-        field_mappings = result["field_mapping"]
+    templates = dict(BUILTIN_BLOCKS)
+    fingerprint = builtin_fingerprint(templates)
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is not None:
+            pool, pool_workers, pool_fingerprint = PROCESS_POOL
+            if pool_workers == workers and pool_fingerprint == fingerprint:
+                return pool
+            pool.shutdown()
+        # The shared memory buffers are created by the workers and unlinked
+        # by this process, so they must share a resource tracker (otherwise
+        # the workers' tracker reports the buffers as leaked).
+        resource_tracker.ensure_running()
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_start_worker,
+            initargs=(templates,),
+        )
+        PROCESS_POOL = (pool, workers, fingerprint)
+        return pool
 
-        # Create a dictionary of keyword arguments for easier lookup
-        kwarg_dict = {name: block for name, block in kwarg_blocks}
 
-        # Apply field mappings
-        for field_name, mapping in field_mappings.items():
-            # Check if we need to map from a positional argument
-            if "arg_index" in mapping and mapping["arg_index"] < len(
-                arg_blocks
-            ):
-                arg_index = mapping["arg_index"]
-                value = extract_constant_value(arg_blocks[arg_index])
+def shutdown_process_pool():
+    """
+    Shut down the warm pool of worker processes, if there is one.
+    """
+    global PROCESS_POOL
+    with PROCESS_POOL_LOCK:
+        if PROCESS_POOL is not None:
+            PROCESS_POOL[0].shutdown()
+            PROCESS_POOL = None
 
-                # If we successfully extracted a value, apply it to the field
-                if value is not None:
-                    # Apply the extracted value to the field
-                    if "fields" in result:
-                        result["fields"][field_name] = value
 
-            # Check if we need to map from a keyword argument
-            elif (
-                "kwarg_name" in mapping and mapping["kwarg_name"] in kwarg_dict
-            ):
-                kwarg_name = mapping["kwarg_name"]
-                value = extract_constant_value(kwarg_dict[kwarg_name])
+def _start_worker(templates):
+    """
+    Register the built-in templates (compiling each of them) in a new worker
+    process.
+    """
+    for name, template in templates.items():
+        register_builtin_block(name, template)
 
-                # If we successfully extracted a value, apply it to the field
-                if value is not None:
-                    # Apply the extracted value to the field
-                    if "fields" in result:
-                        result["fields"][field_name] = value
 
-        # Remove the field_mapping from the result as it's not part of the Blockly format
-        del result["field_mapping"]
+def _convert_chunk(sources, engine, flatten, ids, shared=True):
+    """
+    Convert a chunk of sources in a worker process, and return the name of a
+    new shared memory buffer containing the (UTF-8 encoded) JSON for each of
+    them, one after the other, with the length of each in bytes. The caller
+    must unlink the buffer (see _read_chunk). If shared is False (see
+    SHARED_MEMORY), return the bytes of the JSON in place of the name.
+    """
+    from multiprocessing import shared_memory
 
-    # Process the inputs dictionary if it exists
-    if "inputs" in result:
-        # Apply positional arguments (ARG0, ARG1, ARG2, etc.)
-        for i, arg_block in enumerate(arg_blocks):
-            arg_key = f"ARG{i}"
-            if arg_key in result["inputs"]:
-                # If there's a shadow block in the template
-                if "shadow" in result["inputs"][arg_key]:
-                    # Check if we can reuse the shadow block structure
-                    shadow = result["inputs"][arg_key]["shadow"]
-                    if (
-                        shadow["type"] == arg_block["type"]
-                        and "fields" in shadow
-                        and "fields" in arg_block
-                    ):
-                        # Update the fields in the shadow block
-                        for field_key, field_value in arg_block[
-                            "fields"
-                        ].items():
-                            if field_key in shadow["fields"]:
-                                shadow["fields"][field_key] = field_value
-                    else:
-                        # Types don't match, replace the shadow with the actual block
-                        result["inputs"][arg_key] = {"block": arg_block}
-                else:
-                    # No shadow, just set the block directly
-                    result["inputs"][arg_key]["block"] = arg_block
+    results = [
+        Converter(engine, flatten, ids=ids).convert(code).encode("utf-8")
+        for code in sources
+    ]
+    lengths = [len(result) for result in results]
+    if not shared:
+        return b"".join(results), lengths
+    memory = shared_memory.SharedMemory(create=True, size=max(1, sum(lengths)))
+    offset = 0
+    for result in results:
+        memory.buf[offset : offset + len(result)] = result
+        offset += len(result)
+    memory.close()
+    return memory.name, lengths
 
-    # Apply keyword arguments that didn't get used in field mappings
-    for kw_name, kw_block in kwarg_blocks:
-        kw_key = f"KWARG_{kw_name}"
-        # If the template has a specific placeholder for this keyword
-        if "inputs" in result and kw_key in result["inputs"]:
-            if "shadow" in result["inputs"][kw_key]:
-                # Similar logic to positional args with shadows
-                shadow = result["inputs"][kw_key]["shadow"]
-                if (
-                    shadow["type"] == kw_block["type"]
-                    and "fields" in shadow
-                    and "fields" in kw_block
-                ):
-                    for field_key, field_value in kw_block["fields"].items():
-                        if field_key in shadow["fields"]:
-                            shadow["fields"][field_key] = field_value
-                else:
-                    result["inputs"][kw_key] = {"block": kw_block}
-            else:
-                result["inputs"][kw_key]["block"] = kw_block
-        else:
-            # If the template doesn't have a specific placeholder, add it
-            if "inputs" not in result:
-                result["inputs"] = {}
-            result["inputs"][kw_key] = {"block": kw_block}
 
-    return result
+def _read_chunk(name, lengths):
+    """
+    Read the JSON for each of a chunk of sources from the named shared memory
+    buffer (see _convert_chunk), and unlink the buffer. If name is the bytes
+    of the JSON, read them instead.
+    """
+    from multiprocessing import shared_memory
+
+    if type(name) is bytes:
+        data = name
+    else:
+        memory = shared_memory.SharedMemory(name=name)
+        try:
+            data = bytes(memory.buf[: sum(lengths)])
+        finally:
+            memory.close()
+            memory.unlink()
+    results = []
+    offset = 0
+    for length in lengths:
+        results.append(data[offset : offset + length].decode("utf-8"))
+        offset += length
+    return results
 
 
-def traverse_node(node):
+def _discard_chunk(future):
     """
-    Traverse a node in the AST and generate the Blockly JSON.
+    Cancel the future for a chunk of sources (see _convert_chunk) that won't
+    be read, or wait for it and unlink its shared memory buffer, if it has
+    one (and it hasn't already been unlinked).
     """
-    # The Blockly JSON representation of the node.
-    block = {
-        "type": type(node).__name__,
-        # Add other global attributes here.
-    }
-    # Traverse the node and generate the Blockly JSON.
-    if node is None:
-        return node
-    elif isinstance(node, ast.Pass):
-        return block
-    elif isinstance(node, ast.FunctionDef):
-        block["extraState"] = {
-            "create_new_model": True,
-            "name": node.name,
-            "args": [{"name": arg.arg} for arg in node.args.args],
-        }
-        block["inputs"] = {"body": {}}
-        body = traverse_body(node.body)
-        if body:
-            block["inputs"]["body"]["block"] = body
-        # Iterate over args and create an Argument block within the corresponding input
-        for i, arg in enumerate(node.args.args, start=1):
-            block["inputs"][f"arg_{i:06}"] = {
-                "block": {
-                    "type": "Argument",
-                    "fields": {"name": arg.arg},
-                }
-            }
-        # Register the function for later use. TODO: FIXME for nested functions.
-        USER_DEFINED_FUNCTIONS[node.name] = {
-            "function_name": node.name,
-            "args": [{"name": arg.arg} for arg in node.args.args],
-        }
-    elif isinstance(node, ast.Return):
-        block["inputs"] = {
-            "value": {
-                "block": traverse_node(node.value),
-            },
+    from multiprocessing import shared_memory
+
+    if future.cancel():
+        return
+    try:
+        name, _ = future.result()
+        if type(name) is bytes:
+            # The JSON wasn't in shared memory.
+            return
+        memory = shared_memory.SharedMemory(name=name)
+    except Exception:
+        # The chunk failed, or its buffer was unlinked by _read_chunk.
+        return
+    memory.close()
+    memory.unlink()
+
+
+def _error(e):
+    """
+    Return the Blockly JSON (as a dict) for an error raised while converting
+    code.
+    """
+    if isinstance(e, SyntaxError):
+        # Return some helpful context for the syntax error.
+        context = {
+            "lineno": e.lineno,
+            "offset": e.offset,
+            "text": e.text,
+            "message": e.msg,
         }
-    elif isinstance(node, ast.Constant):
-        block["type"] = type(node.value).__name__
-        if isinstance(node.value, bool):
-            block["fields"] = {"value": str(node.value)}
+        return {"error": context}
+    # Catch all for all other errors.
+    return {"error": str(e)}
+
+
+def _dumps(value, default=None):
+    """
+    Return the JSON for the value, exactly as json.dumps would (with the
+    given default function), but without recursion, so values nested any
+    number of levels deep can be encoded. For example, the chains of blocks
+    linked via "next" for the top level statements of a very large module
+    (which nest two levels deeper for each statement), or the blocks for a
+    very deep expression converted by the stack engine.
+    """
+    try:
+        return json.dumps(value, default=default)
+    except RecursionError:
+        # Only encode the value in a loop if it's too deep, since it's
+        # slower.
+        return _encode(value, default)
+
+
+def _encode(value, default):
+    """
+    Return the JSON for the value, exactly as json.dumps would, using an
+    explicit stack of the lists and dicts being encoded, rather than
+    recursion (see _dumps).
+    """
+    parts = []
+    append = parts.append
+    # The iterator over the items of each list and dict being encoded, with
+    # whether it's a dict and whether any of its items have been encoded,
+    # innermost last.
+    stack = []
+    while True:
+        # The most common types are checked first.
+        if type(value) is str:
+            append(_encode_string(value))
+        elif isinstance(value, dict):
+            if value:
+                append("{")
+                stack.append([iter(value.items()), True, False])
+            else:
+                append("{}")
+        elif value is None:
+            append("null")
+        elif value is True:
+            append("true")
+        elif value is False:
+            append("false")
+        elif isinstance(value, str):
+            append(_encode_string(value))
+        elif isinstance(value, int):
+            append(int.__repr__(value))
+        elif isinstance(value, float):
+            append(json.dumps(value))
+        elif isinstance(value, (list, tuple)):
+            if value:
+                append("[")
+                stack.append([iter(value), False, False])
+            else:
+                append("[]")
+        elif default is not None:
+            value = default(value)
+            continue
         else:
-            block["fields"] = {"value": node.value}
-    elif isinstance(node, ast.Expr):
-        block = traverse_node(node.value)
-    elif isinstance(node, ast.FormattedValue):
-        block["inputs"] = {
-            "value": {
-                "block": traverse_node(node.value),
-            },
-            "format_spec": traverse_node(node.format_spec),
-        }
-    elif isinstance(node, ast.JoinedStr):
-        values = [traverse_node(value) for value in node.values]
-        block["fields"] = {"value": values}
-    elif isinstance(node, (ast.List, ast.Tuple, ast.Set)):
-        block["extraState"] = {"items": len(node.elts)}
-        block["inputs"] = {}
-        for i, elt in enumerate(node.elts, start=1):
-            block["inputs"][f"input_{i:06}"] = {"block": traverse_node(elt)}
-    elif isinstance(node, ast.Dict):
-        block["extraState"] = {"items": len(node.keys)}
-        block["inputs"] = {}
-        for i, (key, value) in enumerate(zip(node.keys, node.values), start=1):
-            if key is None:
-                # This is a **some_dict argument to unpack.
-                block["inputs"][f"input_{i:06}"] = {
-                    "block": {
-                        "type": "dict_unpack",
-                        "inputs": {
-                            "value": {"block": traverse_node(value)},
-                        },
-                    }
-                }
+            raise TypeError(
+                f"Object of type {type(value).__name__} is not JSON "
+                "serializable"
+            )
+        # Find the next value to encode, closing each list and dict that
+        # has no more items.
+        while stack:
+            entry = stack[-1]
+            item = next(entry[0], _END)
+            if item is _END:
+                stack.pop()
+                append("}" if entry[1] else "]")
+                continue
+            if entry[2]:
+                append(", ")
+            entry[2] = True
+            if entry[1]:
+                key, value = item
+                append(_encode_key(key))
+                append(": ")
             else:
-                block["inputs"][f"input_{i:06}"] = {
-                    "block": {
-                        "type": "dict_item",
-                        "inputs": {
-                            "key": {"block": traverse_node(key)},
-                            "value": {"block": traverse_node(value)},
-                        },
-                    }
-                }
-    elif isinstance(node, ast.Delete):
-        block["extraState"] = {"items": len(node.targets)}
-        block["inputs"] = {}
-        for i, target in enumerate(node.targets, start=1):
-            block["inputs"][f"input_{i:06}"] = {"block": traverse_node(target)}
-    elif isinstance(node, ast.AugAssign):
-        block["inputs"] = {
-            "value": {
-                "block": traverse_node(node.value),
-            },
+                value = item
+            break
+        else:
+            return "".join(parts)
+
+
+# The end of the items of a list or dict (see _encode).
+_END = object()
+
+_encode_string = json.encoder.encode_basestring_ascii
+
+
+def _encode_key(key):
+    """
+    Return the JSON for the key of an item in a dict, as json.dumps would.
+    """
+    if isinstance(key, str):
+        return _encode_string(key)
+    if key is None or isinstance(key, (int, float)):
+        return '"' + json.dumps(key) + '"'
+    raise TypeError(
+        "keys must be str, int, float, bool or None, not "
+        f"{type(key).__name__}"
+    )
+
+
+# The first word of the binary encoding (see encode_blocks), which includes
+# the version of the encoding.
+_BINARY_MAGIC = int.from_bytes(b"PYB2", "little")
+
+# The tags of the records in the binary encoding, in the low bits of the
+# first word of each record.
+_NULL, _FALSE, _TRUE, _INT, _NUMBER, _STRING, _LIST, _DICT, _REF = range(9)
+_TAG_BITS = 4
+_TAG_MASK = (1 << _TAG_BITS) - 1
+_MAX_PAYLOAD = (1 << (32 - _TAG_BITS)) - 1
+
+
+def encode_blocks(result, dedup=False):
+    """
+    Encode the Blockly JSON (as a dict, such as from py2blocks_dict) in a
+    compact binary form, with exactly the same content (including the order
+    of the keys). Every string (such as block types, input and field names,
+    and field values) is stored once, in a string table, and the values are
+    laid out as a flat array of 32 bit records, in the order json.dumps would
+    encode them. Chains of blocks of any length are encoded without
+    recursion.
+
+    If dedup is True, each distinct list or dict (such as the block for a
+    repeated expression, or the inputs of a repeated call) is only encoded
+    the first time it occurs. Every later copy of it is a single record that
+    refers back to the first (see _number_subtrees).
+
+    The encoding (all little endian, unsigned 32 bit words) is:
+
+    * a header of four words: the magic number (b"PYB2"), the number of
+      strings (n), the number of words of records (r), and the number of
+      bytes of UTF-8 (u) in the string table.
+    * n + 1 words: the offset of the start of each string (and of the end
+      of the last one) in the UTF-8.
+    * u bytes: the UTF-8 for the strings, padded with zeros to a multiple
+      of four bytes.
+    * r words: the records for the value. The low four bits of the first
+      word of a record are its tag, and the rest (the payload) are:
+
+      - null (0), false (1), true (2): unused.
+      - int (3): the int, zigzag encoded (0, -1, 1, -2 are 0, 1, 2, 3).
+      - number (4): the index of the string of the JSON for the number,
+        for numbers that don't fit (such as floats).
+      - string (5): the index of the string.
+      - list (6): the number of items, whose records follow.
+      - dict (7): the number of items, each of which is a word (the index
+        of the string for its key) followed by the records for its value.
+      - reference (8): the index of the first word of the records of an
+        earlier list or dict that's the same as this one (if dedup).
+
+    The words of the records start on a four byte boundary, so JavaScript
+    can read them directly with a Uint32Array on the same buffer.
+
+    Args:
+        result (dict): The Blockly JSON to encode.
+        dedup (bool): If True, encode repeated lists and dicts as
+            references to the first copy.
+
+    Returns:
+        bytes: The encoded Blockly JSON.
+
+    Raises:
+        TypeError: If the result contains anything other than the types
+            json.dumps encodes by default.
+        ValueError: If there are too many strings or items to encode.
+    """
+    # The index of each string, in the order they're first used.
+    strings = {}
+    records = []
+    # The number of each distinct list and dict (see _number_subtrees), and
+    # the index of the first word of the records for each number encoded.
+    numbers = _number_subtrees(result) if dedup else None
+    firsts = {}
+    # The values still to be encoded, last first. A (word,) tuple is a word
+    # to add as is (for the key of an item in a dict).
+    pending = [result]
+    while pending:
+        value = pending.pop()
+        value_type = type(value)
+        if value_type is tuple:
+            records.append(value[0])
+            continue
+        if value_type is str:
+            tag = _STRING
+            payload = strings.setdefault(value, len(strings))
+        elif value_type is dict or value_type is list:
+            tag = _DICT if value_type is dict else _LIST
+            payload = len(value)
+            if numbers is not None and payload:
+                first = firsts.setdefault(numbers[id(value)], len(records))
+                if first != len(records):
+                    tag = _REF
+                    payload = first
+            if tag == _DICT:
+                for key, item in reversed(value.items()):
+                    pending.append(item)
+                    pending.append(
+                        (strings.setdefault(str(key), len(strings)),)
+                    )
+            elif tag == _LIST:
+                pending.extend(reversed(value))
+        elif value is None:
+            tag = _NULL
+            payload = 0
+        elif value_type is bool:
+            tag = _TRUE if value else _FALSE
+            payload = 0
+        elif value_type is int and -(1 << 27) <= value < 1 << 27:
+            tag = _INT
+            payload = value << 1 if value >= 0 else (-value << 1) - 1
+        elif value_type in (int, float):
+            tag = _NUMBER
+            payload = strings.setdefault(json.dumps(value), len(strings))
+        else:
+            raise TypeError(
+                f"Object of type {value_type.__name__} is not JSON "
+                "serializable"
+            )
+        if payload > _MAX_PAYLOAD:
+            raise ValueError("Too many strings or items to encode.")
+        records.append(payload << _TAG_BITS | tag)
+    encoded = [text.encode("utf-8", "surrogatepass") for text in strings]
+    offsets = [0]
+    for text in encoded:
+        offsets.append(offsets[-1] + len(text))
+    header = array.array(
+        "I", [_BINARY_MAGIC, len(strings), len(records), offsets[-1]]
+    )
+    header.extend(offsets)
+    records = array.array("I", records)
+    if sys.byteorder == "big":
+        header.byteswap()
+        records.byteswap()
+    padding = b"\0" * (-offsets[-1] % 4)
+    return b"".join([header.tobytes(), *encoded, padding, records.tobytes()])
+
+
+def decode_blocks(data):
+    """
+    Decode the Blockly JSON (as a dict) from its binary encoding (see
+    encode_blocks). This is the reference decoder: the result is exactly
+    the same as the dict that was encoded. References to repeated lists and
+    dicts (see encode_blocks) are expanded to the same object as the first
+    copy, so the result is standard Blockly JSON, but those objects are
+    shared and shouldn't be changed.
+
+    Args:
+        data (bytes): The encoded Blockly JSON (or a bytearray or
+            memoryview of it).
+
+    Returns:
+        dict: The Blockly JSON.
+
+    Raises:
+        ValueError: If the data isn't a valid encoding.
+    """
+    data = bytes(data)
+    header = array.array("I", data[:16])
+    if sys.byteorder == "big":
+        header.byteswap()
+    if len(header) != 4 or header[0] != _BINARY_MAGIC:
+        raise ValueError("The data isn't encoded Blockly JSON.")
+    _, count, length, size = header
+    start = 16 + 4 * (count + 1)
+    end = start + size + -size % 4
+    if len(data) != end + 4 * length:
+        raise ValueError("The encoded Blockly JSON is the wrong length.")
+    offsets = array.array("I", data[16:start])
+    records = array.array("I", data[end:])
+    if sys.byteorder == "big":
+        offsets.byteswap()
+        records.byteswap()
+    text = data[start : start + size]
+    strings = [
+        text[offsets[i] : offsets[i + 1]].decode("utf-8", "surrogatepass")
+        for i in range(count)
+    ]
+    root = []
+    # The lists and dicts being filled in, with the number of items each
+    # still needs, innermost last.
+    filling = [[root, 1]]
+    # The lists and dicts decoded so far, by the index of their first word.
+    decoded = {}
+    position = 0
+    try:
+        while filling:
+            container = filling[-1]
+            if not container[1]:
+                filling.pop()
+                continue
+            container[1] -= 1
+            container = container[0]
+            if type(container) is dict:
+                key = strings[records[position]]
+                position += 1
+            word = records[position]
+            position += 1
+            tag = word & _TAG_MASK
+            payload = word >> _TAG_BITS
+            if tag == _STRING:
+                value = strings[payload]
+            elif tag == _DICT or tag == _LIST:
+                value = {} if tag == _DICT else []
+                if payload:
+                    filling.append([value, payload])
+                    decoded[position - 1] = value
+            elif tag == _REF:
+                value = decoded[payload]
+            elif tag == _INT:
+                value = -((payload + 1) >> 1) if payload & 1 else payload >> 1
+            elif tag == _NUMBER:
+                value = json.loads(strings[payload])
+            elif tag <= _TRUE:
+                value = (None, False, True)[tag]
+            else:
+                raise ValueError(f"Unknown tag in encoded Blockly JSON: {tag}")
+            if type(container) is dict:
+                container[key] = value
+            else:
+                container.append(value)
+    except (IndexError, KeyError):
+        raise ValueError("The encoded Blockly JSON is incomplete.")
+    if position != length:
+        raise ValueError("The encoded Blockly JSON has extra records.")
+    return root[0]
+
+
+def _number_subtrees(result):
+    """
+    Number each distinct list and dict (with any items) in the result, so
+    equal ones have the same number, however deeply they're nested. The
+    subtrees are hash-consed from the leaves up (without recursion): each
+    one's canonical form is its type and its items, with each list and dict
+    in them replaced by its number, so comparing forms is cheap.
+
+    Returns:
+        dict: The number of each list and dict, keyed by its id().
+    """
+    numbers = {}
+    # The number for each canonical form.
+    forms = {}
+    # The lists and dicts to number, with whether their items are numbered.
+    pending = [(result, False)]
+    while pending:
+        value, ready = pending.pop()
+        if id(value) in numbers:
+            # Shared by more than one block (see convert_dict).
+            continue
+        items = value.items() if type(value) is dict else enumerate(value)
+        if not ready:
+            pending.append((value, True))
+            for _, item in items:
+                if type(item) in (dict, list) and item:
+                    pending.append((item, False))
+            continue
+        form = [type(value)]
+        for key, item in items:
+            form.append(key)
+            item_type = type(item)
+            if item_type is str or item is None:
+                form.append(item)
+            elif item_type is dict or item_type is list:
+                # Empty lists and dicts aren't numbered.
+                form.append(numbers[id(item)] if item else (item_type,))
+            else:
+                # So that 1, 1.0 and True are different.
+                form.append((item_type, item))
+        numbers[id(value)] = forms.setdefault(tuple(form), len(forms))
+    return numbers
+
+
+class ParseCache:
+    """
+    A bounded cache of the ASTs parsed from pieces of Python code, keyed by
+    a hash of the code, so code that's converted (or checked by other tools)
+    again and again is only parsed once. It's safe to share between threads
+    and sessions (see Converter).
+
+    The same AST is returned for the same code, so it must not be changed.
+    Only the max_size most recently used ASTs are kept. Code with a syntax
+    error isn't cached.
+
+    The stats contain the number of "hits" and "misses".
+    """
+
+    def __init__(self, max_size=128):
+        """
+        Create an empty cache.
+
+        Args:
+            max_size (int): The maximum number of ASTs to keep.
+        """
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0}
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, code):
+        """
+        Return the AST for the code, parsing it if it isn't in the cache.
+
+        Args:
+            code (str): The Python code to parse.
+
+        Returns:
+            ast.Module: The AST (which must not be changed).
+
+        Raises:
+            SyntaxError: If the code can't be parsed.
+        """
+        data = code.encode("utf-8", "surrogatepass")
+        key = hashlib.blake2b(data, digest_size=16).digest()
+        trees = self._trees
+        with self._lock:
+            tree = trees.get(key)
+            if tree is not None:
+                trees.move_to_end(key)
+                self.stats["hits"] += 1
+                return tree
+            self.stats["misses"] += 1
+        # Parse without holding the lock, so other threads aren't held up.
+        tree = ast.parse(code)
+        with self._lock:
+            trees[key] = tree
+            while len(trees) > self.max_size:
+                trees.popitem(last=False)
+        return tree
+
+    def __len__(self):
+        """
+        Return the number of ASTs in the cache.
+        """
+        return len(self._trees)
+
+    def clear(self):
+        """
+        Remove all the ASTs from the cache.
+        """
+        with self._lock:
+            self._trees.clear()
+
+
+class DiskCache:
+    """
+    A persistent cache of the Blockly JSON for pieces of Python code, stored
+    (compressed) in a SQLite database file, so the same code is only
+    converted once, across runs and processes.
+
+    Each result is keyed by a hash of the code, the options it was converted
+    with, the registered node handlers, the version of the converter (a hash
+    of this module's source code) and the version of Python (see
+    DiskCache.key). So there's no need to clear the cache when any of them
+    change: the old results are just never used again, and are eventually
+    evicted. Each result also records the fingerprint (see
+    template_fingerprint) of the built-in template for each function the
+    code calls (or None, for functions without a template). A result is
+    only used if these are the same as the current templates, so
+    registering or replacing a template only invalidates the results for
+    code that calls it.
+
+    When the total size of the (compressed) results is more than max_size
+    bytes, the least recently used results are evicted, until it's 90% of
+    max_size. Several processes (or threads) can use the same file at the
+    same time.
+
+    The stats contain the number of "hits", "misses" and "evictions" for
+    this cache object (not for other processes using the same file), and
+    the number of "invalidations": misses because a result was found, but
+    for different templates.
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024):
+        """
+        Open (or create) the cache.
+
+        Args:
+            path (str): The path of the SQLite database file.
+            max_size (int): The maximum total size, in bytes, of the
+                (compressed) results in the cache.
+        """
+        # SQLite isn't available in all environments (e.g. Pyodide).
+        import sqlite3
+
+        self.path = path
+        self.max_size = max_size
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0,
         }
-        block["fields"] = {"var": {"name": node.target.id}}
-    elif isinstance(node, ast.Name):
-        block["fields"] = {"var": {"name": node.id}}
-    elif isinstance(node, ast.BinOp):
-        block["inputs"] = {
-            "left": {
-                "block": traverse_node(node.left),
-            },
-            "right": {
-                "block": traverse_node(node.right),
+        self._lock = threading.Lock()
+        # Wait (rather than fail) while another process is writing.
+        self._connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            # Readers don't block the writer (or each other) in WAL mode.
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # It's only a cache, so it's fine to lose the most recent writes
+            # on a power failure (but not to corrupt the database).
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS conversions ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "templates TEXT NOT NULL, size INTEGER NOT NULL, "
+                "used REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS conversions_used "
+                "ON conversions (used)"
+            )
+
+    def convert(
+        self,
+        code,
+        engine="recursive",
+        flatten=False,
+        ids=False,
+        tree=None,
+        parse_cache=None,
+    ):
+        """
+        Return the Blockly JSON for the code (see py2blocks), from the cache
+        if possible, otherwise converting it and adding it to the cache.
+        """
+        key = self.key(code, engine, flatten, ids)
+        result = self.get(key)
+        if result is None:
+            converter = Converter(
+                engine, flatten, ids=ids, parse_cache=parse_cache
+            )
+            result = converter.convert(code, tree=tree)
+            self.put(key, result, converter.function_keys)
+        return result
+
+    def key(self, code, engine="recursive", flatten=False, ids=False):
+        """
+        Return the key for the Blockly JSON for the code, converted with the
+        given options, by the current converter.
+        """
+        options = json.dumps([engine, flatten, ids, _converter_fingerprint()])
+        digest = hashlib.sha256(options.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(code.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Return the Blockly JSON (str) in the cache for the key, or None if
+        it isn't in the cache, or a template it used has changed since.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, templates FROM conversions WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                templates = json.loads(row[1])
+                if templates != _template_fingerprints(templates):
+                    self.stats["invalidations"] += 1
+                    row = None
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self._connection.execute(
+                "UPDATE conversions SET used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key, result, function_keys=()):
+        """
+        Add the Blockly JSON (str) to the cache with the key, evicting the
+        least recently used results if the cache is too big. The function
+        keys are those of the calls in the code (see
+        Converter.function_keys), whose templates the result depends on.
+        """
+        value = zlib.compress(result.encode("utf-8"))
+        templates = json.dumps(_template_fingerprints(function_keys))
+        with self._lock:
+            connection = self._connection
+            # Take the write lock for the whole transaction, so the total
+            # size can't change under us.
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO conversions "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, value, templates, len(value), time.time()),
+                )
+                (total,) = connection.execute(
+                    "SELECT SUM(size) FROM conversions"
+                ).fetchone()
+                if total > self.max_size:
+                    # Make room for more than this result, so there's no
+                    # need to evict results on every put.
+                    target = self.max_size * 0.9
+                    evicted = []
+                    for old_key, size in connection.execute(
+                        "SELECT key, size FROM conversions ORDER BY used"
+                    ):
+                        if total <= target:
+                            break
+                        evicted.append((old_key,))
+                        total -= size
+                    connection.executemany(
+                        "DELETE FROM conversions WHERE key = ?", evicted
+                    )
+                    self.stats["evictions"] += len(evicted)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def __len__(self):
+        """
+        Return the number of results in the cache.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM conversions"
+            ).fetchone()[0]
+
+    def clear(self):
+        """
+        Remove all the results from the cache (for all processes).
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM conversions")
+
+    def close(self):
+        """
+        Close the database file.
+        """
+        with self._lock:
+            self._connection.close()
+
+
+# The hash of this module's source code, and the version of Python, used as
+# the version of the converter in DiskCache keys (see _converter_fingerprint).
+_CONVERTER_VERSION = None
+
+
+def _converter_fingerprint():
+    """
+    Return a hash of everything, other than the code, the options and the
+    built-in templates, that the Blockly JSON for some code depends on: the
+    version of the converter (see _CONVERTER_VERSION) and the node handlers.
+    """
+    global _CONVERTER_VERSION
+    if _CONVERTER_VERSION is None:
+        digest = hashlib.sha256(sys.version.encode("utf-8"))
+        try:
+            with open(__file__, "rb") as module:
+                digest.update(module.read())
+        except (NameError, OSError):
+            pass
+        _CONVERTER_VERSION = digest.hexdigest()
+    handlers = sorted(
+        f"{ast_type.__module__}.{ast_type.__qualname__}="
+        f"{handler.__module__}.{handler.__qualname__}"
+        for ast_type, handler in NODE_HANDLERS.items()
+    )
+    data = json.dumps([_CONVERTER_VERSION, handlers])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _template_fingerprints(function_keys):
+    """
+    Return the fingerprint of the template in BUILTIN_BLOCKS for each of the
+    function keys (or None, if there isn't one), keyed by function key.
+    """
+    return {
+        key: (
+            template_fingerprint(key, BUILTIN_BLOCKS[key])
+            if key in BUILTIN_BLOCKS
+            else None
+        )
+        for key in function_keys
+    }
+
+
+class Converter:
+    """
+    A conversion session. It owns all the state built up while converting
+    Python code to Blockly JSON, so independent sessions can safely convert
+    code at the same time (for example, in different threads).
+
+    The state is:
+
+    * user_defined_functions - the functions defined so far by the code
+      being (or most recently) converted, keyed by name. Calls to these functions (and to built-in functions)
+      become blocks, rather than catch_all blocks. The value is the metadata
+      needed to generate a valid block for the function.
+    * builtin_blocks - the built-in function templates, which are those in
+      BUILTIN_BLOCKS plus any registered with this session.
+    * builtin_builders - the builders compiled from builtin_blocks, which
+      start with those compiled for BUILTIN_BLOCKS.
+    * conversion_stats - statistics about the most recent call to traverse
+      (or about all the calls to traverse_node and traverse_body since then):
+
+      - nodes - the number of nodes in the AST that were visited (converted).
+      - catch_all - the number of catch_all blocks created.
+      - wasted_visits - the number of visits to nodes whose blocks were thrown
+        away because an enclosing node became a catch_all block after its
+        children were converted. The built-in handlers check if a node will
+        become a catch_all block (see will_catch_all) before converting any
+        children, so this is only non-zero because of custom handlers.
+      - cache_hits and cache_misses - the number of top level statements
+        whose blocks were (or weren't) found in the statement_cache.
+      - cache_hit_rate - the fraction of top level statements whose blocks
+        were found in the statement_cache (or zero, if it wasn't used).
+
+    * function_keys - the function keys (see get_function_key) of the calls
+      in the code most recently converted by traverse (including calls
+      that became catch_all blocks). Only the templates for these keys were
+      used, so the result only depends on them (see DiskCache).
+    * source - the index of the source code being converted by traverse, if
+      available, from which the code in catch_all blocks is taken.
+    * statement_cache - if the session has a cache_size, the blocks for the
+      most recently converted top level statements (see traverse). The keys
+      are ("source", code) for the statement's source code, and ("ast", dump)
+      for ast.dump of the statement, so statements that only differ in their
+      position, whitespace or comments share an entry. The value is a
+      (block, registrations, catch_all, code, function_keys, known) tuple,
+      where registrations are the (name, metadata) of each user-defined
+      function that the statement defines, catch_all is True if the block
+      contains catch_all blocks, code is the statement's source code (or
+      None, if the source code wasn't available), function_keys are the
+      function keys of the calls in the statement and known are those that
+      were user-defined functions (defined before the statement). Replacing
+      the template for a function key only removes the entries for
+      statements that call it, and an entry is only used if the same
+      function keys are user-defined functions as when it was cached.
+    * document - the Document for the source code most recently converted
+      by convert, traverse or edit, so it can be edited (see edit), or None.
+
+    Each call to traverse (or iter_blocks) starts with no user-defined
+    functions, so the result only depends on the code converted (in which
+    calls only become blocks after the function is defined), and is the
+    same however many times it's converted, and by whichever session.
+    """
+
+    def __init__(
+        self,
+        engine="recursive",
+        flatten=False,
+        cache_size=0,
+        ids=False,
+        parse_cache=None,
+    ):
+        """
+        Create a new session.
+
+        Args:
+            engine (str): The name of the traversal engine to use (see
+                ENGINES).
+            flatten (bool): If True, convert long chains of BoolOp, Compare
+                and BinOp operations (such as a and b and c, 0 < a < b, or
+                a + b + c) into a single BoolOpChain, CompareChain or
+                BinOpChain block with an input for each item, rather than
+                nesting binary blocks.
+            cache_size (int): The maximum number of keys in the
+                statement_cache (there are one or two for each top level
+                statement). If 0, there is no cache.
+            ids (bool): If True, give every block (in the inputs of other
+                blocks, or at the top level) an "id" that only depends on
+                the top level statement it's in, so it stays the same when
+                other statements change (see _assign_ids).
+            parse_cache (ParseCache): If given, the cache of ASTs that the
+                code converted by convert and edit is parsed with (see
+                parse).
+        """
+        self.engine = engine
+        self.flatten = flatten
+        self.cache_size = cache_size
+        self.ids = ids
+        self.parse_cache = parse_cache
+        self.builtin_blocks = ChainMap({}, BUILTIN_BLOCKS)
+        # The (name, metadata) of each user-defined function registered while
+        # converting the current top level statement (see register_function),
+        # or None if they're not being recorded.
+        self._registrations = None
+        # Each Constant and Name node converted into a block, followed by
+        # the block, so the blocks can be found by their position in the
+        # source code (see Document), or None if they're not being recorded.
+        # The list is flat so recording them doesn't create any objects.
+        self._tokens = None
+        # The set the function keys of calls are added to (see
+        # function_keys), or None if they're not being recorded.
+        self._function_keys = None
+        # The (name, metadata) of the user-defined functions defined by each
+        # top level statement, in a list for each statement, so the document
+        # knows which functions each region defines (see Document), or None
+        # if they're not being recorded.
+        self._defined = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything learnt from the code converted so far, so the
+        session is the same as a new one (with the same engine, options and
+        built-in blocks).
+        """
+        self.user_defined_functions = {}
+        self.builtin_builders = ChainMap({}, BUILTIN_BUILDERS)
+        self.conversion_stats = {
+            "nodes": 0,
+            "catch_all": 0,
+            "wasted_visits": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "cache_hit_rate": 0,
+        }
+        self.function_keys = set()
+        self.source = None
+        self.statement_cache = OrderedDict() if self.cache_size else None
+        self.document = None
+        # The chains of blocks in each stack of the Blockly JSON most
+        # recently returned by convert or edit (see diff_blocks).
+        self._previous = []
+        # The state of everything (other than the statement itself and the
+        # templates) that the blocks in the statement_cache depend upon. See
+        # _cache_state.
+        self._cached_state = None
+        # The fingerprint of each template (see template_fingerprint) when
+        # the statement_cache was last checked, keyed by function key.
+        self._cached_templates = {}
+
+    def reset_conversion_stats(self):
+        """
+        Reset all the counts in conversion_stats to zero.
+        """
+        for key in self.conversion_stats:
+            self.conversion_stats[key] = 0
+
+    def convert(self, code, patch=False, tree=None):
+        """
+        Convert Python code to Blockly JSON.
+
+        Args:
+            code (str): The Python code to convert.
+            patch (bool): If True, return a patch from the Blockly JSON most
+                recently returned by this session (see diff_blocks), as
+                {"patch": [operation, ...]}, rather than the Blockly JSON.
+            tree (ast.Module): If given, the AST already parsed from the
+                code (which must be exactly the same code), so it isn't
+                parsed again.
+
+        Returns:
+            str: The Blockly JSON representation of the Python code (or the
+            patch to it).
+        """
+        return self._to_json(self._convert(code, tree), patch)
+
+    def convert_dict(self, code, patch=False, tree=None):
+        """
+        Convert Python code to Blockly JSON, in the same way as convert,
+        but return it as a dict (as json.loads would for the result of
+        convert), without encoding it. The blocks may be shared with later
+        results (see traverse), so don't change them. Later conversions and
+        edits return new dicts, and never change the blocks in this one.
+
+        Returns:
+            dict: The Blockly JSON representation of the Python code (or the
+            patch to it), or {"error": details} (see convert).
+        """
+        return self._to_dict(self._convert(code, tree), patch)
+
+    def write(self, code, buffer, tree=None):
+        """
+        Convert Python code to Blockly JSON, in the same way as convert, but
+        write the JSON into the buffer, replacing its contents, in the same
+        way as write_blocks of stream_blocks. The blocks for each top level
+        statement are built as dicts, encoded into the buffer, and then
+        dropped, so the memory used for the blocks is bounded by the largest
+        top level statement, rather than growing with the whole of the code
+        (as it does for json.dumps of the result of traverse).
+
+        As with iter_blocks, the statement_cache isn't used, and the
+        session's document and most recent result aren't changed.
+
+        Args:
+            code (str): The Python code to convert.
+            buffer (io.StringIO or bytearray): The buffer to write the JSON
+                to (as UTF-8, for a bytearray). Any other seekable text file
+                can be used in place of an io.StringIO.
+            tree (ast.Module): If given, the AST already parsed from the
+                code.
+
+        Returns:
+            The buffer, containing the Blockly JSON representation of the
+            Python code, or {"error": details} (see convert).
+        """
+        if type(buffer) is bytearray:
+
+            def clear():
+                del buffer[:]
+
+            def write(text):
+                buffer.extend(text.encode("utf-8"))
+
+        else:
+
+            def clear():
+                buffer.seek(0)
+                buffer.truncate()
+
+            write = buffer.write
+
+        clear()
+        try:
+            _write_chunks(self._stream_blocks(code, tree), write)
+        except Exception as e:
+            # Replace the JSON written so far, which can't be finished.
+            clear()
+            write(json.dumps(_error(e)))
+        return buffer
+
+    def _convert(self, code, tree):
+        """
+        Return a function that converts the code (see convert), which
+        returns the Blockly JSON as a dict.
+        """
+
+        def convert_code():
+            # Parse the Python code into an AST.
+            nonlocal tree
+            if tree is None:
+                tree = self.parse(code)
+            # Traverse the AST to generate the Blockly JSON.
+            return self.traverse(tree, code)
+
+        # The document can't be edited until it has been converted, and
+        # defines no functions until then.
+        self.document = Document(code)
+        self.user_defined_functions = {}
+        return convert_code
+
+    def edit(self, offset, removed_length, inserted_text, patch=False):
+        """
+        Convert the source code in the session's document (the code most
+        recently converted), after an edit, to Blockly JSON.
+
+        If the edit is within a single number, string or name (such as
+        changing 12 to 123, or x to xy) and leaves it the same type of token,
+        the field in the block for the token is patched, without parsing or
+        converting anything (see Document).
+
+        Otherwise, only the region of the document that contains the edit
+        is parsed and converted again, and its blocks are spliced into the
+        existing blocks for the document, unless:
+
+        * the edit crosses from one region into another,
+        * the edited region doesn't parse on its own (or runs on into the
+          next region), or
+        * the edit adds, removes or renames a function defined in the edited
+          region (which changes how calls to it in later regions are
+          converted),
+
+        in which case the whole document is parsed and converted again. The
+        edited region only knows the functions defined in the regions before
+        it, so the result is always the same as converting the edited code.
+
+        Args:
+            offset (int): The offset into the document at which the edit
+                starts.
+            removed_length (int): The number of characters removed from the
+                document at offset.
+            inserted_text (str): The text inserted into the document at
+                offset.
+            patch (bool): If True, return a patch rather than the Blockly
+                JSON (see convert).
+
+        Returns:
+            str: The Blockly JSON representation of the edited source code
+            (or the patch to it).
+        """
+        return self._to_json(
+            self._edit(offset, removed_length, inserted_text), patch
+        )
+
+    def edit_dict(self, offset, removed_length, inserted_text, patch=False):
+        """
+        Convert the source code in the session's document after an edit, in
+        the same way as edit, but return the Blockly JSON as a dict (see
+        convert_dict).
+
+        Returns:
+            dict: The Blockly JSON representation of the edited source code
+            (or the patch to it), or {"error": details}.
+        """
+        return self._to_dict(
+            self._edit(offset, removed_length, inserted_text), patch
+        )
+
+    def _edit(self, offset, removed_length, inserted_text):
+        """
+        Return a function that converts the session's document after the
+        edit (see edit), which returns the Blockly JSON as a dict.
+        """
+        document = self.document
+        if document is None:
+            raise ValueError("There is no document to edit.")
+        source = document.source
+        end = offset + removed_length
+        if not 0 <= offset <= end <= len(source):
+            raise ValueError("The edit is outside the document.")
+        code = source[:offset] + inserted_text + source[end:]
+
+        def convert_edit():
+            result = self._patch(document, offset, end, inserted_text, code)
+            if result is None:
+                result = self._splice(
+                    document, offset, end, inserted_text, code
+                )
+            if result is None:
+                result = self.traverse(self.parse(code), code)
+            return result
+
+        self.document = Document(code)
+        self.user_defined_functions = {}
+        return convert_edit
+
+    def parse(self, code):
+        """
+        Parse the code into an AST, via the session's parse_cache, if it has
+        one.
+
+        Args:
+            code (str): The Python code to parse.
+
+        Returns:
+            ast.Module: The AST.
+        """
+        if self.parse_cache is None:
+            return ast.parse(code)
+        return self.parse_cache.parse(code)
+
+    def _to_json(self, convert, patch=False):
+        """
+        Call the convert function, which returns the Blockly JSON as a dict,
+        and return it (or the patch to it, from the previous Blockly JSON) as
+        a string, or the details of any error.
+        """
+        previous = self._previous
+        result = self._to_dict(convert, patch)
+        try:
+            return _dumps(result)
+        except Exception as e:
+            # The result was never returned, so the next patch is from the
+            # one before.
+            self._previous = previous
+            return json.dumps({"error": str(e)})
+
+    def _to_dict(self, convert, patch=False):
+        """
+        Call the convert function, which returns the Blockly JSON as a dict,
+        and return it (or the patch to it, from the previous Blockly JSON),
+        or the details of any error, as a dict.
+        """
+        try:
+            result = convert()
+            stacks = _stacks(result)
+            if patch:
+                result = {"patch": _diff_stacks(self._previous, stacks)}
+        except Exception as e:
+            return _error(e)
+        # The blocks are never changed once they're in a result (other than
+        # their "next"), so the blocks at the top level are all that's needed
+        # to compare against the next result.
+        self._previous = stacks
+        return result
+
+    def traverse(self, tree, source=None):
+        """
+        Traverse the AST and generate the Blockly JSON.
+
+        Args:
+            tree (ast.AST): The AST to traverse.
+            source (str): The source code the AST was parsed from, if
+                available, used for the code in catch_all blocks.
+
+        Returns:
+            dict: The Blockly JSON representation of the AST.
+        """
+        self.source = SourceIndex(source) if source is not None else None
+        self.user_defined_functions = {}
+        self.reset_conversion_stats()
+        # The root of the Blockly JSON.
+        blocks = {
+            "blocks": [],
+        }
+        # Traverse the AST and generate the Blockly JSON. The top level
+        # statements are chained together in exactly the same way as the body
+        # of a node.
+        if source is not None:
+            # Record the blocks for tokens and the functions defined by each
+            # statement, for the document.
+            self._tokens = []
+            self._defined = []
+        self._function_keys = self.function_keys = set()
+        try:
+            if tree.body:
+                blocks["blocks"].append(self._traverse_top_level(tree.body))
+        finally:
+            tokens = self._tokens
+            defined = self._defined
+            self._tokens = None
+            self._defined = None
+            self._function_keys = None
+        if self.ids and blocks["blocks"]:
+            blocks["blocks"] = [_assign_ids(_chain(blocks["blocks"][0]))[0]]
+        result = {
+            "blocks": blocks,
+        }
+        if source is not None:
+            self.document = _index_document(
+                source, tree.body, self.source, result, tokens, defined
+            )
+        return result
+
+    def iter_blocks(self, tree, source=None):
+        """
+        Traverse the AST, one top level statement at a time, generating the
+        block for each statement (without a "next") as it's converted. The
+        blocks are the same as those in the result of traverse, other than
+        not being chained together.
+
+        The statement_cache isn't used, and the session's document (see
+        edit) and most recent result (see convert) aren't changed.
+
+        Args:
+            tree (ast.AST): The AST to traverse.
+            source (str): The source code the AST was parsed from, if
+                available, used for the code in catch_all blocks.
+
+        Returns:
+            generator: The block (dict) for each top level statement.
+        """
+        self.source = SourceIndex(source) if source is not None else None
+        self.user_defined_functions = {}
+        self.reset_conversion_stats()
+        self.function_keys = set()
+        # The counts used to give each block an id, if needed.
+        counts = {}
+        for node in tree.body:
+            self._function_keys = self.function_keys
+            try:
+                block = self.traverse_node(node)
+            finally:
+                self._function_keys = None
+            if self.ids:
+                block = _assign_id(block, counts)
+            yield block
+
+    def _stream_blocks(self, code, tree=None):
+        """
+        Generate the JSON (str) for the block for each top level statement
+        in the code (see stream_blocks), parsing it first if no tree is
+        given.
+        """
+        if tree is None:
+            tree = self.parse(code)
+        for block in self.iter_blocks(tree, code):
+            yield _dumps(block)
+
+    def _traverse_top_level(self, body):
+        """
+        Traverse the (non-empty) top level statements in the body of a
+        module, using the statement_cache if there is one, and recording the
+        functions defined by each statement, if they're being recorded (see
+        _defined).
+        """
+        if self.statement_cache is not None:
+            return self._traverse_cached_body(body)
+        if self._defined is None:
+            return self.traverse_body(body)
+        first_block = None
+        previous_block = None
+        for node in body:
+            self._registrations = registrations = []
+            try:
+                block = self.traverse_node(node)
+            finally:
+                self._registrations = None
+            self._defined.append(registrations)
+            if previous_block is None:
+                first_block = block
+            else:
+                previous_block["next"] = {"block": block}
+            previous_block = block
+        return first_block
+
+    def _splice(self, document, offset, end, inserted_text, code):
+        """
+        Convert the region of the document that contains the edit replacing
+        document.source[offset:end] with inserted_text (giving code), and
+        splice its blocks into the document's existing blocks. Return the
+        updated Blockly JSON, or None if the whole of the code must be
+        converted instead (see edit).
+        """
+        starts = document.starts
+        if document.result is None or not starts:
+            return None
+        i = bisect.bisect_right(starts, offset) - 1
+        is_last = i + 1 == len(starts)
+        region_end = len(document.source) if is_last else starts[i + 1]
+        if end > region_end:
+            return None
+        shift = len(inserted_text) - (end - offset)
+        start = starts[i]
+        text = code[start : region_end + shift]
+        if not is_last and not text.endswith(("\n", "\r")):
+            # The region would run on into the next region.
+            return None
+        try:
+            tree = ast.parse(text)
+        except (SyntaxError, ValueError):
+            return None
+        # Only the functions defined before the region are known to it, as
+        # they would be if the whole of the code was converted.
+        self.user_defined_functions = _defined_functions(
+            document.functions[:i]
+        )
+        self.source = SourceIndex(text)
+        self.reset_conversion_stats()
+        blocks = []
+        self._tokens = []
+        self._defined = defined = []
+        try:
+            if tree.body:
+                blocks = _chain(self._traverse_top_level(tree.body))
+        finally:
+            tokens = self._tokens
+            self._tokens = None
+            self._defined = None
+        new_starts, new_regions, new_functions = _index_regions(
+            tree.body, blocks, defined, self.source, start
+        )
+        names = {name for region in new_functions for name, _ in region}
+        if names != {name for name, _ in document.functions[i]}:
+            # Calls to the functions in the regions after it may change.
+            return None
+        functions = (
+            document.functions[:i]
+            + new_functions
+            + document.functions[i + 1 :]
+        )
+        self.user_defined_functions = _defined_functions(functions)
+        following = [region_start + shift for region_start in starts[i + 1 :]]
+        if i == 0 and new_starts:
+            new_starts[0] = 0
+        elif i == 0 and following:
+            following[0] = 0
+        new_tokens = _index_tokens(tokens, self.source, start, new_starts)
+        tokens = document.get_tokens()
+        regions = document.blocks
+        next_block = None if is_last else regions[i + 1][0]
+        first_block = blocks[0] if blocks else next_block
+        if blocks:
+            _link(blocks[-1], next_block)
+        if self.ids:
+            # The ids of the other statements may change too, if they're the
+            # same as a statement in the region.
+            regions = regions[:i] + new_regions + regions[i + 1 :]
+            chain = _assign_ids(
+                [block for region in regions for block in region]
+            )
+            first_block = chain[0] if chain else None
+            blocks = iter(chain)
+            regions = [[next(blocks) for _ in region] for region in regions]
+        else:
+            before, first_block = _relink_before(regions[:i], first_block)
+            regions = before + new_regions + regions[i + 1 :]
+        result = {
+            "blocks": {
+                "blocks": [] if first_block is None else [first_block],
             },
         }
-        block["fields"] = {"op": type(node.op).__name__}
-    elif isinstance(node, ast.BoolOp):
-        # If there are two values, just use value[0] as left and value[1] as
-        # right input.
-        # If there are more than two values, use value[0] as left and create a
-        # new ast.BoolOp (with the remaining values), as the right input.
-        if len(node.values) == 2:
-            block["inputs"] = {
-                "left": {
-                    "block": traverse_node(node.values[0]),
-                },
-                "right": {
-                    "block": traverse_node(node.values[1]),
-                },
-            }
+        self.document = Document(
+            code,
+            starts[:i] + new_starts + following,
+            regions,
+            result,
+            tokens[:i] + new_tokens + tokens[i + 1 :],
+            functions,
+        )
+        return result
+
+    def _patch(self, document, offset, end, inserted_text, code):
+        """
+        Patch the field in the block for the token (see Document) that
+        contains the edit replacing document.source[offset:end] with
+        inserted_text (giving code). Return the updated Blockly JSON, or None
+        if the edit isn't within a single token, or changes its type.
+        """
+        starts = document.starts
+        if document.result is None or not starts or self.ids:
+            # The ids of the blocks depend on the whole statement.
+            return None
+        i = bisect.bisect_right(starts, offset) - 1
+        region_start = starts[i]
+        tokens = document.get_tokens()[i]
+        position = (offset - region_start, float("inf"))
+        j = bisect.bisect_right(tokens, position) - 1
+        if j < 0:
+            return None
+        token_start, token_end, block = tokens[j]
+        token_start += region_start
+        token_end += region_start
+        if end > token_end:
+            return None
+        shift = len(inserted_text) - (end - offset)
+        new_end = token_end + shift
+        block_type = block["type"]
+        fields = block["fields"]
+        old_value = fields["var"]["name"] if block_type == "Name" else None
+        if old_value is None:
+            old_value = fields["value"]
+        old_text = document.source[token_start:token_end]
+        if _token_value(block_type, old_text) != old_value:
+            # The token isn't a single token of the right type.
+            return None
+        value = _token_value(block_type, code[token_start:new_end])
+        if value is None:
+            return None
+        if block_type != "str" and not (
+            _is_token_boundary(code, token_start - 1)
+            and _is_token_boundary(code, new_end)
+        ):
+            # The token would run into the code next to it.
+            return None
+        path = _find_block(document.blocks[i], block)
+        if path is None:
+            # The block isn't in the result (a handler replaced it).
+            return None
+        # Blocks are never changed once they're in a result, since they may
+        # be shared with the statement_cache or a previous result (see
+        # diff_blocks). So the block and the blocks that contain it are
+        # copied instead, as are the top level blocks before it (to link
+        # them to the copies).
+        region = list(document.blocks[i])
+        index = path[0]
+        parent = region[index] = dict(region[index])
+        for key in path[1:]:
+            child = parent[key]
+            child = dict(child) if isinstance(child, dict) else list(child)
+            parent[key] = child
+            parent = child
+        before, first_block = _relink_before(
+            document.blocks[:i] + [region[:index]], region[index]
+        )
+        region[:index] = before.pop()
+        result = {"blocks": {"blocks": [first_block]}}
+        if block_type == "Name":
+            parent["fields"] = {"var": {"name": value}}
+        else:
+            parent["fields"] = {"value": value}
+        self.reset_conversion_stats()
+        self.user_defined_functions = _defined_functions(document.functions)
+        token = (token_start - region_start, new_end - region_start, parent)
+        tokens = tokens[:j] + [token]
+        tokens.extend(
+            (start + shift, stop + shift, other)
+            for start, stop, other in document.tokens[i][j + 1 :]
+        )
+        self.document = Document(
+            code,
+            starts[: i + 1] + [start + shift for start in starts[i + 1 :]],
+            before + [region] + document.blocks[i + 1 :],
+            result,
+            document.tokens[:i] + [tokens] + document.tokens[i + 1 :],
+            document.functions,
+        )
+        return result
+
+    def _traverse_cached_body(self, body):
+        """
+        Traverse the top level statements in the body of a module, in the
+        same way as traverse_body, but using the statement_cache.
+
+        Statements are looked up by their source code first, which is cheap.
+        If that isn't found, they're looked up by ast.dump of the statement,
+        which is slower, but means changes to a statement's whitespace or
+        comments still hit.
+
+        The blocks in the cache are shared by the results of every call to
+        traverse, so only the top level blocks (which are linked together
+        via "next") are copied.
+        """
+        cache = self.statement_cache
+        stats = self.conversion_stats
+        functions = self.user_defined_functions
+        changed = self._changed_templates()
+        if changed:
+            # Only the blocks for statements that call these functions may
+            # not be the same as the blocks that would be converted now.
+            for key, entry in list(cache.items()):
+                if not changed.isdisjoint(entry[4]):
+                    del cache[key]
+        state = self._cache_state()
+        if state != self._cached_state:
+            # The cached blocks may not be the same as the blocks that would
+            # be converted now.
+            cache.clear()
+            self._cached_state = state
+        first_block = None
+        previous_block = None
+        for node in body:
+            code = self._source_code(node)
+            keys = []
+            entry = None
+            if code is not None:
+                keys.append(("source", code))
+                entry = cache.get(keys[0])
+            if entry is None:
+                keys.append(("ast", ast.dump(node)))
+                entry = cache.get(keys[-1])
+                if entry is not None and entry[2] and entry[3] != code:
+                    # The code in its catch_all blocks has changed.
+                    entry = None
+            if entry is not None and entry[5] != self._known_functions(
+                entry[4]
+            ):
+                # Calls in the statement would be converted differently.
+                entry = None
+            if entry is not None:
+                stats["cache_hits"] += 1
+                block = entry[0]
+                for name, metadata in entry[1]:
+                    functions[name] = metadata
+                if self._function_keys is not None:
+                    self._function_keys.update(entry[4])
+            else:
+                stats["cache_misses"] += 1
+                block, entry = self._convert_statement(node, code)
+            for key in keys:
+                cache[key] = entry
+                cache.move_to_end(key)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+            if self._defined is not None:
+                self._defined.append(entry[1])
+            block = dict(block)
+            if previous_block is None:
+                first_block = block
+            else:
+                previous_block["next"] = {"block": block}
+            previous_block = block
+        stats["cache_hit_rate"] = stats["cache_hits"] / len(body)
+        return first_block
+
+    def _convert_statement(self, node, code):
+        """
+        Convert a top level statement, with the given source code, that isn't
+        in the statement_cache. Return the block and the entry to cache for
+        it.
+        """
+        stats = self.conversion_stats
+        functions = self.user_defined_functions
+        count = len(functions)
+        catch_all = stats["catch_all"]
+        self._registrations = registrations = []
+        outer_keys = self._function_keys
+        self._function_keys = function_keys = set()
+        try:
+            block = self.traverse_node(node)
+        finally:
+            self._registrations = None
+            self._function_keys = outer_keys
+        if outer_keys is not None:
+            outer_keys.update(function_keys)
+        # The functions the statement defined are the last ones added (in
+        # order) to the dict.
+        new = set(
+            itertools.islice(reversed(functions), len(functions) - count)
+        )
+        catch_all = stats["catch_all"] != catch_all
+        entry = (
+            block,
+            registrations,
+            catch_all,
+            code,
+            frozenset(function_keys),
+            self._known_functions(function_keys, new),
+        )
+        return block, entry
+
+    def _known_functions(self, function_keys, new=()):
+        """
+        Return the set of the function keys (of the calls in a top level
+        statement) that are user-defined functions, other than the new ones
+        that the statement defined itself. The block for the statement only
+        depends on the user-defined functions through these, so it can be
+        used again wherever they're the same.
+        """
+        functions = self.user_defined_functions
+        return frozenset(
+            key for key in function_keys if key in functions and key not in new
+        )
+
+    def _cache_state(self):
+        """
+        Return the state of everything (other than the statement itself and
+        the templates for the functions it calls) that the block for a top
+        level statement depends upon, other than the user-defined functions
+        (see _known_functions): the options and the node handlers.
+        """
+        return (self.flatten, tuple(NODE_HANDLERS.items()))
+
+    def _changed_templates(self):
+        """
+        Return the set of function keys whose templates (in builtin_blocks)
+        have been added, replaced (by a template with different contents) or
+        removed since the statement_cache was last checked.
+        """
+        templates = {
+            name: template_fingerprint(name, template)
+            for name, template in self.builtin_blocks.items()
+        }
+        previous = self._cached_templates
+        self._cached_templates = templates
+        if templates == previous:
+            return set()
+        return {
+            name
+            for name in templates.keys() | previous.keys()
+            if templates.get(name) != previous.get(name)
+        }
+
+    def _source_code(self, node):
+        """
+        Return the source code for the node, or None if it isn't available.
+        """
+        if self.source is None:
+            return None
+        return self.source.segment(node)
+
+    def traverse_body(self, body):
+        """
+        Traverse the body of a node in the AST and generate the Blockly JSON.
+
+        Each statement in the body becomes a block, and each block is linked
+        to the block for the following statement via its "next" attribute.
+        The chain is built in a single forward pass (without recursion or
+        slicing the body) so the cost is linear in the number of statements,
+        and very long bodies don't hit the recursion limit.
+
+        Args:
+            body (list): The list of statement nodes in the body.
+
+        Returns:
+            dict: The block for the first statement, or None if the body is
+            empty.
+        """
+        return get_engine(self.engine)(self, _convert_body(body))
+
+    def traverse_node(self, node):
+        """
+        Traverse a node in the AST and generate the Blockly JSON.
+
+        Args:
+            node (ast.AST): The node to traverse (may be None).
+
+        Returns:
+            dict: The Blockly JSON representation of the node, or None.
+        """
+        if node is None:
+            return None
+        block = _convert_node(self, node)
+        if type(block) is GeneratorType:
+            block = get_engine(self.engine)(self, block)
+        return block
+
+    def register_function(self, name, metadata):
+        """
+        Register a user-defined function, defined by the converted code, so
+        calls to it become blocks.
+
+        Args:
+            name (str): The name of the function.
+            metadata (dict): The metadata needed to generate a valid block for
+                the function.
+        """
+        self.user_defined_functions[name] = metadata
+        if self._registrations is not None:
+            self._registrations.append((name, metadata))
+
+    def register_builtin_block(self, name, template):
+        """
+        Register a new built-in function with its block template, for this
+        session only (see register_builtin_block).
+
+        Args:
+            name (str): The name of the built-in function.
+            template (dict): The template to use for this function.
+        """
+        self.builtin_blocks[name] = template
+        self.builtin_builders[name] = (template, compile_template(template))
+
+    def get_builtin_builder(self, function_key):
+        """
+        Get the builder compiled from the template in builtin_blocks for the
+        given function key, compiling it if the template hasn't been compiled
+        yet (for example, if it was added to BUILTIN_BLOCKS directly).
+
+        Args:
+            function_key (str): The key of the built-in function.
+
+        Returns:
+            callable: The builder (see compile_template).
+        """
+        template = self.builtin_blocks[function_key]
+        compiled = self.builtin_builders.get(function_key)
+        if compiled is None or compiled[0] is not template:
+            compiled = (template, compile_template(template))
+            # Only this session's builders are changed.
+            self.builtin_builders[function_key] = compiled
+        return compiled[1]
+
+    def is_builtin_function(self, function_key):
+        """
+        Check if a function key is in the built-in collection.
+
+        Args:
+            function_key (str): The function key to check.
+
+        Returns:
+            bool: True if the function is a built-in, False otherwise.
+        """
+        if self._function_keys is not None and function_key:
+            self._function_keys.add(function_key)
+        return function_key in self.builtin_blocks
+
+    def is_known_function(self, function_key):
+        """
+        Check if a function key is for a built-in or user-defined function,
+        i.e. if a call to it can be converted into a block (rather than
+        catch_all).
+
+        Args:
+            function_key (str or None): The function key to check.
+
+        Returns:
+            bool: True if the function is known, False otherwise.
+        """
+        if not function_key:
+            return False
+        if self._function_keys is not None:
+            self._function_keys.add(function_key)
+        return (
+            function_key in self.builtin_blocks
+            or function_key in self.user_defined_functions
+        )
+
+    def will_catch_all(self, node):
+        """
+        Check if a node will become a catch_all block when it is converted.
+        This is a cheap check that doesn't convert (or even look at) any
+        child nodes.
+
+        Args:
+            node (ast.AST): The node to check.
+
+        Returns:
+            bool: True if the node will become a catch_all block.
+        """
+        handler = NODE_HANDLERS.get(type(node))
+        if handler is None:
+            return True
+        elif handler is _handle_call:
+            return not self.is_known_function(get_function_key(node))
+        return False
+
+
+class Document:
+    """
+    Source code converted by a session, indexed so the code can be edited
+    and converted again incrementally (see Converter.edit).
+
+    The top level statements are grouped into regions. A region starts at
+    the beginning of the line on which a statement starts (or at the
+    beginning of the source code, for the first region), and ends where the
+    next region starts, so it includes any blank lines and comments after
+    the statement. Statements on the same line are in the same region.
+
+    The tokens in each region are the numbers, strings and names (in the
+    source code of Constant and Name nodes) whose blocks have a field that
+    can be patched with a new value, without converting the region again.
+    Only int, float and str constants, written as a single token (strings
+    without any quotes, backslashes or line breaks inside them), are
+    included.
+
+    The functions in each region are the user-defined functions that its
+    statements define, so a region can be converted again knowing only the
+    functions defined before it.
+    """
+
+    def __init__(
+        self,
+        source,
+        starts=None,
+        blocks=None,
+        result=None,
+        tokens=None,
+        functions=None,
+    ):
+        """
+        Index the given source code.
+
+        Args:
+            source (str): The source code.
+            starts (list): The offset at which each region starts.
+            blocks (list): A list of the top level blocks for the statements
+                in each region.
+            result (dict): The Blockly JSON for the source code, or None if
+                it hasn't been (or couldn't be) converted.
+            tokens (list or callable): A list of the tokens in each region,
+                as (start, end, block) tuples sorted by start, where start
+                and end are offsets from the start of the region, or a
+                function that returns the list when it's first needed (see
+                get_tokens).
+            functions (list): A list of the (name, metadata) of the
+                user-defined functions defined in each region (see
+                Converter.register_function), in order.
+        """
+        self.source = source
+        self.starts = starts or []
+        self.blocks = blocks or []
+        self.result = result
+        self.tokens = tokens
+        self.functions = functions or []
+
+    def get_tokens(self):
+        """
+        Return the list of the tokens in each region, indexing them if they
+        haven't been yet. Most documents are never edited, so they're only
+        indexed when they are.
+        """
+        if self.tokens is None:
+            self.tokens = [[] for _ in self.blocks]
+        elif callable(self.tokens):
+            self.tokens = self.tokens()
+        return self.tokens
+
+
+def _index_document(source, body, source_index, result, tokens, defined):
+    """
+    Return the Document for the source code, given the top level statements
+    in its body, the SourceIndex for the source code, the Blockly JSON it
+    was converted to and the tokens and functions recorded while converting
+    it (see Converter._tokens and Converter._defined).
+    """
+    top_level = result["blocks"]["blocks"]
+    blocks = _chain(top_level[0]) if top_level else []
+    if len(blocks) != len(body):
+        # A handler didn't return a block for every statement.
+        return Document(source)
+    starts, regions, functions = _index_regions(
+        body, blocks, defined, source_index, 0
+    )
+    if starts:
+        starts[0] = 0
+    return Document(
+        source,
+        starts,
+        regions,
+        result,
+        lambda: _index_tokens(tokens, source_index, 0, starts),
+        functions,
+    )
+
+
+def _index_regions(body, blocks, defined, source_index, offset):
+    """
+    Group the top level statements in the body, their blocks and the
+    functions they define (see Converter._defined) into regions (see
+    Document). Return the offset at which each region starts (in the source
+    code indexed by source_index, plus the given offset), a list of the
+    blocks in each region and a list of the functions defined in each
+    region.
+    """
+    starts = []
+    regions = []
+    functions = []
+    line = None
+    for node, block, registrations in zip(body, blocks, defined):
+        lineno = node.lineno
+        if getattr(node, "decorator_list", None):
+            lineno = node.decorator_list[0].lineno
+        if lineno != line:
+            starts.append(offset + source_index.line_starts[lineno - 1])
+            regions.append([])
+            functions.append([])
+            line = lineno
+        regions[-1].append(block)
+        functions[-1].extend(registrations)
+    return starts, regions, functions
+
+
+def _defined_functions(functions):
+    """
+    Return the user-defined functions, keyed by name, defined by the
+    regions with the given functions (see Document), in order.
+    """
+    return {
+        name: metadata for region in functions for name, metadata in region
+    }
+
+
+def _index_tokens(tokens, source_index, offset, starts):
+    """
+    Group the tokens recorded while converting the source code indexed by
+    source_index (see Converter._tokens, in which a node may be None if its
+    block can't be patched) into the regions that start at the given starts
+    (see _index_regions, and Document). They're only checked
+    to be a single token of the right type (see _token_value) when they're
+    edited.
+    """
+    positions = []
+    for node, block in zip(tokens[::2], tokens[1::2]):
+        if node is not None and node.lineno == node.end_lineno:
+            start = source_index.offset(node.lineno, node.col_offset)
+            end = start + node.end_col_offset - node.col_offset
+            if not source_index.is_ascii:
+                end = source_index.offset(node.end_lineno, node.end_col_offset)
+            positions.append((start + offset, end + offset, block))
+    # The tokens were mostly recorded in order, so this is quick.
+    positions.sort(key=lambda token: token[0])
+    regions = [[] for _ in starts]
+    i = 0
+    for start, end, block in positions:
+        while i + 1 < len(starts) and starts[i + 1] <= start:
+            i += 1
+        if start >= starts[0]:
+            regions[i].append((start - starts[i], end - starts[i], block))
+    return regions
+
+
+def _token_value(block_type, text):
+    """
+    Return the value of the field for a block of the given type (Name, int,
+    float or str) that text (the source code of a single token) converts
+    into, or None if text isn't that type of token (see Document).
+    """
+    if block_type == "Name":
+        if (
+            text.isascii()
+            and text.isidentifier()
+            and not keyword.iskeyword(text)
+            and not (keyword.issoftkeyword(text) and text != "_")
+        ):
+            return text
+    elif block_type == "int":
+        if re.fullmatch(tokenize.Intnumber, text):
+            try:
+                return int(text, 0)
+            except ValueError:
+                # For example, 0_7.
+                return None
+    elif block_type == "float":
+        if re.fullmatch(tokenize.Floatnumber, text):
+            return float(text)
+    elif block_type == "str":
+        body = text.lstrip("rRuU")
+        if (
+            len(text) - len(body) <= 1
+            and len(body) >= 2
+            and body[0] in "'\""
+            and body[-1] == body[0]
+            and not any(char in "'\"\\\r\n" for char in body[1:-1])
+        ):
+            return body[1:-1]
+    return None
+
+
+def _is_token_boundary(code, index):
+    """
+    Check that the character at the index into the code (if any) can't be
+    part of a number or name next to it.
+    """
+    if not 0 <= index < len(code):
+        return True
+    char = code[index]
+    return char.isascii() and not (char.isalnum() or char in "_.'\"")
+
+
+def _find_block(blocks, block):
+    """
+    Return the path to the block from one of the given top level blocks (not
+    following their "next"), as a list of the index of the top level block
+    followed by the key (or index) of each dict (or list) on the way, or
+    None if the block isn't found.
+    """
+    for index, top_level in enumerate(blocks):
+        stack = [(top_level, [index])]
+        while stack:
+            value, path = stack.pop()
+            if value is block:
+                return path
+            if isinstance(value, dict):
+                items = value.items()
+            elif isinstance(value, list):
+                items = enumerate(value)
+            else:
+                continue
+            for key, item in items:
+                if isinstance(item, (dict, list)) and not (
+                    value is top_level and key == "next"
+                ):
+                    stack.append((item, path + [key]))
+    return None
+
+
+def _assign_ids(blocks):
+    """
+    Give each of the given top level blocks (and the blocks in their inputs)
+    an id, and return a list of the blocks, linked via "next". The blocks
+    are copied, rather than changed, since they may be in a previous result.
+
+    The id of a top level block is a hash of its contents, followed by the
+    number of the same blocks before it (so two statements that are the same
+    have different ids), such as "4f2a0c9be1d7-0". The id of a block within
+    it is the id of the top level block, followed by the position of the
+    block within it, such as "4f2a0c9be1d7-0.3". So the ids in a statement
+    only change if the statement changes (or a statement that's the same as
+    it is added or removed before it).
+    """
+    counts = {}
+    chain = [_assign_id(block, counts) for block in blocks]
+    _relink(chain)
+    return chain
+
+
+def _assign_id(block, counts):
+    """
+    Return the top level block with its id (see _assign_ids), given the
+    counts of the top level blocks before it, keyed by the hash of their
+    contents (which are updated).
+    """
+    block_id = block.get("id")
+    if block_id is None:
+        digest = _digest(block)
+    else:
+        # The block was given its id by a previous call, so its contents are
+        # the same.
+        digest = block_id.partition("-")[0]
+    count = counts.get(digest, 0)
+    counts[digest] = count + 1
+    new_id = f"{digest}-{count}"
+    if block_id != new_id:
+        return _with_ids(block, new_id)
+    return dict(block)
+
+
+def _digest(block):
+    """
+    Return a short hash of the contents of a top level block (without its
+    "next").
+    """
+    block = {key: value for key, value in block.items() if key != "next"}
+    data = _dumps(block, default=repr).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=6).hexdigest()
+
+
+def _with_ids(block, block_id):
+    """
+    Return a copy of the top level block (without its "next") and of the
+    blocks in its inputs, with the given id, and the ids of the blocks in
+    its inputs numbered after it (see _assign_ids).
+    """
+    top_level = _with_id(block, block_id)
+    top_level.pop("next", None)
+    number = 0
+    stack = [top_level]
+    while stack:
+        block = stack.pop()
+        inputs = block.get("inputs")
+        if not inputs:
+            continue
+        block["inputs"] = inputs = dict(inputs)
+        for name, slot in inputs.items():
+            if not _is_slot(slot) or slot.get("block") is None:
+                continue
+            # Copy the chain of blocks in the input.
+            holder = inputs[name] = dict(slot)
+            while holder is not None:
+                number += 1
+                child = _with_id(holder["block"], f"{block_id}.{number}")
+                holder["block"] = child
+                stack.append(child)
+                holder = child.get("next")
+                if holder is not None:
+                    holder = child["next"] = dict(holder)
+    return top_level
+
+
+def _with_id(block, block_id):
+    """
+    Return a (shallow) copy of the block, with the given id after its type.
+    """
+    copy = {"type": block["type"], "id": block_id}
+    copy.update(block)
+    copy["id"] = block_id
+    return copy
+
+
+def _chain(block):
+    """
+    Return a list of the given block and the blocks that follow it, via
+    "next".
+    """
+    blocks = []
+    while block is not None:
+        blocks.append(block)
+        block = block.get("next", {}).get("block")
+    return blocks
+
+
+def _relink_before(regions, first_block):
+    """
+    Return copies of the top level blocks in the regions (lists of blocks)
+    linked, via "next", to each other and then to the first block (which may
+    be None), and the first of them (or the first block, if there are none).
+    So the blocks in a previous result aren't changed.
+    """
+    copies = []
+    for region in reversed(regions):
+        region = [dict(block) for block in region]
+        for block in reversed(region):
+            _link(block, first_block)
+            first_block = block
+        copies.append(region)
+    copies.reverse()
+    return copies, first_block
+
+
+def _link(block, next_block):
+    """
+    Link the block to the next block via "next" (or unlink it, if the next
+    block is None).
+    """
+    if next_block is None:
+        block.pop("next", None)
+    else:
+        block["next"] = {"block": next_block}
+
+
+def diff_blocks(old, new):
+    """
+    Return a patch that changes the Blockly JSON old into new, so a client
+    can update its workspace with just the blocks that changed, rather than
+    loading every block again.
+
+    Blocks are matched by comparing the chains of blocks (linked via "next")
+    at the top level, and in each input, of old and new. The blocks at the
+    start and end of each chain that are the same are skipped over (blocks
+    that are the same object are assumed to be the same, which is always
+    true for the results from a session, see Converter.convert). Of the
+    rest, blocks that are the same in old and new are kept (or moved), and
+    blocks of the same shape (the same type, and the same inputs) are
+    changed. Any other blocks are removed or inserted. See apply_patch for
+    the operations in the patch.
+
+    Args:
+        old (dict): The Blockly JSON to change.
+        new (dict): The Blockly JSON it should become.
+
+    Returns:
+        list: The operations in the patch.
+    """
+    return _diff_stacks(_stacks(old), _stacks(new))
+
+
+def apply_patch(result, patch):
+    """
+    Apply a patch (see diff_blocks) to the Blockly JSON result, in place.
+    This is the reference for how a client applies a patch to its
+    workspace.
+
+    Each operation in the patch is a dict with an "op" and the path of a
+    block. A path is a list of the index of a stack of blocks (at the top
+    level), the index of the block in that stack, and then the name of an
+    input of that block and the index of a block in that input (counting
+    along "next"), and so on, down to the block. Operations are applied in
+    order, so each path is for the blocks as they are after the previous
+    operations. The operations are:
+
+    * {"op": "remove", "path": path} - remove the block (and the blocks in
+      its inputs). The following block (via "next") takes its place.
+    * {"op": "insert", "path": path, "block": block} - insert the block
+      (with the blocks in its inputs, but without a "next") at the path, in
+      front of the block already there, if any. A stack is added if the
+      index of the stack is the number of stacks.
+    * {"op": "move", "from": path, "to": path} - remove the block at the
+      from path (as for remove), and insert it at the to path (as for
+      insert). Both paths are in the same stack or input.
+    * {"op": "change", "path": path, "fields": fields, "extraState": state}
+      - replace the fields and/or the extraState (whichever are given) of
+      the block. The change also has an "id" if the block's id changed (see
+      Converter).
+
+    Stacks left without any blocks are removed, after applying the patch.
+
+    Args:
+        result (dict): The Blockly JSON to change.
+        patch (list): The operations in the patch.
+
+    Returns:
+        dict: The changed Blockly JSON (the same dict as result).
+    """
+    stacks = result["blocks"]["blocks"]
+    for operation in patch:
+        op = operation["op"]
+        if op == "change":
+            path = operation["path"]
+            chain, _ = _locate_chain(stacks, path[:-1])
+            block = chain[path[-1]]
+            for key in _CHANGEABLE:
+                if key in operation:
+                    block[key] = operation[key]
+        elif op == "remove":
+            path = operation["path"]
+            chain, relink = _locate_chain(stacks, path[:-1])
+            del chain[path[-1]]
+            relink(chain)
+        elif op == "insert":
+            path = operation["path"]
+            chain, relink = _locate_chain(stacks, path[:-1])
+            chain.insert(path[-1], operation["block"])
+            relink(chain)
+        elif op == "move":
+            source, target = operation["from"], operation["to"]
+            chain, relink = _locate_chain(stacks, source[:-1])
+            block = chain.pop(source[-1])
+            chain.insert(target[-1], block)
+            relink(chain)
+        else:
+            raise ValueError(f"Unknown patch operation: {op}")
+    stacks[:] = [stack for stack in stacks if stack is not None]
+    return result
+
+
+def _stacks(result):
+    """
+    Return a list of the chain of blocks (see _chain) in each stack of the
+    Blockly JSON result.
+    """
+    return [_chain(block) for block in result["blocks"]["blocks"]]
+
+
+def _locate_chain(stacks, path):
+    """
+    Return the chain of blocks (see _chain) for the stack, or the input of a
+    block, at the path (see apply_patch), and a function that links a
+    changed list of blocks back into place as the chain.
+    """
+    if len(path) == 1:
+        index = path[0]
+        if index == len(stacks):
+            stacks.append(None)
+        chain = _chain(stacks[index])
+
+        def relink(chain):
+            _relink(chain)
+            stacks[index] = chain[0] if chain else None
+
+    else:
+        chain, _ = _locate_chain(stacks, path[:-2])
+        slot = chain[path[-2]]["inputs"][path[-1]]
+        chain = _chain(slot.get("block"))
+
+        def relink(chain):
+            _relink(chain)
+            slot["block"] = chain[0] if chain else None
+
+    return chain, relink
+
+
+# The keys of a block that a "change" operation in a patch can replace.
+_CHANGEABLE = ("id", "fields", "extraState")
+
+
+def _relink(chain):
+    """
+    Link each block in the list to the next one, via "next".
+    """
+    for block, next_block in zip(chain, chain[1:] + [None]):
+        _link(block, next_block)
+
+
+def _diff_stacks(old_stacks, new_stacks):
+    """
+    Return the patch (see diff_blocks) that changes the old stacks (lists of
+    the chains of blocks at the top level) into the new stacks.
+    """
+    patch = []
+    for index in range(max(len(old_stacks), len(new_stacks))):
+        old_chain = old_stacks[index] if index < len(old_stacks) else []
+        new_chain = new_stacks[index] if index < len(new_stacks) else []
+        _diff_chain(old_chain, new_chain, [index], patch)
+    return patch
+
+
+def _diff_chain(old, new, path, patch):
+    """
+    Add the operations that change the old chain of blocks (at the path to
+    the stack or input) into the new chain to the patch.
+    """
+    start = 0
+    while (
+        start < len(old)
+        and start < len(new)
+        and _same_block(old[start], new[start])
+    ):
+        start += 1
+    old_end = len(old)
+    new_end = len(new)
+    while (
+        old_end > start
+        and new_end > start
+        and _same_block(old[old_end - 1], new[new_end - 1])
+    ):
+        old_end -= 1
+        new_end -= 1
+    old = old[start:old_end]
+    new = new[start:new_end]
+    if not old and not new:
+        return
+    # Old blocks matched to new blocks that are in the same order, and old
+    # blocks that are moved to new blocks, keyed by the old block's index.
+    kept = {}
+    moved = {}
+    if len(old) == 1 and len(new) == 1:
+        # The most common case, which doesn't need the keys.
+        if _same_shape(old[0], new[0]):
+            kept[0] = 0
+    else:
+        old_keys = [_block_key(block) for block in old]
+        new_keys = [_block_key(block) for block in new]
+        matcher = difflib.SequenceMatcher(
+            None, old_keys, new_keys, autojunk=False
+        )
+        gaps = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                for i in range(i1, i2):
+                    kept[i] = j1 + i - i1
+            else:
+                gaps.append((range(i1, i2), range(j1, j2)))
+        # Blocks that are the same, but elsewhere, are moved.
+        unmatched = {}
+        for _, new_range in gaps:
+            for j in new_range:
+                unmatched.setdefault(new_keys[j], []).append(j)
+        for old_range, _ in gaps:
+            for i in old_range:
+                if unmatched.get(old_keys[i]):
+                    moved[i] = unmatched[old_keys[i]].pop(0)
+        # The rest are changed, if they're the same shape.
+        targets = set(moved.values())
+        for old_range, new_range in gaps:
+            olds = [i for i in old_range if i not in moved]
+            news = [j for j in new_range if j not in targets]
+            for i, j in zip(olds, news):
+                if _same_shape(old[i], new[j]):
+                    kept[i] = j
+    # Simulate the chain, as a list of the indexes of the old blocks (or
+    # None for a new block), to find the index of each operation.
+    current = list(range(len(old)))
+    for i in range(len(old)):
+        if i not in kept and i not in moved:
+            index = current.index(i)
+            patch.append({"op": "remove", "path": path + [start + index]})
+            del current[index]
+    if moved:
+        # Move each block to just after the block that comes before it in
+        # new (of those that are kept or moved), in the order of new.
+        matched = {j: i for i, j in kept.items()}
+        matched.update((j, i) for i, j in moved.items())
+        previous = None
+        for j in sorted(matched):
+            i = matched[j]
+            if i in moved:
+                source = current.index(i)
+                del current[source]
+                target = 0 if previous is None else current.index(previous) + 1
+                current.insert(target, i)
+                if source != target:
+                    patch.append(
+                        {
+                            "op": "move",
+                            "from": path + [start + source],
+                            "to": path + [start + target],
+                        }
+                    )
+            previous = i
+    new_blocks = set(range(len(new))) - set(kept.values())
+    new_blocks -= set(moved.values())
+    for j in sorted(new_blocks):
+        block = {key: value for key, value in new[j].items() if key != "next"}
+        patch.append(
+            {"op": "insert", "path": path + [start + j], "block": block}
+        )
+    for i, j in sorted(kept.items(), key=lambda item: item[1]):
+        if not _same_block(old[i], new[j]):
+            _diff_block(old[i], new[j], path + [start + j], patch)
+
+
+def _diff_block(old, new, path, patch):
+    """
+    Add the operations that change the old block (at the path) into the new
+    block, of the same shape (see _same_shape), to the patch.
+    """
+    change = {}
+    for key in _CHANGEABLE:
+        if key in new and old[key] != new[key]:
+            change[key] = new[key]
+    if change:
+        patch.append({"op": "change", "path": path, **change})
+    for name, slot in new.get("inputs", {}).items():
+        if _is_slot(slot):
+            _diff_chain(
+                _chain(old["inputs"][name].get("block")),
+                _chain(slot.get("block")),
+                path + [name],
+                patch,
+            )
+
+
+def _same_block(a, b):
+    """
+    Check if two blocks are the same, not counting "next".
+    """
+    if a is b:
+        return True
+    for key, value in a.items():
+        if key != "next" and (key not in b or b[key] != value):
+            return False
+    return all(key == "next" or key in a for key in b)
+
+
+def _same_shape(a, b):
+    """
+    Check if two blocks are the same shape: the same, apart from the blocks
+    in their inputs (which may be different), their id, fields and
+    extraState (which may have different values).
+    """
+    if a["type"] != b["type"]:
+        return False
+    keys = [key for key in a if key != "next"]
+    if keys != [key for key in b if key != "next"]:
+        return False
+    for key in keys:
+        if key == "inputs":
+            inputs = b["inputs"]
+            if list(a["inputs"]) != list(inputs):
+                return False
+            for name, slot in a["inputs"].items():
+                other = inputs[name]
+                if not (_is_slot(slot) and _is_slot(other)):
+                    if slot != other:
+                        return False
+                elif list(slot) != list(other) or any(
+                    slot_key != "block" and other[slot_key] != value
+                    for slot_key, value in slot.items()
+                ):
+                    return False
+        elif key not in _CHANGEABLE and a[key] != b[key]:
+            return False
+    return True
+
+
+def _is_slot(value):
+    """
+    Check if the value of an input is a slot for a chain of blocks (a dict
+    with the first block in "block"), rather than a block or None.
+    """
+    return isinstance(value, dict) and "type" not in value
+
+
+def _block_key(block):
+    """
+    Return a key for the block, not counting "next", that's the same for
+    blocks that are the same.
+    """
+    block = {key: value for key, value in block.items() if key != "next"}
+    return _dumps(block, default=repr)
+
+
+def _convert_body(body):
+    """
+    Convert the body of a node. This is a generator in the same way as a node
+    handler (see register_node_handler). The return value is the block for
+    the first statement in the body, with the rest of the statements chained
+    together via "next".
+    """
+    first_block = None
+    previous_block = None
+    for node in body:
+        block = yield node
+        if previous_block is None:
+            # The first block in the body. It's the head of the chain.
+            first_block = block
+        else:
+            previous_block["next"] = {"block": block}
+        previous_block = block
+    return first_block
+
+
+def _recursive_engine(converter, steps):
+    """
+    Drive the steps generator (from a node handler) by recursively converting
+    each child node as it is requested.
+
+    This is the reference engine. It is simple and fast, but the depth of the
+    AST it can handle is limited by Python's recursion limit.
+    """
+    stats = converter.conversion_stats
+    nodes = stats["nodes"]
+    wasted = stats["wasted_visits"]
+    child = None
+    try:
+        child = steps.send(None)
+        while True:
+            if child is not None:
+                child = _convert_node(converter, child)
+                if type(child) is GeneratorType:
+                    child = _recursive_engine(converter, child)
+            child = steps.send(child)
+    except StopIteration as stop:
+        block = stop.value
+        if _is_new_catch_all(block, child):
+            _record_wasted_visits(stats, nodes, wasted)
+        return block
+
+
+def _stack_engine(converter, steps):
+    """
+    Drive the steps generator (from a node handler) via an explicit work stack
+    of pending generators, rather than Python recursion.
+
+    The output is identical to that of the recursive engine, but there is no
+    limit to the depth of the AST it can handle.
+    """
+    stats = converter.conversion_stats
+    stack = [steps]
+    # The conversion stats when each generator in the stack was started.
+    starts = [(stats["nodes"], stats["wasted_visits"])]
+    value = None
+    while stack:
+        try:
+            child = stack[-1].send(value)
+        except StopIteration as stop:
+            # The generator at the top of the stack has finished, so its
+            # block is the value to send to the generator beneath it.
+            stack.pop()
+            nodes, wasted = starts.pop()
+            if _is_new_catch_all(stop.value, value):
+                _record_wasted_visits(stats, nodes, wasted)
+            value = stop.value
+            continue
+        value = None if child is None else _convert_node(converter, child)
+        if type(value) is GeneratorType:
+            # The child's handler needs the blocks for its own children.
+            stack.append(value)
+            starts.append((stats["nodes"], stats["wasted_visits"]))
+            value = None
+    return value
+
+
+def _is_new_catch_all(block, child_block):
+    """
+    Check if the block returned by a handler is a catch_all block, other than
+    one for a child node that the handler just passed through (as for
+    ast.Expr nodes).
+    """
+    return (
+        block is not child_block
+        and block is not None
+        and block.get("type") == "catch_all"
+    )
+
+
+def _record_wasted_visits(stats, nodes, wasted):
+    """
+    A handler has fallen back to a catch_all block after converting child
+    nodes, so the visits to those nodes were wasted. Given the "nodes" and
+    "wasted_visits" counts when the handler started, record the visits since
+    then as wasted (including any already recorded as wasted) in stats.
+    """
+    stats["wasted_visits"] = wasted + stats["nodes"] - nodes
+
+
+# The available traversal engines, keyed by name. An engine is called with
+# the Converter and the steps generator to drive.
+ENGINES = {
+    "recursive": _recursive_engine,
+    "stack": _stack_engine,
+}
+
+
+def get_engine(name):
+    """
+    Get the traversal engine with the given name.
+
+    Args:
+        name (str): The name of the engine (a key in ENGINES).
+
+    Returns:
+        callable: The engine.
+    """
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise ValueError(f"Unknown traversal engine: {name}")
+
+
+def register_builtin_block(name, template):
+    """
+    Register a new built-in function with its block template, for all
+    conversions (use Converter.register_builtin_block for a single session).
+
+    Args:
+        name (str): The name of the built-in function (e.g., 'print' or 'invent.publish').
+        template (dict): The template to use for this function.
+    """
+    BUILTIN_BLOCKS[name] = template
+    BUILTIN_BUILDERS[name] = (template, compile_template(template))
+    template_fingerprint(name, template)
+
+
+def template_fingerprint(name, template):
+    """
+    Return the fingerprint of the template for the named built-in function:
+    a hash of the name and the template's contents. Templates with the same
+    contents have the same fingerprint, even if they are different objects
+    (for example, if a pack of templates is loaded again).
+
+    The fingerprint is remembered (see TEMPLATE_FINGERPRINTS) until the
+    template for the name is replaced, so it's cheap to get again. If you
+    change a template, register it again.
+
+    Args:
+        name (str): The name of the built-in function.
+        template (dict): The template for the function.
+
+    Returns:
+        str: The fingerprint.
+    """
+    entry = _template_fingerprint(name, template)
+    return entry[1]
+
+
+def builtin_fingerprint(templates=None):
+    """
+    Return the fingerprint of a collection of templates (BUILTIN_BLOCKS, by
+    default): a combination of the fingerprint of each template (see
+    template_fingerprint), which only depends on the names and contents of
+    the templates, not on the order they were registered in. Only the
+    templates that were added or replaced since the last call are hashed.
+
+    Args:
+        templates (dict): The templates, keyed by function name.
+
+    Returns:
+        str: The fingerprint.
+    """
+    if templates is None:
+        templates = BUILTIN_BLOCKS
+    bits = 0
+    for name, template in templates.items():
+        bits ^= _template_fingerprint(name, template)[2]
+    return f"{bits:032x}"
+
+
+def _template_fingerprint(name, template):
+    """
+    Return the (template, fingerprint, bits) entry in TEMPLATE_FINGERPRINTS
+    for the template, where bits is the fingerprint as an int, adding it if
+    the template for the name was replaced (or not fingerprinted yet).
+    """
+    entry = TEMPLATE_FINGERPRINTS.get(name)
+    if entry is None or entry[0] is not template:
+        data = json.dumps([name, template], sort_keys=True, default=repr)
+        digest = hashlib.blake2b(data.encode("utf-8"), digest_size=16)
+        fingerprint = digest.hexdigest()
+        entry = (template, fingerprint, int(fingerprint, 16))
+        TEMPLATE_FINGERPRINTS[name] = entry
+    return entry
+
+
+def register_node_handler(ast_type, handler):
+    """
+    Register a handler to convert nodes of the given (exact) type in the AST,
+    replacing any existing handler for that type.
+
+    The handler is called with the Converter (the conversion session), the
+    node and a new block (containing just the node's type) to fill in. It
+    either returns the finished block, or is a generator that yields the
+    child nodes whose blocks it needs (each yield evaluates to the child's
+    block) and returns the finished block.
+
+    Handlers are shared by all conversions, so should only be registered
+    before converting any code.
+
+    Args:
+        ast_type (type): The class of AST node (e.g. ast.For) to handle.
+        handler (callable): The handler for nodes of this type.
+
+    Returns:
+        callable or None: The previous handler for this type (so it can be
+        delegated to), or None if there wasn't one.
+    """
+    previous = NODE_HANDLERS.get(ast_type)
+    NODE_HANDLERS[ast_type] = handler
+    return previous
+
+
+def get_function_key(node):
+    """
+    Get the function key for the BUILTIN_BLOCKS dictionary.
+    For module.function calls, combines the module and function name.
+
+    Args:
+        node (ast.Call): The function call node.
+
+    Returns:
+        str or None: The function key or None if it's not a simple name or attribute.
+    """
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    elif isinstance(node.func, ast.Attribute) and isinstance(
+        node.func.value, ast.Name
+    ):
+        # Handle module.function style calls (e.g., invent.subscribe)
+        return f"{node.func.value.id}.{node.func.attr}"
+    return None
+
+
+def extract_constant_value(arg_block):
+    """
+    Extract a constant value from an argument block if possible.
+
+    Args:
+        arg_block (dict): The block representing an argument.
+
+    Returns:
+        Any: The constant value if it can be extracted, otherwise None.
+    """
+    # Check if the block is a constant type
+    if (
+        arg_block
+        and "type" in arg_block
+        and "fields" in arg_block
+        and "value" in arg_block["fields"]
+    ):
+        # Basic types: int, float, str, bool, etc.
+        return arg_block["fields"]["value"]
+    return None
+
+
+def get_function_name(node):
+    """
+    Get a simple representation of the function name for function_call blocks.
+
+    Args:
+        node (ast.Call): The call node.
+
+    Returns:
+        str or None: A string representation of the function name if simple, None if complex.
+    """
+    if isinstance(node.func, ast.Name):
+        # Simple function name
+        return node.func.id
+    elif isinstance(node.func, ast.Attribute) and isinstance(
+        node.func.value, ast.Name
+    ):
+        # Module.function style
+        return f"{node.func.value.id}.{node.func.attr}"
+    return None
+
+
+def catch_all(converter, node, block):
+    """
+    If the node is not supported, we need to provide enough context for a
+    catch-all block that just contains arbitrary code.
+
+    The code is the node's original source code (with its formatting and
+    comments), if available. Otherwise (for example, if the node was created
+    by a handler rather than parsed) the code is regenerated from the node.
+    """
+    converter.conversion_stats["catch_all"] += 1
+    source = converter.source
+    code = source.segment(node) if source is not None else None
+    if code is None:
+        code = ast.unparse(node)
+    block["type"] = "catch_all"
+    block["fields"] = {"code": code}
+    return block
+
+
+class SourceIndex:
+    """
+    An index of the offsets at which each line in some source code starts, so
+    the source code for a node in the AST can be extracted in time
+    proportional to the length of the node's source code.
+    """
+
+    # Line breaks, as understood by Python's tokenizer.
+    LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+    def __init__(self, source):
+        """
+        Index the given source code.
+        """
+        self.source = source
+        self.line_starts = [0]
+        self.line_starts.extend(
+            match.end() for match in self.LINE_BREAK.finditer(source)
+        )
+        # Column offsets in the AST count UTF-8 bytes, which are the same as
+        # characters for ASCII source code.
+        self.is_ascii = source.isascii()
+
+    def offset(self, lineno, col_offset):
+        """
+        Return the offset into the source code of the given line number and
+        (UTF-8 byte) column offset.
+        """
+        line_start = self.line_starts[lineno - 1]
+        if self.is_ascii:
+            return line_start + col_offset
+        line = self.source[line_start : line_start + col_offset]
+        # There are at least as many bytes as characters, so the column is
+        # somewhere in line.
+        return line_start + len(
+            line.encode("utf-8")[:col_offset].decode("utf-8", "ignore")
+        )
+
+    def segment(self, node):
+        """
+        Return the source code for the given node, or None if the node has no
+        position in the source code.
+
+        Lines after the first are dedented by the indentation of the line on
+        which the node starts (other than lines that start inside a string,
+        whose leading whitespace is part of the string), and line breaks are
+        normalised to newlines.
+        """
+        try:
+            lineno = node.lineno
+            col_offset = node.col_offset
+            end_lineno = node.end_lineno
+            end_col_offset = node.end_col_offset
+        except AttributeError:
+            return None
+        if end_lineno is None or end_col_offset is None:
+            return None
+        if getattr(node, "decorator_list", None):
+            # Decorators come before the node, at the same indentation.
+            lineno = node.decorator_list[0].lineno
+        start = self.offset(lineno, col_offset)
+        end = self.offset(end_lineno, end_col_offset)
+        code = self.source[start:end]
+        if lineno == end_lineno:
+            return code
+        lines = self.LINE_BREAK.split(code)
+        first_line = self.source[self.line_starts[lineno - 1] : start]
+        indent = first_line[: len(first_line) - len(first_line.lstrip())]
+        if "'" in code or '"' in code:
+            in_strings = self._string_lines(lineno, end)
+        else:
+            in_strings = ()
+        for i in range(1, len(lines)):
+            line = lines[i]
+            if in_strings is None or lineno + i in in_strings:
+                continue
+            if line.startswith(indent):
+                lines[i] = line[len(indent) :]
+            else:
+                lines[i] = line.lstrip(" \t")
+        return "\n".join(lines)
+
+    def _string_lines(self, lineno, end):
+        """
+        Return the numbers of the lines, after the given line number and up
+        to the given offset into the source code, that start inside a string
+        (including an f-string), or None if the source code can't be
+        tokenized.
+        """
+        base = self.line_starts[lineno - 1]
+        text = self.source[base:end]
+        starts = [
+            line_start - base
+            for line_start in self.line_starts[lineno - 1 :]
+            if line_start - base < len(text)
+        ]
+        lines = iter(
+            text[line_start:line_end]
+            for line_start, line_end in zip(starts, starts[1:] + [len(text)])
+        )
+        result = set()
+        # The depth of the f-strings the tokens are in (since Python 3.12,
+        # an f-string is several tokens), and the row the outermost started.
+        depth = 0
+        start_row = None
+        try:
+            for token in tokenize.generate_tokens(lambda: next(lines, "")):
+                name = tokenize.tok_name[token.type]
+                if name in ("FSTRING_START", "TSTRING_START"):
+                    if not depth:
+                        start_row = token.start[0]
+                    depth += 1
+                    continue
+                if name in ("FSTRING_END", "TSTRING_END"):
+                    depth -= 1
+                elif depth or token.type != tokenize.STRING:
+                    continue
+                else:
+                    start_row = token.start[0]
+                if not depth:
+                    # Tokens' rows count from the line number.
+                    result.update(
+                        range(lineno + start_row, lineno + token.end[0])
+                    )
+        except (tokenize.TokenError, SyntaxError):
+            return None
+        return result
+
+
+def apply_template(template, arg_blocks, kwarg_blocks):
+    """
+    Apply arguments to a template following a consistent pattern.
+    This function makes a deep copy of the template and fills in placeholders.
+
+    Args:
+        template (dict): The template to fill.
+        arg_blocks (list): List of blocks for positional arguments.
+        kwarg_blocks (list): List of (name, block) tuples for keyword arguments.
+
+    Returns:
+        dict: A new block with the arguments applied to the template.
+    """
+    # Create a deep copy of the template to avoid modifying the original
+    result = copy.deepcopy(template)
+
+    # First, handle field mappings if present
+    if "field_mapping" in result:
+        field_mappings = result["field_mapping"]
+
+        # Create a dictionary of keyword arguments for easier lookup
+        kwarg_dict = {name: block for name, block in kwarg_blocks}
+
+        # Apply field mappings
+        for field_name, mapping in field_mappings.items():
+            # Check if we need to map from a positional argument
+            if "arg_index" in mapping and mapping["arg_index"] < len(
+                arg_blocks
+            ):
+                arg_index = mapping["arg_index"]
+                value = extract_constant_value(arg_blocks[arg_index])
+
+                # If we successfully extracted a value, apply it to the field
+                if value is not None:
+                    # Apply the extracted value to the field
+                    if "fields" in result:
+                        result["fields"][field_name] = value
+
+            # Check if we need to map from a keyword argument
+            elif (
+                "kwarg_name" in mapping and mapping["kwarg_name"] in kwarg_dict
+            ):
+                kwarg_name = mapping["kwarg_name"]
+                value = extract_constant_value(kwarg_dict[kwarg_name])
+
+                # If we successfully extracted a value, apply it to the field
+                if value is not None:
+                    # Apply the extracted value to the field
+                    if "fields" in result:
+                        result["fields"][field_name] = value
+
+        # Remove the field_mapping from the result as it's not part of the Blockly format
+        del result["field_mapping"]
+
+    # Process the inputs dictionary if it exists
+    if "inputs" in result:
+        # Apply positional arguments (ARG0, ARG1, ARG2, etc.)
+        for i, arg_block in enumerate(arg_blocks):
+            arg_key = f"ARG{i}"
+            if arg_key in result["inputs"]:
+                # If there's a shadow block in the template
+                if "shadow" in result["inputs"][arg_key]:
+                    # Check if we can reuse the shadow block structure
+                    shadow = result["inputs"][arg_key]["shadow"]
+                    if (
+                        shadow["type"] == arg_block["type"]
+                        and "fields" in shadow
+                        and "fields" in arg_block
+                    ):
+                        # Update the fields in the shadow block
+                        for field_key, field_value in arg_block[
+                            "fields"
+                        ].items():
+                            if field_key in shadow["fields"]:
+                                shadow["fields"][field_key] = field_value
+                    else:
+                        # Types don't match, replace the shadow with the actual block
+                        result["inputs"][arg_key] = {"block": arg_block}
+                else:
+                    # No shadow, just set the block directly
+                    result["inputs"][arg_key]["block"] = arg_block
+
+    # Apply keyword arguments that didn't get used in field mappings
+    for kw_name, kw_block in kwarg_blocks:
+        kw_key = f"KWARG_{kw_name}"
+        # If the template has a specific placeholder for this keyword
+        if "inputs" in result and kw_key in result["inputs"]:
+            if "shadow" in result["inputs"][kw_key]:
+                # Similar logic to positional args with shadows
+                shadow = result["inputs"][kw_key]["shadow"]
+                if (
+                    shadow["type"] == kw_block["type"]
+                    and "fields" in shadow
+                    and "fields" in kw_block
+                ):
+                    for field_key, field_value in kw_block["fields"].items():
+                        if field_key in shadow["fields"]:
+                            shadow["fields"][field_key] = field_value
+                else:
+                    result["inputs"][kw_key] = {"block": kw_block}
+            else:
+                result["inputs"][kw_key]["block"] = kw_block
         else:
-            block["inputs"] = {
-                "left": {
-                    "block": traverse_node(node.values[0]),
-                },
-                "right": {
-                    "block": traverse_node(
-                        ast.BoolOp(op=node.op, values=node.values[1:])
-                    ),
-                },
+            # If the template doesn't have a specific placeholder, add it
+            if "inputs" not in result:
+                result["inputs"] = {}
+            result["inputs"][kw_key] = {"block": kw_block}
+
+    return result
+
+
+def compile_template(template):
+    """
+    Compile a template into a builder: a function that takes the same
+    arg_blocks and kwarg_blocks as apply_template, and returns the same
+    result, but without needing to deep copy and then re-examine the template
+    every time it's called.
+
+    All the decisions that depend only upon the template (which fields are
+    mapped from which arguments, which inputs are slots for which arguments,
+    and which of those have shadow blocks) are made once, here. The builder
+    just creates fresh dictionaries for the parts of the template that end
+    up in the result.
+
+    Args:
+        template (dict): The template to compile.
+
+    Returns:
+        callable: The builder for the template.
+    """
+    # Field mappings only apply if the template has fields to map into.
+    field_rules = []
+    if "fields" in template:
+        for field_name, mapping in template.get("field_mapping", {}).items():
+            field_rules.append(
+                (
+                    field_name,
+                    mapping.get("arg_index"),
+                    mapping.get("kwarg_name"),
+                )
+            )
+    # The top level of the result, in the template's order, with a None
+    # copier as a placeholder for where the inputs go.
+    parts = [
+        (key, None if key == "inputs" else _compile_copier(value))
+        for key, value in template.items()
+        if key != "field_mapping"
+    ]
+    # The input slots, in the template's order.
+    slots = []
+    slot_kwargs = set()
+    for key, value in template.get("inputs", {}).items():
+        index = None
+        name = None
+        if key.startswith("ARG") and key[3:].isdigit():
+            if key == f"ARG{int(key[3:])}":
+                index = int(key[3:])
+        elif key.startswith("KWARG_"):
+            name = key[6:]
+            slot_kwargs.add(name)
+        shadowed = (index is not None or name is not None) and (
+            "shadow" in value
+        )
+        merge_type = None
+        if shadowed and "fields" in value["shadow"]:
+            # Argument blocks of the same type as the shadow block have their
+            # values merged into the shadow block's fields.
+            merge_type = value["shadow"]["type"]
+        slots.append(
+            (key, _compile_copier(value), index, name, shadowed, merge_type)
+        )
+
+    def build_inputs(arg_blocks, kwarg_dict):
+        inputs = {}
+        for key, copy_slot, index, name, shadowed, merge_type in slots:
+            if index is not None and index < len(arg_blocks):
+                arg_block = arg_blocks[index]
+            elif name is not None and name in kwarg_dict:
+                arg_block = kwarg_dict[name]
+            else:
+                # Nothing to put in this slot, so it's used as is.
+                inputs[key] = copy_slot()
+                continue
+            if not shadowed:
+                slot = copy_slot()
+                slot["block"] = arg_block
+            elif arg_block["type"] == merge_type and "fields" in arg_block:
+                slot = copy_slot()
+                fields = slot["shadow"]["fields"]
+                for field_key, field_value in arg_block["fields"].items():
+                    if field_key in fields:
+                        fields[field_key] = field_value
+            else:
+                # Types don't match, replace the shadow with the actual block
+                slot = {"block": arg_block}
+            inputs[key] = slot
+        return inputs
+
+    def builder(arg_blocks, kwarg_blocks):
+        kwarg_dict = dict(kwarg_blocks)
+        result = {}
+        for key, copier in parts:
+            if copier is None:
+                result[key] = build_inputs(arg_blocks, kwarg_dict)
+            else:
+                result[key] = copier()
+        for field_name, arg_index, kwarg_name in field_rules:
+            if arg_index is not None and arg_index < len(arg_blocks):
+                value = extract_constant_value(arg_blocks[arg_index])
+            elif kwarg_name is not None and kwarg_name in kwarg_dict:
+                value = extract_constant_value(kwarg_dict[kwarg_name])
+            else:
+                continue
+            if value is not None:
+                result["fields"][field_name] = value
+        # Keyword arguments without a slot in the template get added as
+        # inputs.
+        for kw_name, kw_block in kwarg_blocks:
+            if kw_name not in slot_kwargs:
+                if "inputs" not in result:
+                    result["inputs"] = {}
+                result["inputs"][f"KWARG_{kw_name}"] = {"block": kw_block}
+        return result
+
+    return builder
+
+
+def _compile_copier(value):
+    """
+    Return a function that returns a fresh (deep) copy of the given value
+    from a template, without the overhead of copy.deepcopy.
+    """
+    if isinstance(value, (dict, list)):
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        nested = [
+            (key, _compile_copier(item))
+            for key, item in items
+            if isinstance(item, (dict, list, tuple, set))
+        ]
+        if not nested:
+            # A shallow copy is a deep copy.
+            return value.copy
+
+        def copier():
+            result = value.copy()
+            for key, nested_copier in nested:
+                result[key] = nested_copier()
+            return result
+
+        return copier
+    elif isinstance(value, (tuple, set)):
+        return lambda: copy.deepcopy(value)
+    return lambda: value
+
+
+def _convert_node(converter, node):
+    """
+    Convert a (non-None) node in the AST via the handler registered for its
+    exact type in NODE_HANDLERS, falling back to a catch_all block.
+
+    Returns either the finished block, or a generator (to be driven by a
+    traversal engine) if the handler needs the blocks for child nodes. See
+    register_node_handler for details.
+    """
+    converter.conversion_stats["nodes"] += 1
+    node_type = type(node)
+    handler = NODE_HANDLERS.get(node_type, catch_all)
+    return handler(converter, node, {"type": node_type.__name__})
+
+
+def _handle_pass(converter, node, block):
+    return block
+
+
+def _handle_function_def(converter, node, block):
+    block["extraState"] = {
+        "create_new_model": True,
+        "name": node.name,
+        "args": [{"name": arg.arg} for arg in node.args.args],
+    }
+    block["inputs"] = {"body": {}}
+    body = yield from _convert_body(node.body)
+    if body:
+        block["inputs"]["body"]["block"] = body
+    # Iterate over args and create an Argument block within the corresponding input
+    for i, arg in enumerate(node.args.args, start=1):
+        block["inputs"][f"arg_{i:06}"] = {
+            "block": {
+                "type": "Argument",
+                "fields": {"name": arg.arg},
             }
-        block["fields"] = {"op": type(node.op).__name__}
-    elif isinstance(node, ast.UnaryOp):
-        if isinstance(node.op, ast.Not):
-            block["type"] = "Not"
-            block["inputs"] = {
-                "value": {
-                    "block": traverse_node(node.operand),
-                },
+        }
+    # Register the function for later use. TODO: FIXME for nested functions.
+    converter.register_function(
+        node.name,
+        {
+            "function_name": node.name,
+            "args": [{"name": arg.arg} for arg in node.args.args],
+        },
+    )
+    return block
+
+
+def _handle_return(converter, node, block):
+    block["inputs"] = {
+        "value": {
+            "block": (yield node.value),
+        },
+    }
+    return block
+
+
+def _handle_constant(converter, node, block):
+    value = node.value
+    if value is not None and not isinstance(value, (str, int, float)):
+        # Bytes, complex numbers and ... can't be encoded as JSON. Fail in
+        # the same way as json.dumps, so the result is the same error,
+        # whether it's returned as a dict or as JSON.
+        raise TypeError(
+            f"Object of type {type(value).__name__} is not JSON serializable"
+        )
+    block["type"] = type(node.value).__name__
+    if isinstance(node.value, bool):
+        block["fields"] = {"value": str(node.value)}
+    else:
+        block["fields"] = {"value": node.value}
+        if converter._tokens is not None:
+            converter._tokens += (node, block)
+    return block
+
+
+def _handle_expr(converter, node, block):
+    return (yield node.value)
+
+
+def _handle_formatted_value(converter, node, block):
+    block["inputs"] = {
+        "value": {
+            "block": (yield node.value),
+        },
+        "format_spec": (yield node.format_spec),
+    }
+    return block
+
+
+def _handle_joined_str(converter, node, block):
+    values = []
+    for value in node.values:
+        values.append((yield value))
+    block["fields"] = {"value": values}
+    return block
+
+
+def _handle_sequence(converter, node, block):
+    # List, Tuple and Set.
+    block["extraState"] = {"items": len(node.elts)}
+    block["inputs"] = {}
+    for i, elt in enumerate(node.elts, start=1):
+        block["inputs"][f"input_{i:06}"] = {"block": (yield elt)}
+    return block
+
+
+def _handle_dict(converter, node, block):
+    block["extraState"] = {"items": len(node.keys)}
+    block["inputs"] = {}
+    for i, (key, value) in enumerate(zip(node.keys, node.values), start=1):
+        if key is None:
+            # This is a **some_dict argument to unpack.
+            block["inputs"][f"input_{i:06}"] = {
+                "block": {
+                    "type": "dict_unpack",
+                    "inputs": {
+                        "value": {"block": (yield value)},
+                    },
+                }
             }
         else:
-            block["inputs"] = {
-                "value": {
-                    "block": traverse_node(node.operand),
-                },
-            }
-            block["fields"] = {"op": type(node.op).__name__}
-    elif isinstance(node, ast.Compare):
-        # If there are two values, just use value[0] as left and value[1] as
-        # right input.
-        # If there are more than two values, use value[0] as left and create a
-        # new ast.BoolOp (with the remaining values), as the right input.
-        if len(node.ops) == 1:
-            block["inputs"] = {
-                "left": {
-                    "block": traverse_node(node.left),
-                },
-                "right": {
-                    "block": traverse_node(node.comparators[0]),
-                },
+            block["inputs"][f"input_{i:06}"] = {
+                "block": {
+                    "type": "dict_item",
+                    "inputs": {
+                        "key": {"block": (yield key)},
+                        "value": {"block": (yield value)},
+                    },
+                }
             }
-        else:
-            block["inputs"] = {
+    return block
+
+
+def _handle_delete(converter, node, block):
+    block["extraState"] = {"items": len(node.targets)}
+    block["inputs"] = {}
+    for i, target in enumerate(node.targets, start=1):
+        block["inputs"][f"input_{i:06}"] = {"block": (yield target)}
+    return block
+
+
+def _handle_aug_assign(converter, node, block):
+    block["inputs"] = {
+        "value": {
+            "block": (yield node.value),
+        },
+    }
+    block["fields"] = {"var": {"name": node.target.id}}
+    return block
+
+
+def _handle_name(converter, node, block):
+    block["fields"] = {"var": {"name": node.id}}
+    if converter._tokens is not None:
+        converter._tokens += (node, block)
+    return block
+
+
+def _handle_bin_op(converter, node, block):
+    if converter.flatten and _is_chained_bin_op(node.left, node.op):
+        # Gather the operands of the chain, such as a + b + c + d (which
+        # Python parses as ((a + b) + c) + d), from the innermost outwards.
+        operands = [node.right]
+        left = node.left
+        while _is_chained_bin_op(left, node.op):
+            operands.append(left.right)
+            left = left.left
+        operands.append(left)
+        values = []
+        for operand in reversed(operands):
+            values.append((yield operand))
+        return _chain_block(
+            "BinOpChain", values, {"op": type(node.op).__name__}
+        )
+    block["inputs"] = {
+        "left": {
+            "block": (yield node.left),
+        },
+        "right": {
+            "block": (yield node.right),
+        },
+    }
+    block["fields"] = {"op": type(node.op).__name__}
+    return block
+
+
+def _is_chained_bin_op(node, op):
+    """
+    Check if the node is the left operand of a flattenable chain of binary
+    operations with the given op. Chains are evaluated left to right, so
+    all operators except (right associative) ** can be chained.
+    """
+    return (
+        type(node) is ast.BinOp
+        and type(node.op) is type(op)
+        and type(op) is not ast.Pow
+    )
+
+
+def _chain_block(block_type, values, fields):
+    """
+    Return a flattened chain block, with an input for each of the blocks in
+    values (in the same way as List or Tuple blocks) and the given fields for
+    the op(s) between them.
+    """
+    return {
+        "type": block_type,
+        "extraState": {"items": len(values)},
+        "inputs": {
+            f"input_{i:06}": {"block": value}
+            for i, value in enumerate(values, start=1)
+        },
+        "fields": fields,
+    }
+
+
+def _handle_bool_op(converter, node, block):
+    values = []
+    for value in node.values:
+        values.append((yield value))
+    op = type(node.op).__name__
+    if converter.flatten and len(values) > 2:
+        return _chain_block("BoolOpChain", values, {"op": op})
+    # If there are two values, just use value[0] as left and value[1] as
+    # right input.
+    # If there are more than two values, use value[0] as left and a BoolOp
+    # block (for the remaining values, built in the same way) as the right
+    # input. The nested blocks are built from the innermost (last) pair
+    # outwards.
+    right = values[-1]
+    for i in range(len(values) - 2, 0, -1):
+        right = {
+            "type": "BoolOp",
+            "inputs": {
                 "left": {
-                    "block": traverse_node(node.left),
+                    "block": values[i],
                 },
                 "right": {
-                    "block": traverse_node(
-                        ast.Compare(
-                            left=node.comparators[0],
-                            ops=node.ops[1:],
-                            comparators=node.comparators[1:],
-                        )
-                    ),
+                    "block": right,
                 },
-            }
-
-        block["fields"] = {"op": type(node.ops[0]).__name__}
-    elif isinstance(node, ast.IfExp):
-        block["inputs"] = {
-            "test": {
-                "block": traverse_node(node.test),
-            },
-            "body": {
-                "block": traverse_node(node.body),
-            },
-            "orelse": {
-                "block": traverse_node(node.orelse),
             },
+            "fields": {"op": op},
         }
-    elif isinstance(node, ast.Attribute):
+    block["inputs"] = {
+        "left": {
+            "block": values[0],
+        },
+        "right": {
+            "block": right,
+        },
+    }
+    block["fields"] = {"op": op}
+    return block
+
+
+def _handle_unary_op(converter, node, block):
+    if isinstance(node.op, ast.Not):
+        block["type"] = "Not"
         block["inputs"] = {
             "value": {
-                "block": traverse_node(node.value),
+                "block": (yield node.operand),
             },
         }
-        block["fields"] = {"attr": node.attr}
-    elif isinstance(node, ast.NamedExpr):
+    else:
         block["inputs"] = {
-            "target": {
-                "block": traverse_node(node.target),
-            },
             "value": {
-                "block": traverse_node(node.value),
+                "block": (yield node.operand),
             },
         }
-    elif isinstance(node, ast.Subscript):
-        block["inputs"] = {
-            "value": {
-                "block": traverse_node(node.value),
+        block["fields"] = {"op": type(node.op).__name__}
+    return block
+
+
+def _handle_compare(converter, node, block):
+    values = [(yield node.left)]
+    for comparator in node.comparators:
+        values.append((yield comparator))
+    ops = [type(op).__name__ for op in node.ops]
+    if converter.flatten and len(values) > 2:
+        fields = {f"op_{i:06}": op for i, op in enumerate(ops, start=1)}
+        return _chain_block("CompareChain", values, fields)
+    # If there are two values, just use value[0] as left and value[1] as
+    # right input.
+    # If there are more than two values, use value[0] as left and a Compare
+    # block (for the remaining values and ops, built in the same way) as the
+    # right input. The nested blocks are built from the innermost (last) pair
+    # outwards.
+    right = values[-1]
+    for i in range(len(ops) - 1, 0, -1):
+        right = {
+            "type": "Compare",
+            "inputs": {
+                "left": {
+                    "block": values[i],
+                },
+                "right": {
+                    "block": right,
+                },
             },
+            "fields": {"op": ops[i]},
         }
-        if isinstance(node.slice, ast.Tuple):
-            block["inputs"]["slice"] = {
-                "block": traverse_node(node.slice.elts[0])
-            }
-            block["inputs"]["slice"]["block"]["inputs"]["step"] = {
-                "block": traverse_node(node.slice.elts[1])
-            }
-        else:
-            block["inputs"]["slice"] = {"block": traverse_node(node.slice)}
+    block["inputs"] = {
+        "left": {
+            "block": values[0],
+        },
+        "right": {
+            "block": right,
+        },
+    }
 
-    elif isinstance(node, ast.Slice):
-        block["inputs"] = {
-            "lower": {
-                "block": traverse_node(node.lower),
-            },
-            "upper": {
-                "block": traverse_node(node.upper),
-            },
-            "step": {
-                "block": traverse_node(node.step),
-            },
+    block["fields"] = {"op": ops[0]}
+    return block
+
+
+def _handle_if_exp(converter, node, block):
+    block["inputs"] = {
+        "test": {
+            "block": (yield node.test),
+        },
+        "body": {
+            "block": (yield node.body),
+        },
+        "orelse": {
+            "block": (yield node.orelse),
+        },
+    }
+    return block
+
+
+def _handle_attribute(converter, node, block):
+    block["inputs"] = {
+        "value": {
+            "block": (yield node.value),
+        },
+    }
+    block["fields"] = {"attr": node.attr}
+    return block
+
+
+def _handle_named_expr(converter, node, block):
+    block["inputs"] = {
+        "target": {
+            "block": (yield node.target),
+        },
+        "value": {
+            "block": (yield node.value),
+        },
+    }
+    return block
+
+
+def _handle_subscript(converter, node, block):
+    block["inputs"] = {
+        "value": {
+            "block": (yield node.value),
+        },
+    }
+    if isinstance(node.slice, ast.Tuple):
+        block["inputs"]["slice"] = {"block": (yield node.slice.elts[0])}
+        block["inputs"]["slice"]["block"]["inputs"]["step"] = {
+            "block": (yield node.slice.elts[1])
         }
-    elif isinstance(
-        node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
-    ):
-        block["extraState"] = {"items": len(node.generators)}
-        if isinstance(node, ast.DictComp):
-            block["inputs"] = {
-                "elt": {
-                    "block": {
-                        "type": "dict_item",
-                        "inputs": {
-                            "key": {
-                                "block": traverse_node(node.key),
-                            },
-                            "value": {
-                                "block": traverse_node(node.value),
-                            },
+    else:
+        block["inputs"]["slice"] = {"block": (yield node.slice)}
+    return block
+
+
+def _handle_slice(converter, node, block):
+    block["inputs"] = {
+        "lower": {
+            "block": (yield node.lower),
+        },
+        "upper": {
+            "block": (yield node.upper),
+        },
+        "step": {
+            "block": (yield node.step),
+        },
+    }
+    return block
+
+
+def _handle_comprehension(converter, node, block):
+    # ListComp, SetComp, DictComp and GeneratorExp.
+    block["extraState"] = {"items": len(node.generators)}
+    if isinstance(node, ast.DictComp):
+        block["inputs"] = {
+            "elt": {
+                "block": {
+                    "type": "dict_item",
+                    "inputs": {
+                        "key": {
+                            "block": (yield node.key),
                         },
-                    }
-                },
-            }
-        else:
-            block["inputs"] = {
-                "elt": {
-                    "block": traverse_node(node.elt),
+                        "value": {
+                            "block": (yield node.value),
+                        },
+                    },
                 }
+            },
+        }
+    else:
+        block["inputs"] = {
+            "elt": {
+                "block": (yield node.elt),
             }
+        }
 
-        for i, gen in enumerate(node.generators, start=1):
-            # Create a new target and iter
-            block["inputs"][f"target_{i:06}"] = {
-                "block": traverse_node(gen.target),
-            }
-            block["inputs"][f"iter_{i:06}"] = {
-                "block": traverse_node(gen.iter)
-            }
-            if gen.ifs:
-                # Generate ListCompIf
-                block["type"] = f"{block['type']}If"
-                block["inputs"][f"if_{i:06}"] = {
-                    "block": traverse_node(gen.ifs[0])
-                }
-    elif isinstance(node, (ast.Assign, ast.AnnAssign)):
-        block["inputs"] = {
-            "target": {
-                "block": traverse_node(node.targets[0]),
-            },
-            "value": {
-                "block": traverse_node(node.value),
-            },
+    for i, gen in enumerate(node.generators, start=1):
+        # Create a new target and iter
+        block["inputs"][f"target_{i:06}"] = {
+            "block": (yield gen.target),
         }
-    elif isinstance(node, ast.Call):
-        # Get the function identifier (could be simple name or module.function)
-        function_key = get_function_key(node)
+        block["inputs"][f"iter_{i:06}"] = {"block": (yield gen.iter)}
+        if gen.ifs:
+            # Generate ListCompIf
+            block["type"] = f"{block['type']}If"
+            block["inputs"][f"if_{i:06}"] = {"block": (yield gen.ifs[0])}
+    return block
 
-        # Process positional arguments
-        arg_blocks = [traverse_node(arg) for arg in node.args]
 
-        # Process keyword arguments
-        kwarg_blocks = [
-            (kw.arg, traverse_node(kw.value))
-            for kw in node.keywords
-            if kw.arg is not None
-        ]
+def _handle_assign(converter, node, block):
+    # Assign and AnnAssign.
+    block["inputs"] = {
+        "target": {
+            "block": (yield node.targets[0]),
+        },
+        "value": {
+            "block": (yield node.value),
+        },
+    }
+    return block
 
-        # Check if it's a built-in function with a pre-defined block template
-        if function_key and is_builtin_function(function_key):
-            # Get the template and apply the arguments
-            template = BUILTIN_BLOCKS[function_key]
-            block = apply_template(template, arg_blocks, kwarg_blocks)
-
-            # Handle kwargs unpacking if present
-            kwargs_unpack = [
-                kw.value for kw in node.keywords if kw.arg is None
-            ]
-            if kwargs_unpack:
-                if "inputs" not in block:
-                    block["inputs"] = {}
-                block["inputs"]["KWARGS_UNPACK"] = {
-                    "block": traverse_node(kwargs_unpack[0])
-                }
-        elif function_key in USER_DEFINED_FUNCTIONS:
-            # It's a user-defined function or a method call
-            block["extraState"] = block.get("extraState", {})
 
-            # Get function name for simple cases
-            func_name = get_function_name(node)
+def _handle_call(converter, node, block):
+    # Get the function identifier (could be simple name or module.function)
+    function_key = get_function_key(node)
+    if not converter.is_known_function(function_key):
+        # Decide before converting any arguments, since their blocks would
+        # just be thrown away.
+        return catch_all(converter, node, block)
 
-            if func_name:
-                block["extraState"]["name"] = func_name
-                block["inputs"] = {}
+    # Process positional arguments. Each argument (and keyword argument) is
+    # converted exactly once, and the resulting blocks are reused by
+    # whichever kind of call this turns out to be.
+    if converter._tokens is not None:
+        # The tokens recorded for the arguments start here.
+        first_token = len(converter._tokens)
+    arg_blocks = []
+    for arg in node.args:
+        arg_blocks.append((yield arg))
+
+    # Process keyword arguments (a None name is a **kwargs to unpack)
+    keyword_blocks = []
+    for kw in node.keywords:
+        keyword_blocks.append((kw.arg, (yield kw.value)))
 
-            # Add positional arguments
-            block["extraState"]["args"] = len(node.args)
+    # Check if it's a built-in function with a pre-defined block template
+    if converter.is_builtin_function(function_key):
+        # Build the block from the template with the arguments applied
+        builder = converter.get_builtin_builder(function_key)
+        kwarg_blocks = [
+            (name, kw_block)
+            for name, kw_block in keyword_blocks
+            if name is not None
+        ]
+        block = builder(arg_blocks, kwarg_blocks)
+        tokens = converter._tokens
+        template = converter.builtin_blocks[function_key]
+        if tokens and "field_mapping" in template:
+            # The values of the argument blocks may have been copied into
+            # the block's fields, so they can't be patched on their own.
+            derived = {id(arg_block) for arg_block in arg_blocks}
+            derived.update(id(kw_block) for _, kw_block in keyword_blocks)
+            for i in range(first_token + 1, len(tokens), 2):
+                if id(tokens[i]) in derived:
+                    tokens[i - 1] = None
+
+        # Handle kwargs unpacking if present
+        kwargs_unpack = [
+            kw_block for name, kw_block in keyword_blocks if name is None
+        ]
+        if kwargs_unpack:
             if "inputs" not in block:
                 block["inputs"] = {}
-            for i, arg in enumerate(node.args, start=1):
-                block["inputs"][f"arg_{i:06}"] = {
-                    "block": traverse_node(arg),
-                }
+            block["inputs"]["KWARGS_UNPACK"] = {"block": kwargs_unpack[0]}
+    else:
+        # It's a user-defined function or a method call
+        block["extraState"] = block.get("extraState", {})
+
+        # Get function name for simple cases
+        func_name = get_function_name(node)
+
+        if func_name:
+            block["extraState"]["name"] = func_name
+            block["inputs"] = {}
 
-            # Add keyword arguments
-            block["extraState"] = block.get("extraState", {})
-            block["extraState"]["kwargs"] = len(node.keywords)
-            for i, keyword in enumerate(node.keywords, start=1):
-                if keyword.arg is None:
-                    # This is a **kwargs argument
-                    block["inputs"][f"kwarg_{i:06}"] = {
-                        "block": {
-                            "type": "kwargs_unpack",
-                            "inputs": {
-                                "value": {
-                                    "block": traverse_node(keyword.value)
-                                },
-                            },
+        # Add positional arguments
+        block["extraState"]["args"] = len(node.args)
+        if "inputs" not in block:
+            block["inputs"] = {}
+        for i, arg_block in enumerate(arg_blocks, start=1):
+            block["inputs"][f"arg_{i:06}"] = {
+                "block": arg_block,
+            }
+
+        # Add keyword arguments
+        block["extraState"] = block.get("extraState", {})
+        block["extraState"]["kwargs"] = len(node.keywords)
+        for i, (name, kw_block) in enumerate(keyword_blocks, start=1):
+            if name is None:
+                # This is a **kwargs argument
+                block["inputs"][f"kwarg_{i:06}"] = {
+                    "block": {
+                        "type": "kwargs_unpack",
+                        "inputs": {
+                            "value": {"block": kw_block},
                         },
-                    }
-                else:
-                    block["inputs"][f"kwarg_{i:06}"] = {
-                        "block": {
-                            "type": "keyword",
-                            "fields": {"arg": keyword.arg},
-                            "inputs": {
-                                "value": {
-                                    "block": traverse_node(keyword.value)
-                                },
-                            },
+                    },
+                }
+            else:
+                block["inputs"][f"kwarg_{i:06}"] = {
+                    "block": {
+                        "type": "keyword",
+                        "fields": {"arg": name},
+                        "inputs": {
+                            "value": {"block": kw_block},
                         },
-                    }
-        else:
-            block = catch_all(node, block)
-    else:
-        block = catch_all(node, block)
+                    },
+                }
     return block
+
+
+# The handlers used to convert each type of node in the AST, keyed by the
+# node's exact class. Nodes whose class isn't in here become catch_all blocks.
+# Use register_node_handler to add or override handlers.
+NODE_HANDLERS = {
+    ast.Pass: _handle_pass,
+    ast.FunctionDef: _handle_function_def,
+    ast.Return: _handle_return,
+    ast.Constant: _handle_constant,
+    ast.Expr: _handle_expr,
+    ast.FormattedValue: _handle_formatted_value,
+    ast.JoinedStr: _handle_joined_str,
+    ast.List: _handle_sequence,
+    ast.Tuple: _handle_sequence,
+    ast.Set: _handle_sequence,
+    ast.Dict: _handle_dict,
+    ast.Delete: _handle_delete,
+    ast.AugAssign: _handle_aug_assign,
+    ast.Name: _handle_name,
+    ast.BinOp: _handle_bin_op,
+    ast.BoolOp: _handle_bool_op,
+    ast.UnaryOp: _handle_unary_op,
+    ast.Compare: _handle_compare,
+    ast.IfExp: _handle_if_exp,
+    ast.Attribute: _handle_attribute,
+    ast.NamedExpr: _handle_named_expr,
+    ast.Subscript: _handle_subscript,
+    ast.Slice: _handle_slice,
+    ast.ListComp: _handle_comprehension,
+    ast.SetComp: _handle_comprehension,
+    ast.DictComp: _handle_comprehension,
+    ast.GeneratorExp: _handle_comprehension,
+    ast.Assign: _handle_assign,
+    ast.AnnAssign: _handle_assign,
+    ast.Call: _handle_call,
+}
@@ -2,6 +2,9 @@
 Test suite for py2blocks.
 """
 
+import ast
+import sys
+import time
 import py2blocks
 import json
 from pyscript import window
@@ -67,7 +70,8 @@ async def test_function_no_args_no_body_no_return():
     Ensure that a simple function is converted to Blockly JSON correctly.
     """
     python_code = "def test_function():\n    pass"
-    result = json.loads(py2blocks.py2blocks(python_code))
+    converter = py2blocks.Converter()
+    result = json.loads(converter.convert(python_code))
     render_blocks("test_function_no_args_no_body_no_return", result)
     assert result == {
         "blocks": {
@@ -85,7 +89,7 @@ async def test_function_no_args_no_body_no_return():
         }
     }, result
     assert (
-        "test_function" in py2blocks.USER_DEFINED_FUNCTIONS
+        "test_function" in converter.user_defined_functions
     ), "Missing user defined function."
 
 
@@ -95,7 +99,8 @@ async def test_function_no_args_no_body_with_return():
     Blockly JSON correctly.
     """
     python_code = "def test_function():\n    return 1"
-    result = json.loads(py2blocks.py2blocks(python_code))
+    converter = py2blocks.Converter()
+    result = json.loads(converter.convert(python_code))
     render_blocks("test_function_no_args_no_body_with_return", result)
     assert result == {
         "blocks": {
@@ -127,7 +132,7 @@ async def test_function_no_args_no_body_with_return():
         }
     }, result
     assert (
-        "test_function" in py2blocks.USER_DEFINED_FUNCTIONS
+        "test_function" in converter.user_defined_functions
     ), "Missing user defined function."
 
 
@@ -137,7 +142,8 @@ async def test_function_no_args_with_body_with_return():
     converted to Blockly JSON correctly.
     """
     python_code = "def test_function():\n    x = 1\n    return x"
-    result = json.loads(py2blocks.py2blocks(python_code))
+    converter = py2blocks.Converter()
+    result = json.loads(converter.convert(python_code))
     render_blocks("test_function_no_args_with_body_with_return", result)
     assert result == {
         "blocks": {
@@ -190,7 +196,7 @@ async def test_function_no_args_with_body_with_return():
         }
     }, result
     assert (
-        "test_function" in py2blocks.USER_DEFINED_FUNCTIONS
+        "test_function" in converter.user_defined_functions
     ), "Missing user defined function."
 
 
@@ -200,7 +206,8 @@ async def test_function_with_args_with_body_with_return():
     is converted to Blockly JSON correctly.
     """
     python_code = "def test_function(x):\n    y = x + 1\n    return y"
-    raw = py2blocks.py2blocks(python_code)
+    converter = py2blocks.Converter()
+    raw = converter.convert(python_code)
     result = json.loads(raw)
     render_blocks("test_function_with_args_with_body_with_return", result)
     assert result == {
@@ -278,7 +285,7 @@ async def test_function_with_args_with_body_with_return():
         }
     }, result
     assert (
-        "test_function" in py2blocks.USER_DEFINED_FUNCTIONS
+        "test_function" in converter.user_defined_functions
     ), "Missing user defined function."
 
 
@@ -288,7 +295,8 @@ async def test_function_inside_another_function():
     correctly.
     """
     python_code = "def outer_function():\n    def inner_function():\n        return 1\n    return inner_function"
-    result = json.loads(py2blocks.py2blocks(python_code))
+    converter = py2blocks.Converter()
+    result = json.loads(converter.convert(python_code))
     render_blocks("test_function_inside_another_function", result)
     assert result == {
         "blocks": {
@@ -349,17 +357,18 @@ async def test_function_inside_another_function():
         }
     }, result
     assert (
-        "outer_function" in py2blocks.USER_DEFINED_FUNCTIONS
+        "outer_function" in converter.user_defined_functions
     ), "Missing user defined function."
     assert (
-        "inner_function" in py2blocks.USER_DEFINED_FUNCTIONS
+        "inner_function" in converter.user_defined_functions
     ), "Missing user defined function."
 
 
 async def test_calling_user_defined_function():
     # TODO: check number of args and keywords is reflected in the call block.
     python_code = "def test_function():\n    return 1\n\ntest_function()"
-    result = json.loads(py2blocks.py2blocks(python_code))
+    converter = py2blocks.Converter()
+    result = json.loads(converter.convert(python_code))
     render_blocks("test_calling_user_defined_function", result)
     assert result == {
         "blocks": {
@@ -402,7 +411,7 @@ async def test_calling_user_defined_function():
         }
     }, result
     assert (
-        "test_function" in py2blocks.USER_DEFINED_FUNCTIONS
+        "test_function" in converter.user_defined_functions
     ), "Missing user defined function."
 
 
@@ -410,7 +419,8 @@ async def test_user_defined_function_with_args_and_kwargs():
     python_code = (
         "def test_function(x, y=1):\n    return x + y\n\ntest_function(2, y=3)"
     )
-    result = json.loads(py2blocks.py2blocks(python_code))
+    converter = py2blocks.Converter()
+    result = json.loads(converter.convert(python_code))
     render_blocks("test_user_defined_function_with_args_and_kwargs", result)
     assert result == {
         "blocks": {
@@ -508,7 +518,7 @@ async def test_user_defined_function_with_args_and_kwargs():
         }
     }, result
     assert (
-        "test_function" in py2blocks.USER_DEFINED_FUNCTIONS
+        "test_function" in converter.user_defined_functions
     ), "Missing user defined function."
 
 
@@ -2026,6 +2036,7 @@ async def test_assign_with_tuple():
         }
     }, result
 
+
 async def test_assign_with_multiple_targets():
     """
     Ensure that an assignment with multiple targets is converted to Blockly JSON
@@ -2035,4 +2046,1542 @@ async def test_assign_with_multiple_targets():
     result = json.loads(py2blocks.py2blocks(python_code))
     # TODO: Create new multiple assignment block
     render_blocks("test_assign_with_multiple_targets", result)
-    assert result == {}, result
\ No newline at end of file
+    assert result == {}, result
+
+
+async def test_long_function_body():
+    """
+    Ensure that a function with a very long body is chained together via the
+    "next" attribute of each block, without hitting the recursion limit.
+    """
+    python_code = "def test_function():\n" + "    x = 1\n" * 5000
+    tree = ast.parse(python_code)
+    body = py2blocks.Converter().traverse_body(tree.body[0].body)
+    count = 0
+    block = body
+    while block:
+        assert block["type"] == "Assign", block
+        count += 1
+        block = block.get("next", {}).get("block")
+    assert count == 5000, count
+
+
+async def test_traverse_body_scales_linearly():
+    """
+    Ensure that the cost of chaining a body of statements grows linearly with
+    the number of statements (up to 100k statements).
+    """
+    small = ast.parse("pass\n" * 10_000).body
+    large = ast.parse("pass\n" * 100_000).body
+    converter = py2blocks.Converter()
+    start = time.perf_counter()
+    converter.traverse_body(small)
+    small_time = time.perf_counter() - start
+    start = time.perf_counter()
+    converter.traverse_body(large)
+    large_time = time.perf_counter() - start
+    # Ten times the statements should take roughly ten times as long. Allow
+    # plenty of headroom for timing noise: quadratic behaviour would be ~100x.
+    assert large_time < small_time * 30, (small_time, large_time)
+
+
+async def test_engines_produce_identical_output():
+    """
+    Ensure that the explicit stack engine produces exactly the same output as
+    the reference recursive engine.
+    """
+    python_code = (
+        "def f(x, y=1):\n"
+        "    z = [i * 2 for i in range(x) if i]\n"
+        "    return f(f(x), y=z)\n"
+        "x = a and b and c\n"
+        "y = 0 < a < b < c\n"
+        "d = {'a': 1, **other}\n"
+        "print(f'{x!r:>10}', x[1:2:3], x.y.z, sep='')\n"
+        "f(-x if not y else (z := 1), **kw)\n"
+        "unknown(1, 2, k=3)\n"
+        "while x:\n"
+        "    pass\n"
+    )
+    tree = ast.parse(python_code)
+    recursive = json.dumps(py2blocks.traverse(tree, "recursive"))
+    stack = json.dumps(py2blocks.traverse(tree, "stack"))
+    assert recursive == stack, (recursive, stack)
+
+
+async def test_stack_engine_deep_expression():
+    """
+    Ensure that the explicit stack engine can convert expressions nested far
+    deeper than the recursion limit.
+    """
+    python_code = "x = " + " + ".join(["a"] * 2000)
+    tree = ast.parse(python_code)
+    result = py2blocks.traverse(tree, "stack")
+    block = result["blocks"]["blocks"][0]["inputs"]["value"]["block"]
+    depth = 0
+    while block["type"] == "BinOp":
+        assert block["inputs"]["right"]["block"]["fields"] == {
+            "var": {"name": "a"}
+        }
+        depth += 1
+        block = block["inputs"]["left"]["block"]
+    assert depth == 1999, depth
+    # The JSON can be encoded too (even with ids, which hash each block).
+    for ids in (False, True):
+        result = py2blocks.py2blocks(python_code, engine="stack", ids=ids)
+        start = '{"blocks": {"blocks": [{"type": "Assign", '
+        assert result.startswith(start), result[:100]
+        end = '"fields": {"op": "Add"}}}}}]}}'
+        assert result.endswith(end), result[-100:]
+        assert result.count('"type": "BinOp"') == 1999, result[:100]
+        assert result.count('"fields": {"var": {"name": "a"}}') == 2000
+        assert result.count('"id": ') == (4001 if ids else 0)
+
+
+async def test_unknown_engine():
+    """
+    Ensure that asking for a non-existent traversal engine results in a
+    helpful error.
+    """
+    result = json.loads(py2blocks.py2blocks("x = 1", engine="unknown"))
+    assert result == {"error": "Unknown traversal engine: unknown"}, result
+
+
+async def test_register_node_handler():
+    """
+    Ensure that a handler can be registered for a type of node that is not
+    otherwise supported, and that it can yield child nodes to get their
+    blocks.
+    """
+
+    def handle_await(converter, node, block):
+        block["inputs"] = {"value": {"block": (yield node.value)}}
+        return block
+
+    previous = py2blocks.register_node_handler(ast.Await, handle_await)
+    try:
+        assert previous is None, previous
+        python_code = "async def f():\n    await x"
+        tree = ast.parse(python_code)
+        for engine in py2blocks.ENGINES:
+            converter = py2blocks.Converter(engine)
+            result = converter.traverse_node(tree.body[0].body[0].value)
+            assert result == {
+                "type": "Await",
+                "inputs": {
+                    "value": {
+                        "block": {
+                            "type": "Name",
+                            "fields": {"var": {"name": "x"}},
+                        }
+                    }
+                },
+            }, result
+    finally:
+        del py2blocks.NODE_HANDLERS[ast.Await]
+
+
+async def test_override_node_handler():
+    """
+    Ensure that an existing handler can be overridden, and the previous
+    handler delegated to.
+    """
+
+    def handle_name(converter, node, block):
+        block = previous(converter, node, block)
+        block["fields"]["var"]["name"] = node.id.upper()
+        return block
+
+    previous = py2blocks.register_node_handler(ast.Name, handle_name)
+    try:
+        result = json.loads(py2blocks.py2blocks("x"))
+        assert result == {
+            "blocks": {
+                "blocks": [
+                    {"type": "Name", "fields": {"var": {"name": "X"}}},
+                ]
+            }
+        }, result
+    finally:
+        py2blocks.register_node_handler(ast.Name, previous)
+
+
+async def test_compiled_template_matches_apply_template():
+    """
+    Ensure that the builder compiled from a template produces exactly the same
+    result as applying the template via apply_template, for field mappings,
+    shadow blocks (both merged and replaced) and keyword argument slots.
+    """
+    template = {
+        "type": "invent_publish",
+        "fields": {"CHANNEL": "", "RETAIN": "FALSE"},
+        "field_mapping": {
+            "CHANNEL": {"arg_index": 0},
+            "RETAIN": {"kwarg_name": "retain"},
+        },
+        "inputs": {
+            "ARG0": {"shadow": {"type": "str", "fields": {"value": ""}}},
+            "ARG1": {"shadow": {"type": "str", "fields": {"value": "x"}}},
+            "KWARG_delay": {"block": None},
+        },
+        "extraState": {"options": [{"name": "retain"}]},
+    }
+    builder = py2blocks.compile_template(template)
+    for python_code in [
+        "publish()",
+        "publish('news')",
+        "publish('news', message, delay=5, retain=True)",
+        "publish('news', 'hello', other=1)",
+    ]:
+        node = ast.parse(python_code).body[0].value
+        converter = py2blocks.Converter()
+        arg_blocks = [converter.traverse_node(arg) for arg in node.args]
+        kwarg_blocks = [
+            (kw.arg, converter.traverse_node(kw.value)) for kw in node.keywords
+        ]
+        expected = json.dumps(
+            py2blocks.apply_template(template, arg_blocks, kwarg_blocks)
+        )
+        result = json.dumps(builder(arg_blocks, kwarg_blocks))
+        assert result == expected, (python_code, result, expected)
+    # Each result is a fresh copy, so changing it doesn't change the template.
+    builder([], [])["extraState"]["options"].append({"name": "delay"})
+    assert template["extraState"] == {"options": [{"name": "retain"}]}
+
+
+async def test_register_builtin_block_compiles_template():
+    """
+    Ensure that registering a built-in block compiles its template, and that
+    replacing a template (even directly in BUILTIN_BLOCKS) is picked up.
+    """
+    py2blocks.register_builtin_block(
+        "invent.go", {"type": "go_block", "inputs": {"ARG0": {"block": None}}}
+    )
+    try:
+        template, builder = py2blocks.BUILTIN_BUILDERS["invent.go"]
+        assert template is py2blocks.BUILTIN_BLOCKS["invent.go"]
+        result = json.loads(py2blocks.py2blocks("invent.go(1)"))
+        assert result["blocks"]["blocks"][0] == {
+            "type": "go_block",
+            "inputs": {
+                "ARG0": {"block": {"type": "int", "fields": {"value": 1}}}
+            },
+        }, result
+        py2blocks.BUILTIN_BLOCKS["invent.go"] = {"type": "stop_block"}
+        result = json.loads(py2blocks.py2blocks("invent.go(1)"))
+        assert result["blocks"]["blocks"][0] == {"type": "stop_block"}, result
+    finally:
+        del py2blocks.BUILTIN_BLOCKS["invent.go"]
+        del py2blocks.BUILTIN_BUILDERS["invent.go"]
+
+
+async def test_nested_user_defined_function_calls_convert_arguments_once():
+    """
+    Ensure that the arguments to nested calls of a user-defined function are
+    only converted once, rather than once per level of nesting.
+    """
+    visits = []
+
+    def handle_name(converter, node, block):
+        visits.append(node.id)
+        return previous(converter, node, block)
+
+    previous = py2blocks.register_node_handler(ast.Name, handle_name)
+    try:
+        depth = 20
+        python_code = (
+            "def f(x, y=1):\n    return x\n"
+            + "f(" * depth
+            + "x"
+            + ", y=z)" * depth
+        )
+        result = json.loads(py2blocks.py2blocks(python_code))
+        # The innermost x once, plus z once per level of nesting (and the x
+        # in the return statement).
+        assert visits.count("x") == 2, visits.count("x")
+        assert visits.count("z") == depth, visits.count("z")
+        block = result["blocks"]["blocks"][0]["next"]["block"]
+        for _ in range(depth):
+            assert block["type"] == "Call", block
+            block = block["inputs"]["arg_000001"]["block"]
+        assert block == {"type": "Name", "fields": {"var": {"name": "x"}}}
+    finally:
+        py2blocks.register_node_handler(ast.Name, previous)
+
+
+async def test_will_catch_all():
+    """
+    Ensure that nodes that will become catch_all blocks are identified
+    without converting them.
+    """
+    python_code = (
+        "def f():\n    pass\n"
+        "f(1)\n"
+        "print(1)\n"
+        "unknown(1)\n"
+        "x = 1\n"
+        "while x:\n    pass"
+    )
+    tree = ast.parse(python_code)
+    converter = py2blocks.Converter()
+    converter.traverse(tree)
+    expected = [False, False, False, True, False, True]
+    result = [
+        converter.will_catch_all(
+            node.value if isinstance(node, ast.Expr) else node
+        )
+        for node in tree.body
+    ]
+    assert result == expected, result
+
+
+async def test_conversion_stats():
+    """
+    Ensure that the conversion stats count the nodes visited and the catch_all
+    blocks created, and that the arguments of calls that become catch_all
+    blocks are not visited at all.
+    """
+    python_code = "x = 1\nunknown([1, 2, 3], key=value)"
+    converter = py2blocks.Converter()
+    converter.convert(python_code)
+    assert converter.conversion_stats == {
+        "nodes": 5,
+        "catch_all": 1,
+        "wasted_visits": 0,
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "cache_hit_rate": 0,
+    }, converter.conversion_stats
+
+
+async def test_conversion_stats_wasted_visits():
+    """
+    Ensure that visits to nodes whose blocks are thrown away by a handler
+    that falls back to a catch_all block are counted as wasted.
+    """
+
+    def handle_await(converter, node, block):
+        yield node.value
+        return py2blocks.catch_all(converter, node, block)
+
+    py2blocks.register_node_handler(ast.Await, handle_await)
+    try:
+        python_code = "async def f():\n    await g(x + 1)"
+        tree = ast.parse(python_code)
+        for engine in py2blocks.ENGINES:
+            converter = py2blocks.Converter(engine)
+            converter.user_defined_functions["g"] = {}
+            converter.traverse_node(tree.body[0].body[0])
+            assert converter.conversion_stats == {
+                "nodes": 6,
+                "catch_all": 1,
+                "wasted_visits": 4,
+                "cache_hits": 0,
+                "cache_misses": 0,
+                "cache_hit_rate": 0,
+            }, converter.conversion_stats
+    finally:
+        del py2blocks.NODE_HANDLERS[ast.Await]
+
+
+async def test_catch_all_keeps_original_source():
+    """
+    Ensure that the code in a catch_all block is the original source code,
+    with its formatting and comments, dedented relative to the line on which
+    it starts.
+    """
+    python_code = (
+        "def f():\n"
+        "    while x:  # Forever.\n"
+        "        print('é',\n"
+        '              "ü")\n'
+    )
+    result = json.loads(py2blocks.py2blocks(python_code))
+    render_blocks("test_catch_all_keeps_original_source", result)
+    body = result["blocks"]["blocks"][0]["inputs"]["body"]["block"]
+    code = "while x:  # Forever.\n    print('é',\n          \"ü\")"
+    assert body == {"type": "catch_all", "fields": {"code": code}}, body
+
+
+async def test_catch_all_keeps_multiline_strings():
+    """
+    Ensure that the lines of a multi-line string in a nested catch_all block
+    aren't dedented, since their leading whitespace is part of the string,
+    while the rest of the code is.
+    """
+    python_code = (
+        "def f():\n"
+        "    while x:\n"
+        '        s = """\n'
+        "  keep me\n"
+        "        and me\n"
+        '"""\n'
+        "        print(s,\n"
+        "              1)\n"
+    )
+    result = json.loads(py2blocks.py2blocks(python_code))
+    body = result["blocks"]["blocks"][0]["inputs"]["body"]["block"]
+    code = body["fields"]["code"]
+    assert code == (
+        "while x:\n"
+        '    s = """\n'
+        "  keep me\n"
+        "        and me\n"
+        '"""\n'
+        "    print(s,\n"
+        "          1)"
+    ), code
+    # The string is the same as in the original code.
+    original = ast.parse(python_code).body[0].body[0].body[0].value.value
+    assert ast.parse(code).body[0].body[0].value.value == original
+
+
+async def test_catch_all_without_source():
+    """
+    Ensure that the code in a catch_all block is regenerated from the AST if
+    the source code isn't available.
+    """
+    tree = ast.parse("while x:  # Forever.\n    pass")
+    result = py2blocks.traverse(tree)
+    assert result["blocks"]["blocks"][0] == {
+        "type": "catch_all",
+        "fields": {"code": "while x:\n    pass"},
+    }, result
+
+
+async def test_flattened_bool_op():
+    """
+    Ensure that a chain of boolean operations can be flattened into a single
+    BoolOpChain block.
+    """
+    python_code = "a and b and c"
+    result = json.loads(py2blocks.py2blocks(python_code, flatten=True))
+    render_blocks("test_flattened_bool_op", result)
+    assert result == {
+        "blocks": {
+            "blocks": [
+                {
+                    "type": "BoolOpChain",
+                    "extraState": {"items": 3},
+                    "inputs": {
+                        f"input_{i:06}": {
+                            "block": {
+                                "type": "Name",
+                                "fields": {"var": {"name": name}},
+                            }
+                        }
+                        for i, name in enumerate("abc", start=1)
+                    },
+                    "fields": {"op": "And"},
+                }
+            ]
+        }
+    }, result
+
+
+async def test_flattened_compare():
+    """
+    Ensure that a chain of comparisons can be flattened into a single
+    CompareChain block, with a field for each op.
+    """
+    python_code = "1 < 2 > 5"
+    result = json.loads(py2blocks.py2blocks(python_code, flatten=True))
+    render_blocks("test_flattened_compare", result)
+    assert result == {
+        "blocks": {
+            "blocks": [
+                {
+                    "type": "CompareChain",
+                    "extraState": {"items": 3},
+                    "inputs": {
+                        "input_000001": {
+                            "block": {"type": "int", "fields": {"value": 1}}
+                        },
+                        "input_000002": {
+                            "block": {"type": "int", "fields": {"value": 2}}
+                        },
+                        "input_000003": {
+                            "block": {"type": "int", "fields": {"value": 5}}
+                        },
+                    },
+                    "fields": {"op_000001": "Lt", "op_000002": "Gt"},
+                }
+            ]
+        }
+    }, result
+
+
+async def test_flattened_bin_op():
+    """
+    Ensure that a (left to right) chain of the same binary operation can be
+    flattened into a single BinOpChain block, while a parenthesised operand,
+    a different operation or a (right to left) chain of ** are not part of
+    the chain.
+    """
+    python_code = "a - (b - c) - d\nx ** y ** z\n1 + 2 * 3"
+    result = json.loads(py2blocks.py2blocks(python_code, flatten=True))
+    render_blocks("test_flattened_bin_op", result)
+    chain = result["blocks"]["blocks"][0]
+    assert chain["type"] == "BinOpChain", chain
+    assert chain["extraState"] == {"items": 3}, chain
+    assert chain["fields"] == {"op": "Sub"}, chain
+    assert chain["inputs"]["input_000002"]["block"]["type"] == "BinOp", chain
+    power = chain["next"]["block"]
+    assert power["type"] == "BinOp", power
+    assert power["inputs"]["right"]["block"]["type"] == "BinOp", power
+    mixed = power["next"]["block"]
+    assert mixed["type"] == "BinOp", mixed
+    assert mixed["inputs"]["right"]["block"]["type"] == "BinOp", mixed
+
+
+async def test_long_chains_flattened_and_nested():
+    """
+    Ensure that long chains are the same depth whatever their length when
+    flattened, and that the (default) nested output is unchanged.
+    """
+    python_code = " and ".join(f"x{i}" for i in range(500))
+    tree = ast.parse(python_code)
+    flattened = py2blocks.traverse(tree, flatten=True)
+    block = flattened["blocks"]["blocks"][0]
+    assert block["extraState"] == {"items": 500}, block["extraState"]
+    assert len(block["inputs"]) == 500
+    nested = py2blocks.traverse(tree, "stack")
+    block = nested["blocks"]["blocks"][0]
+    for i in range(498):
+        assert block["type"] == "BoolOp", block
+        assert block["inputs"]["left"]["block"]["fields"] == {
+            "var": {"name": f"x{i}"}
+        }
+        block = block["inputs"]["right"]["block"]
+    assert block["inputs"]["right"]["block"]["fields"] == {
+        "var": {"name": "x499"}
+    }
+
+
+async def test_converter_sessions_are_independent():
+    """
+    Ensure that the functions defined by one conversion are not known to any
+    other, in the same session or another one, so converting the same code
+    always gives the same result.
+    """
+    py2blocks.py2blocks("def f():\n    pass")
+    result = json.loads(py2blocks.py2blocks("f()"))
+    assert result["blocks"]["blocks"][0]["type"] == "catch_all", result
+    first = py2blocks.Converter()
+    second = py2blocks.Converter()
+    first.convert("def f():\n    pass")
+    assert "f" in first.user_defined_functions
+    result = json.loads(first.convert("f()"))
+    assert result["blocks"]["blocks"][0]["type"] == "catch_all", result
+    assert first.user_defined_functions == {}
+    result = json.loads(second.convert("f()"))
+    assert result["blocks"]["blocks"][0]["type"] == "catch_all", result
+    assert second.user_defined_functions == {}
+    # A call before the function is defined is never a block.
+    python_code = "f(1)\ndef f(a):\n    return a\nf(2)\n"
+    for converter in (first, py2blocks.Converter(cache_size=100)):
+        expected = py2blocks.py2blocks(python_code)
+        assert converter.convert(python_code) == expected
+        assert converter.convert(python_code) == expected
+        result = json.loads(expected)
+        blocks = result["blocks"]["blocks"][0]
+        assert blocks["type"] == "catch_all", blocks
+        blocks = blocks["next"]["block"]["next"]["block"]
+        assert blocks["type"] == "Call", blocks
+    converter.convert("def g():\n    pass")
+    result = json.loads(converter.convert("g()"))
+    assert result["blocks"]["blocks"][0]["type"] == "catch_all", result
+
+
+async def test_converter_reset():
+    """
+    Ensure that resetting a conversion session forgets everything learnt from
+    the code converted so far, but keeps its options and built-in blocks.
+    """
+    converter = py2blocks.Converter(flatten=True)
+    converter.register_builtin_block("go", {"type": "go_block"})
+    converter.convert("def f():\n    pass\ngo()\nwhile x:\n    pass")
+    assert "f" in converter.user_defined_functions
+    assert converter.conversion_stats["catch_all"] == 1
+    converter.reset()
+    assert converter.user_defined_functions == {}
+    assert converter.conversion_stats == {
+        "nodes": 0,
+        "catch_all": 0,
+        "wasted_visits": 0,
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "cache_hit_rate": 0,
+    }, converter.conversion_stats
+    assert converter.source is None
+    result = json.loads(converter.convert("go()\nf()\na or b or c"))
+    block = result["blocks"]["blocks"][0]
+    assert block["type"] == "go_block", block
+    block = block["next"]["block"]
+    assert block["type"] == "catch_all", block
+    block = block["next"]["block"]
+    assert block["type"] == "BoolOpChain", block
+
+
+async def test_converter_register_builtin_block():
+    """
+    Ensure that a built-in block registered with a conversion session is only
+    used by that session.
+    """
+    converter = py2blocks.Converter()
+    converter.register_builtin_block("go", {"type": "go_block"})
+    assert "go" not in py2blocks.BUILTIN_BLOCKS
+    assert "go" not in py2blocks.BUILTIN_BUILDERS
+    result = json.loads(converter.convert("go()\nprint(1)"))
+    block = result["blocks"]["blocks"][0]
+    assert block == {
+        "type": "go_block",
+        "next": {
+            "block": {
+                "type": "print_block",
+                "inputs": {
+                    "ARG0": {"block": {"type": "int", "fields": {"value": 1}}}
+                },
+            }
+        },
+    }, block
+    result = json.loads(py2blocks.py2blocks("go()"))
+    assert result["blocks"]["blocks"][0]["type"] == "catch_all", result
+
+
+# A batch of sources for convert_many, including calls to functions that are
+# only defined in another source.
+BATCH = [
+    "def f(x):\n    return x\nf(1)",
+    "f(1)",
+    "x = a and b and c",
+    "x = (",
+    "print('hello', sep='')",
+] * 10
+
+
+async def test_convert_many():
+    """
+    Ensure that converting many pieces of code gives the same results, in the
+    same order, as converting each in turn, with each in its own conversion
+    session.
+    """
+    expected = [py2blocks.py2blocks(code) for code in BATCH]
+    result = py2blocks.convert_many(BATCH)
+    assert result == expected, result
+    result = py2blocks.convert_many(BATCH[:3], flatten=True)
+    call = json.loads(result[1])["blocks"]["blocks"][0]
+    assert call["type"] == "catch_all", call
+    assign = json.loads(result[2])["blocks"]["blocks"][0]
+    value = assign["inputs"]["value"]["block"]
+    assert value["type"] == "BoolOpChain", value
+
+
+@upytest.skip(
+    "Threads are not available in Pyodide",
+    skip_when=sys.platform == "emscripten",
+)
+async def test_convert_many_threads():
+    """
+    Ensure that converting many pieces of code across a pool of threads gives
+    the same results, in the same order, as converting each in turn.
+    """
+    expected = [py2blocks.py2blocks(code) for code in BATCH]
+    for workers in (2, 4):
+        result = py2blocks.convert_many(BATCH, workers=workers)
+        assert result == expected, (workers, result)
+
+
+@upytest.skip(
+    "Processes are not available in Pyodide",
+    skip_when=sys.platform == "emscripten",
+)
+async def test_convert_many_processes():
+    """
+    Ensure that converting many pieces of code across a pool of processes
+    gives the same results, in the same order, as converting each in turn,
+    whatever the size of the chunks sent to each process, and that the
+    workers use the current built-in templates.
+    """
+    expected = [py2blocks.py2blocks(code) for code in BATCH]
+    try:
+        for chunksize in (None, 1, 7, 100):
+            result = py2blocks.convert_many(
+                BATCH, workers=2, executor="process", chunksize=chunksize
+            )
+            assert result == expected, (chunksize, result)
+        # Without shared memory (as on Windows), the JSON comes back with
+        # the rest of the workers' results.
+        shared = py2blocks.SHARED_MEMORY
+        py2blocks.SHARED_MEMORY = False
+        try:
+            result = py2blocks.convert_many(
+                BATCH, workers=2, executor="process", chunksize=7
+            )
+            assert result == expected, result
+        finally:
+            py2blocks.SHARED_MEMORY = shared
+        pool = py2blocks.get_process_pool(2)
+        assert py2blocks.get_process_pool(2) is pool
+        py2blocks.register_builtin_block("go", {"type": "go_block"})
+        try:
+            result = py2blocks.convert_many(
+                ["go()"], workers=2, executor="process"
+            )
+            assert result == ['{"blocks": {"blocks": [{"type": "go_block"}]}}']
+            assert py2blocks.get_process_pool(2) is not pool
+        finally:
+            del py2blocks.BUILTIN_BLOCKS["go"]
+            del py2blocks.BUILTIN_BUILDERS["go"]
+    finally:
+        py2blocks.shutdown_process_pool()
+
+
+@upytest.skip(
+    "Processes are not available in Pyodide",
+    skip_when=sys.platform == "emscripten",
+)
+async def test_convert_many_processes_failed_chunk():
+    """
+    Ensure that if a chunk can't be converted by the pool of processes, the
+    error is raised, and the shared memory buffers of the other chunks are
+    still unlinked.
+    """
+    import os
+
+    def listing():
+        if not os.path.isdir("/dev/shm"):
+            # Nothing to check on platforms without a shared memory folder.
+            return set()
+        return set(os.listdir("/dev/shm"))
+
+    before = listing()
+    # Functions can't be sent to a worker process.
+    sources = BATCH[:3] + [lambda: 0] + BATCH * 2
+    try:
+        try:
+            py2blocks.convert_many(
+                sources, workers=2, executor="process", chunksize=1
+            )
+        except Exception:
+            pass
+        else:
+            assert False, "No error raised."
+        # The pool still works, and (by the time it has converted more code)
+        # has finished converting all the other chunks.
+        result = py2blocks.convert_many(BATCH, workers=2, executor="process")
+        assert result == [py2blocks.py2blocks(code) for code in BATCH]
+        leaked = listing() - before
+        assert not leaked, leaked
+    finally:
+        py2blocks.shutdown_process_pool()
+
+
+async def test_convert_many_unknown_executor():
+    """
+    Ensure that asking for a non-existent executor results in a helpful
+    error.
+    """
+    try:
+        py2blocks.convert_many(BATCH, executor="unknown")
+    except ValueError as e:
+        assert str(e) == "Unknown executor: unknown", e
+    else:
+        assert False, "No ValueError raised."
+
+
+async def test_statement_cache():
+    """
+    Ensure that the blocks for top level statements are cached, so only the
+    statements that changed are converted again, even if other statements
+    move or have whitespace or comments added, and that the result is the
+    same as without the cache.
+    """
+    versions = [
+        "def f(x):\n    return x\ny = f(1)\nprint(y)\nwhile y:\n    pass",
+        "def f(x):\n    return x\ny = f(2)\nprint(y)\nwhile y:\n    pass",
+        "def f(x):\n\n    return x  # Same.\n\ny = f(2)\nprint( y )\n"
+        "while y:\n    pass",
+        "print(y)\ndef f(x):\n    return x\ny = f(2)\nwhile y:  # Forever.\n"
+        "    pass",
+    ]
+    converter = py2blocks.Converter(cache_size=100)
+    hits = []
+    for python_code in versions:
+        result = converter.convert(python_code)
+        expected = py2blocks.py2blocks(python_code)
+        assert result == expected, (result, expected)
+        hits.append(converter.conversion_stats["cache_hits"])
+    # The first time around is all misses, then the changed assignment
+    # misses, then all hit, then just the catch_all with a new comment misses.
+    assert hits == [0, 3, 4, 3], hits
+    assert converter.conversion_stats["cache_hit_rate"] == 0.75
+    assert converter.conversion_stats["nodes"] == 1
+
+
+async def test_statement_cache_invalidation():
+    """
+    Ensure that cached blocks aren't used if the built-in templates or the
+    set of user-defined functions change, and that only the given number of
+    statements are cached.
+    """
+    converter = py2blocks.Converter(cache_size=2)
+    python_code = "go(1)\nx = 1\ny = 2\nz = 3"
+    converter.convert(python_code)
+    assert len(converter.statement_cache) == 2
+    result = json.loads(converter.convert(python_code))
+    assert result["blocks"]["blocks"][0]["type"] == "catch_all", result
+    converter.register_builtin_block("go", {"type": "go_block"})
+    result = json.loads(converter.convert(python_code))
+    assert result["blocks"]["blocks"][0]["type"] == "go_block", result
+    assert converter.conversion_stats["cache_hits"] == 0
+    result = json.loads(converter.convert("f()"))
+    assert result["blocks"]["blocks"][0]["type"] == "catch_all", result
+    result = json.loads(converter.convert("def f():\n    pass\nf()"))
+    block = result["blocks"]["blocks"][0]["next"]["block"]
+    assert block["type"] == "Call", result
+    converter.reset()
+    assert len(converter.statement_cache) == 0
+    result = json.loads(converter.convert("f()"))
+    assert result["blocks"]["blocks"][0]["type"] == "catch_all", result
+
+
+async def test_statement_cache_function_invalidation():
+    """
+    Ensure that defining, renaming or deleting a function only converts the
+    cached statements that call it again, and that the result is the same
+    as without the cache.
+    """
+    versions = [
+        "h(1)\nx = 1\ndef h():\n    pass\nh(2)\nprint(x)\n",
+        "h(1)\nx = 1\ndef he():\n    pass\nh(2)\nprint(x)\n",
+        "h(1)\nx = 1\ndef hello():\n    pass\nh(2)\nprint(x)\n",
+        "h(1)\nx = 1\nh(2)\nprint(x)\n",
+        "h(1)\nx = 1\ndef h():\n    pass\nh(2)\nprint(x)\n",
+    ]
+    converter = py2blocks.Converter(cache_size=100)
+    hits = []
+    for python_code in versions:
+        result = converter.convert(python_code)
+        expected = py2blocks.py2blocks(python_code)
+        assert result == expected, (result, expected)
+        hits.append(converter.conversion_stats["cache_hits"])
+        names = [
+            name
+            for name in ("h", "he", "hello")
+            if f"def {name}(" in python_code
+        ]
+        assert list(converter.user_defined_functions) == names
+    # Only the functions that changed, and the calls to h where whether it
+    # has been defined changed, are converted again. Stale names are never
+    # used, so h(2) is a Call block again once h is defined again.
+    assert hits == [0, 3, 4, 4, 4], hits
+
+
+async def test_statement_cache_template_invalidation():
+    """
+    Ensure that registering or replacing a template only invalidates the
+    cached blocks for statements that call the function, and that loading
+    the same template again doesn't invalidate anything.
+    """
+    converter = py2blocks.Converter(cache_size=100)
+    python_code = "go(1)\nprint(go)\nprint(stop(2))\nx = 1\n"
+    converter.convert(python_code)
+    assert converter.function_keys == {"go", "print", "stop"}
+    converter.register_builtin_block("go", {"type": "go_block"})
+    result = json.loads(converter.convert(python_code))
+    assert result["blocks"]["blocks"][0]["type"] == "go_block", result
+    stats = converter.conversion_stats
+    assert (stats["cache_hits"], stats["cache_misses"]) == (3, 1), stats
+    converter.register_builtin_block("go", {"type": "go_block"})
+    converter.convert(python_code)
+    assert stats["cache_hits"] == 4, stats
+    converter.register_builtin_block("stop", {"type": "stop_block"})
+    result = json.loads(converter.convert(python_code))
+    assert (stats["cache_hits"], stats["cache_misses"]) == (3, 1), stats
+    call = result["blocks"]["blocks"][0]["next"]["block"]["next"]["block"]
+    assert call["inputs"]["ARG0"]["block"]["type"] == "stop_block", call
+    assert converter.function_keys == {"go", "print", "stop"}
+
+
+async def test_builtin_fingerprint():
+    """
+    Ensure that the fingerprint of the built-in templates only depends on
+    their names and contents.
+    """
+    fingerprint = py2blocks.builtin_fingerprint()
+    assert py2blocks.builtin_fingerprint() == fingerprint
+    templates = dict(py2blocks.BUILTIN_BLOCKS)
+    assert py2blocks.builtin_fingerprint(templates) == fingerprint
+    templates["go"] = {"type": "go_block"}
+    assert py2blocks.builtin_fingerprint(templates) != fingerprint
+    other = {"go": {"type": "go_block"}, **py2blocks.BUILTIN_BLOCKS}
+    assert py2blocks.builtin_fingerprint(other) == (
+        py2blocks.builtin_fingerprint(templates)
+    )
+    go = py2blocks.template_fingerprint("go", {"type": "go_block"})
+    assert go == py2blocks.template_fingerprint("go", templates["go"])
+    assert go != py2blocks.template_fingerprint("go", {"type": "stop"})
+    assert go != py2blocks.template_fingerprint("stop", {"type": "go_block"})
+
+
+async def test_edit():
+    """
+    Ensure that an edit to a converted document only converts the region of
+    the document containing the edit again, unless it has to convert the
+    whole document, and that the result is the same as converting the whole
+    edited document.
+    """
+    python_code = "x = 1\n\n# Comment.\ny = f(2)\nprint(x, y)\n"
+    converter = py2blocks.Converter()
+    converter.convert(python_code)
+    # Each edit replaces the first occurrence of some text, and is expected
+    # to visit the given number of nodes (None for a syntax error).
+    edits = [
+        # Within one region.
+        ("f(2)", "f(23)", 3),
+        # Insert a statement.
+        ("print", "z = 4\nprint", 7),
+        # Delete a statement, and the comment before it (across a region
+        # boundary, so the whole document is converted).
+        ("\n# Comment.\ny = f(23)\n", "", 10),
+        # Join two regions into one.
+        ("1\nz", "1; z", 10),
+        # Start an unfinished call in the first region.
+        ("x = 1", "(x = 1", None),
+        # Finish it (there are no regions after a syntax error).
+        ("(x = 1", "(f)\nx = 1", 12),
+        # Define a new function, which changes how calls to it are converted.
+        ("(f)", "def f():\n    pass\nf()", 14),
+    ]
+    for old, new, nodes in edits:
+        offset = python_code.index(old)
+        python_code = python_code.replace(old, new, 1)
+        result = converter.edit(offset, len(old), new)
+        assert converter.document.source == python_code, python_code
+        if nodes is None:
+            assert json.loads(result)["error"]["lineno"] == 1, result
+            continue
+        expected = py2blocks.Converter().convert(python_code)
+        assert result == expected, (python_code, result, expected)
+        assert converter.conversion_stats["nodes"] == nodes, (
+            python_code,
+            converter.conversion_stats,
+        )
+
+
+async def test_edit_functions():
+    """
+    Ensure that an edit only knows the functions defined before the edited
+    region, and that adding, removing or renaming a function converts the
+    whole document again, so the result and the session's functions are
+    always the same as converting the edited code in a new session.
+    """
+    for cache_size in (0, 100):
+        python_code = "f(1)\ndef f(a):\n    return a\nf(2)\n"
+        converter = py2blocks.Converter(cache_size=cache_size)
+        converter.convert(python_code)
+        # Each edit replaces the first occurrence of some text, and is
+        # expected to visit the given number of nodes.
+        edits = [
+            # Nothing changes, so the call before the function is still a
+            # catch_all block, and the region is converted again.
+            ("def", "def", 3),
+            ("f(1)", "f(1) ", 2),
+            # Change the function, without renaming it.
+            ("return a", "return a + 1", 5),
+            # Rename the function.
+            ("def f", "def g", 9),
+            # Call it, in a later region.
+            ("f(2)", "g(2)", 3),
+            # Delete the function.
+            ("def g(a):\n    return a + 1\n", "", 4),
+            # Define it again, before the call.
+            ("g(2)", "def g(): pass\ng(2)", 7),
+        ]
+        for old, new, nodes in edits:
+            offset = python_code.index(old)
+            python_code = python_code.replace(old, new, 1)
+            result = converter.edit(offset, len(old), new)
+            expected_converter = py2blocks.Converter()
+            expected = expected_converter.convert(python_code)
+            assert result == expected, (python_code, result, expected)
+            assert (
+                converter.user_defined_functions
+                == expected_converter.user_defined_functions
+            ), python_code
+            if not cache_size:
+                assert converter.conversion_stats["nodes"] == nodes, (
+                    python_code,
+                    converter.conversion_stats,
+                )
+        result = json.loads(result)
+        block = result["blocks"]["blocks"][0]
+        assert block["type"] == "catch_all", block
+        block = block["next"]["block"]["next"]["block"]
+        assert block["type"] == "Call", block
+
+
+async def test_edit_token():
+    """
+    Ensure that an edit within a single number, string or name just patches
+    the field in its block, without converting anything, unless it changes
+    the type of the token. The blocks in the statement cache are unchanged.
+    """
+    python_code = "x = 12\ny = 'ab'\nz = x + 1.5\n"
+    converter = py2blocks.Converter(cache_size=10)
+    original = converter.convert(python_code)
+    # Each edit replaces the first occurrence of some text after the given
+    # offset, and is expected to visit the given number of nodes.
+    edits = [
+        ("12", "123", 0, 0),
+        ("ab", "abc", 0, 0),
+        ("x", "xy", 12, 0),
+        ("1.5", "1.25", 0, 0),
+        # From an int to a float.
+        ("123", "12.3", 0, 3),
+        # An empty string.
+        ("abc", "", 0, 0),
+        # A quote in a string.
+        ("''", "'\"'", 0, 3),
+        # From a name to a keyword.
+        ("xy", "None", 0, 5),
+    ]
+    for old, new, start, nodes in edits:
+        offset = python_code.index(old, start)
+        python_code = python_code[:offset] + python_code[offset:].replace(
+            old, new, 1
+        )
+        result = converter.edit(offset, len(old), new)
+        expected = py2blocks.Converter().convert(python_code)
+        assert result == expected, (python_code, result, expected)
+        assert converter.conversion_stats["nodes"] == nodes, (
+            python_code,
+            converter.conversion_stats,
+        )
+    assert converter.convert("x = 12\ny = 'ab'\nz = x + 1.5\n") == original
+    # A value copied into a field by a template can't be patched.
+    converter.register_builtin_block(
+        "wait",
+        {
+            "type": "wait_block",
+            "fields": {"SECONDS": 0},
+            "field_mapping": {"SECONDS": {"arg_index": 0}},
+            "inputs": {"ARG0": {"block": None}},
+        },
+    )
+    converter.convert("wait(5)\n")
+    result = json.loads(converter.edit(5, 1, "6"))
+    assert converter.conversion_stats["nodes"] == 3, converter.conversion_stats
+    assert result["blocks"]["blocks"][0]["fields"] == {"SECONDS": 6}, result
+
+
+async def test_diff_blocks():
+    """
+    Ensure that the patch between two results moves, inserts, removes and
+    changes just the blocks that are different, and that applying the patch
+    to the first result gives the second.
+    """
+    old = json.loads(py2blocks.py2blocks("a = 1\nb = 2\nc = 3\nprint(a)\n"))
+    new = json.loads(
+        py2blocks.py2blocks("b = 2\nc = 3\na = 1\nprint(a + 1)\nd = 4\n")
+    )
+    patch = py2blocks.diff_blocks(old, new)
+    assert [operation["op"] for operation in patch] == [
+        "move",
+        "insert",
+        "remove",
+        "insert",
+    ], patch
+    assert patch[0] == {"op": "move", "from": [0, 0], "to": [0, 2]}, patch
+    assert patch[1]["path"] == [0, 4], patch
+    assert patch[2] == {"op": "remove", "path": [0, 3, "ARG0", 0]}, patch
+    assert patch[3]["block"]["type"] == "BinOp", patch
+    # The patch is JSON, and is applied to a copy of the old result.
+    patch = json.loads(json.dumps(patch))
+    result = py2blocks.apply_patch(json.loads(json.dumps(old)), patch)
+    assert result == new, result
+    assert py2blocks.diff_blocks(new, new) == []
+
+
+async def test_convert_patch():
+    """
+    Ensure that a session returns a patch from the result it most recently
+    returned, if asked, whether the code is converted or edited. Results
+    with errors are skipped.
+    """
+    converter = py2blocks.Converter()
+    result = json.loads(converter.convert("x = 1\n", patch=True))
+    assert result["patch"] == [
+        {
+            "op": "insert",
+            "path": [0, 0],
+            "block": json.loads(py2blocks.py2blocks("x = 1"))["blocks"][
+                "blocks"
+            ][0],
+        }
+    ], result
+    result = json.loads(converter.convert("x = 2\n", patch=True))
+    change = {"op": "change", "path": [0, 0, "value", 0]}
+    assert result == {"patch": [{**change, "fields": {"value": 2}}]}, result
+    result = json.loads(converter.convert("x = (\n", patch=True))
+    assert "error" in result, result
+    result = json.loads(converter.edit(4, 1, "3", patch=True))
+    assert result == {"patch": [{**change, "fields": {"value": 3}}]}, result
+    result = json.loads(converter.edit(4, 1, "4"))
+    assert result == json.loads(py2blocks.py2blocks("x = 4\n")), result
+    result = json.loads(converter.convert("", patch=True))
+    assert result == {"patch": [{"op": "remove", "path": [0, 0]}]}, result
+
+
+async def test_block_ids():
+    """
+    Ensure that, if asked, every block has a unique id, and that the ids of
+    the blocks in a function stay the same when another function is changed,
+    whether the code is converted or edited.
+    """
+
+    def ids(block, found):
+        while block is not None:
+            found.append(block["id"])
+            for slot in block.get("inputs", {}).values():
+                if "type" not in slot and slot.get("block"):
+                    ids(slot["block"], found)
+            block = block.get("next", {}).get("block")
+        return found
+
+    def function_ids(result):
+        found = ids(result["blocks"]["blocks"][0], [])
+        return found[:6], found[6:12]
+
+    code = (
+        "def f(x):\n"
+        "    return x + 1\n"
+        "\n"
+        "def g(y):\n"
+        "    print(y * 2)\n"
+        "\n"
+        "print(1)\n"
+        "print(1)\n"
+    )
+    converter = py2blocks.Converter(ids=True)
+    result = json.loads(converter.convert(code))
+    found = ids(result["blocks"]["blocks"][0], [])
+    assert len(found) == 16, found
+    assert len(set(found)) == len(found), found
+    # The same statements have the same hash, but a different occurrence.
+    assert found[12].endswith("-0") and found[14].endswith("-1"), found
+    assert found[12].split("-")[0] == found[14].split("-")[0], found
+    f_ids, g_ids = function_ids(result)
+    assert all(block_id.startswith(f_ids[0]) for block_id in f_ids), f_ids
+    # Change f, by converting.
+    new_code = code.replace("x + 1", "x + 10")
+    result = json.loads(converter.convert(new_code))
+    new_f_ids, new_g_ids = function_ids(result)
+    assert new_g_ids == g_ids, new_g_ids
+    assert new_f_ids[0] != f_ids[0], new_f_ids
+    # Change f back, by editing.
+    result = json.loads(converter.edit(new_code.index("10"), 2, "1"))
+    assert function_ids(result) == (f_ids, g_ids), result
+    expected = json.loads(py2blocks.py2blocks(code, ids=True))
+    assert result == expected, result
+
+
+async def test_edit_without_document():
+    """
+    Ensure that an edit can only be made to a converted document, and only
+    within it.
+    """
+    converter = py2blocks.Converter()
+    for edit in [(0, 0, "x"), (1, 0, "x"), (0, 1, "")]:
+        try:
+            converter.edit(*edit)
+        except ValueError:
+            pass
+        else:
+            assert False, f"No ValueError raised for {edit}."
+        converter.convert("")
+
+
+@upytest.skip(
+    "SQLite is not available in Pyodide",
+    skip_when=sys.platform == "emscripten",
+)
+async def test_disk_cache():
+    """
+    Ensure that the disk cache returns the same JSON as converting the code,
+    is shared by all the caches using the same file, depends on the options
+    and the templates for the functions called, and evicts the least
+    recently used results.
+    """
+    import os
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), "cache.db")
+    cache = py2blocks.DiskCache(path)
+    other = py2blocks.DiskCache(path)
+    code = "x = 1 + 2 + 3\nprint(x)\n"
+    try:
+        expected = py2blocks.py2blocks(code)
+        assert py2blocks.py2blocks(code, cache=cache) == expected
+        assert py2blocks.py2blocks(code, cache=cache) == expected
+        assert py2blocks.py2blocks(code, cache=other) == expected
+        flattened = py2blocks.py2blocks(code, flatten=True)
+        assert py2blocks.py2blocks(code, flatten=True, cache=cache) == (
+            flattened
+        )
+        assert cache.stats == {
+            "hits": 1,
+            "misses": 2,
+            "evictions": 0,
+            "invalidations": 0,
+        }, cache.stats
+        assert other.stats["hits"] == 1, other.stats
+        # Only the code that calls a new template is converted again.
+        py2blocks.py2blocks("go()", cache=cache)
+        py2blocks.register_builtin_block("go", {"type": "go_block"})
+        try:
+            assert py2blocks.py2blocks(code, cache=cache) == expected
+            assert cache.stats["hits"] == 2, cache.stats
+            result = py2blocks.py2blocks("go()", cache=cache)
+            assert json.loads(result)["blocks"]["blocks"][0] == {
+                "type": "go_block"
+            }, result
+            assert cache.stats["invalidations"] == 1, cache.stats
+        finally:
+            del py2blocks.BUILTIN_BLOCKS["go"]
+            del py2blocks.BUILTIN_BUILDERS["go"]
+        result = py2blocks.py2blocks("go()", cache=cache)
+        assert result == py2blocks.py2blocks("go()"), result
+        assert cache.stats["invalidations"] == 2, cache.stats
+        assert len(cache) == 3, len(cache)
+        # Only room for about two results.
+        small = py2blocks.DiskCache(path, max_size=400)
+        py2blocks.py2blocks(code, cache=small)
+        py2blocks.py2blocks("print(2)", cache=small)
+        assert small.stats["evictions"] > 0, small.stats
+        assert py2blocks.py2blocks(code, cache=small) == expected
+        assert small.stats["hits"] == 2, small.stats
+        small.close()
+    finally:
+        cache.close()
+        other.close()
+
+
+async def test_convert_tree():
+    """
+    Ensure that code that has already been parsed is converted to the same
+    JSON as the code alone, without changing the AST, and that the ASTs in
+    a parse cache are reused, up to the size of the cache.
+    """
+    python_code = "def f(x):\n    return x + 1\n\nprint(f(2))\n"
+    tree = ast.parse(python_code)
+    dump = ast.dump(tree)
+    expected = py2blocks.py2blocks(python_code)
+    result = py2blocks.py2blocks(python_code, tree=tree)
+    assert result == expected, result
+    assert ast.dump(tree) == dump
+    cache = py2blocks.ParseCache(max_size=2)
+    assert cache.parse(python_code) is cache.parse(python_code)
+    result = py2blocks.py2blocks(python_code, parse_cache=cache)
+    assert result == expected, result
+    assert cache.stats == {"hits": 2, "misses": 1}, cache.stats
+    py2blocks.py2blocks("x = 1", parse_cache=cache)
+    py2blocks.py2blocks("y = 2", parse_cache=cache)
+    assert len(cache) == 2, len(cache)
+    py2blocks.py2blocks(python_code, parse_cache=cache)
+    assert cache.stats == {"hits": 2, "misses": 4}, cache.stats
+    result = json.loads(py2blocks.py2blocks("x = (", parse_cache=cache))
+    assert result["error"]["lineno"] == 1, result
+    assert len(cache) == 2, len(cache)
+
+
+async def test_py2blocks_dict():
+    """
+    Ensure that the Blockly JSON returned as a dict is the same as the
+    decoded JSON string, including for errors, patches and edits.
+    """
+    for python_code in ["x = 1 + 2 + 3\nprint(x)\n", "x = (", ""]:
+        result = py2blocks.py2blocks_dict(python_code, flatten=True)
+        expected = json.loads(py2blocks.py2blocks(python_code, flatten=True))
+        assert result == expected, result
+    # Constants that can't be encoded as JSON are the same error.
+    for python_code, name in [
+        ("x = b'a'", "bytes"),
+        ("x = ...", "ellipsis"),
+        ("print(1j)", "complex"),
+    ]:
+        expected = {"error": f"Object of type {name} is not JSON serializable"}
+        assert json.loads(py2blocks.py2blocks(python_code)) == expected
+        assert py2blocks.py2blocks_dict(python_code) == expected
+    converter = py2blocks.Converter()
+    result = converter.convert_dict("x = 1\n")
+    assert result == json.loads(py2blocks.py2blocks("x = 1\n")), result
+    result = converter.edit_dict(4, 1, "2", patch=True)
+    change = {"op": "change", "path": [0, 0, "value", 0]}
+    assert result == {"patch": [{**change, "fields": {"value": 2}}]}, result
+    result = converter.edit_dict(4, 1, "(")
+    assert result["error"]["lineno"] == 1, result
+    result = json.loads(converter.edit(4, 1, "3", patch=True))
+    assert result == {"patch": [{**change, "fields": {"value": 3}}]}, result
+
+
+async def test_edit_dict_keeps_earlier_results():
+    """
+    Ensure that the dicts returned for earlier conversions and edits are
+    unchanged by later edits (whether fields are patched in place, or
+    regions are converted again), so they can be kept to diff or undo.
+    """
+    python_code = "x = 1\nprint(x)\ny = 2\nif y:\n    z = 3\n"
+    for ids in (False, True):
+        converter = py2blocks.Converter(ids=ids, cache_size=16)
+        results = [converter.convert_dict(python_code)]
+        for edit in [
+            (4, 1, "5"),
+            (len(python_code) - 2, 1, "4"),
+            (0, 0, "w = 0\n"),
+            (6, 0, "a\n"),
+        ]:
+            results.append(converter.edit_dict(*edit))
+        expected = [json.loads(json.dumps(result)) for result in results]
+        assert expected[0] == py2blocks.py2blocks_dict(python_code, ids=ids)
+        for i in range(4):
+            assert results[i] is not results[i + 1]
+            assert py2blocks.diff_blocks(results[i], results[i + 1])
+        converter.edit_dict(0, 6, "")
+        converter.edit_dict(4, 1, "6")
+        for result, snapshot in zip(results, expected):
+            assert result == snapshot, result
+
+
+async def test_stream_blocks():
+    """
+    Ensure that the JSON for each top level statement is generated in turn,
+    and that writing the chunks gives exactly the same JSON as py2blocks,
+    including for errors and empty code.
+    """
+    import io
+
+    python_code = "def f(x):\n    return x\n\nf(1)\nprint(f(2))\nf(1)\n"
+    chunks = list(py2blocks.stream_blocks(python_code))
+    assert len(chunks) == 4, chunks
+    blocks = [json.loads(chunk) for chunk in chunks]
+    assert [block["type"] for block in blocks] == [
+        "FunctionDef",
+        "Call",
+        "print_block",
+        "Call",
+    ], blocks
+    assert all("next" not in block for block in blocks), blocks
+    for python_code in [python_code, "", "x = (", "x = 1 + 2 + 3"]:
+        for flatten, ids in [(False, False), (True, True)]:
+            output = io.StringIO()
+            py2blocks.write_blocks(
+                py2blocks.stream_blocks(python_code, flatten=flatten, ids=ids),
+                output,
+            )
+            expected = py2blocks.py2blocks(
+                python_code, flatten=flatten, ids=ids
+            )
+            assert output.getvalue() == expected, output.getvalue()
+
+
+async def test_py2blocks_into():
+    """
+    Ensure that the JSON written into a buffer (an io.StringIO or bytearray)
+    is exactly the same as from py2blocks, including for errors (even after
+    some of the JSON has been written), and that the buffer is emptied
+    first, so it can be reused.
+    """
+    import io
+
+    output = io.StringIO()
+    data = bytearray()
+    for python_code in [
+        "def f(x):\n    return x\n\nf(1)\nprint(f(2))\nx = 1 + 2 + 3\n",
+        "x = 1",
+        "",
+        "x = (",
+        "x = 1\n" * 3000,
+    ]:
+        for flatten, ids in [(False, False), (True, True)]:
+            expected = py2blocks.py2blocks(
+                python_code, flatten=flatten, ids=ids
+            )
+            result = py2blocks.py2blocks_into(
+                python_code, output, flatten=flatten, ids=ids
+            )
+            assert result is output
+            assert output.getvalue() == expected, output.getvalue()[:100]
+            result = py2blocks.py2blocks_into(
+                python_code, data, flatten=flatten, ids=ids
+            )
+            assert result is data
+            assert data.decode("utf-8") == expected, data[:100]
+
+    # An error after the first statement has been written.
+    def handle_global(converter, node, block):
+        raise ValueError("No globals")
+
+    py2blocks.register_node_handler(ast.Global, handle_global)
+    try:
+        python_code = "x = 1\nglobal x\n"
+        expected = py2blocks.py2blocks(python_code)
+        assert expected == '{"error": "No globals"}', expected
+        py2blocks.py2blocks_into(python_code, output)
+        assert output.getvalue() == expected, output.getvalue()
+        py2blocks.py2blocks_into(python_code, data)
+        assert data.decode("utf-8") == expected, data
+    finally:
+        del py2blocks.NODE_HANDLERS[ast.Global]
+    # Each conversion only knows the functions defined by its own code.
+    converter = py2blocks.Converter()
+    converter.write("def f(x):\n    return x\nf(1)\n", output)
+    assert '"catch_all"' not in output.getvalue(), output.getvalue()
+    converter.write("f(1)\n", output)
+    assert output.getvalue() == py2blocks.py2blocks("f(1)\n")
+    assert '"catch_all"' in output.getvalue(), output.getvalue()
+
+
+async def test_binary_encoding():
+    """
+    Ensure that the compact binary encoding of the Blockly JSON decodes to
+    exactly the same result (with the keys in the same order), that each
+    string is only stored once, and that invalid data is rejected.
+    """
+    python_code = (
+        "def f(x, y=1.5):\n"
+        "    return x * -7 + 10 ** 20\n"
+        "\n"
+        "print(f(1, y=True), 'héllo', None, [1, 2], {'a': 2})\n"
+        "print(f(1))\n"
+        "while x:\n"
+        "    pass\n"
+    )
+    for code in [python_code, "", "x = ("]:
+        for flatten, ids in [(False, False), (True, True)]:
+            expected = py2blocks.py2blocks_dict(code, flatten=flatten, ids=ids)
+            data = py2blocks.py2blocks_binary(code, flatten=flatten, ids=ids)
+            assert type(data) is bytes
+            result = py2blocks.decode_blocks(data)
+            assert result == expected, result
+            assert json.dumps(result) == json.dumps(expected)
+    value = {"a": [None, True, False, 0, -1, 2**28, -(2**40), 0.1, ""]}
+    data = py2blocks.encode_blocks(value)
+    assert json.dumps(py2blocks.decode_blocks(data)) == json.dumps(value)
+    # The header: the magic number, then the number of strings, words of
+    # records and bytes of UTF-8 in the string table.
+    data = py2blocks.encode_blocks({"type": "print", "next": {"type": "x"}})
+    header = [int.from_bytes(data[i : i + 4], "little") for i in (4, 8, 12)]
+    assert data[:4] == b"PYB2", data
+    assert header == [4, 7, 14], header
+    assert len(data) == 16 + 4 * 5 + 16 + 4 * 7, data
+    # Chains that are too long for json.dumps (and for comparing dicts).
+    data = py2blocks.py2blocks_binary("x = 1\n" * 3000)
+    assert py2blocks.encode_blocks(py2blocks.decode_blocks(data)) == data
+    for invalid in [b"", b"{}", data[:-4], data + b"\0\0\0\0"]:
+        try:
+            py2blocks.decode_blocks(invalid)
+        except ValueError:
+            pass
+        else:
+            assert False, f"No ValueError raised for {invalid[:8]}."
+    try:
+        py2blocks.encode_blocks({"blocks": {1, 2}})
+    except TypeError:
+        pass
+    else:
+        assert False, "No TypeError raised."
+    # Errors while converting or encoding are returned, as for py2blocks.
+    data = py2blocks.py2blocks_binary("x = b'a'")
+    expected = json.loads(py2blocks.py2blocks("x = b'a'"))
+    assert py2blocks.decode_blocks(data) == expected, data
+
+    def handle_global(converter, node, block):
+        block["fields"] = {"names": set(node.names)}
+        return block
+
+    py2blocks.register_node_handler(ast.Global, handle_global)
+    try:
+        data = py2blocks.py2blocks_binary("global x\n")
+        expected = json.loads(py2blocks.py2blocks("global x\n"))
+        assert expected == {
+            "error": "Object of type set is not JSON serializable"
+        }, expected
+        assert py2blocks.decode_blocks(data) == expected, data
+    finally:
+        del py2blocks.NODE_HANDLERS[ast.Global]
+
+
+async def test_binary_dedup():
+    """
+    Ensure that repeated subtrees are only encoded once, when deduplicated,
+    and are expanded back to exactly the same Blockly JSON, without mixing
+    up values that are equal in Python but not in JSON.
+    """
+    body = "    print(x)\n" * 3000
+    python_code = (
+        "print(a.b.c + 1)\n"
+        "print(a.b.c + 1)\n"
+        "print(a.b.c + 1.0)\n"
+        "print(a.b.c + True)\n"
+        "print([], {})\n"
+        f"def f():\n{body}def g():\n{body}f()\n"
+    )
+    for flatten, ids in [(False, False), (True, True)]:
+        data = py2blocks.py2blocks_binary(
+            python_code, flatten=flatten, ids=ids
+        )
+        deduped = py2blocks.py2blocks_binary(
+            python_code, flatten=flatten, ids=ids, dedup=True
+        )
+        assert len(deduped) < len(data), (len(deduped), len(data))
+        # The same Blockly JSON as without deduplication.
+        result = py2blocks.decode_blocks(deduped)
+        assert py2blocks.encode_blocks(result) == data
+        if not ids:
+            # The body of g is a reference to the (same) body of f.
+            assert len(deduped) < len(data) / 3, (len(deduped), len(data))
+            blocks = result["blocks"]["blocks"][0]
+            bodies = []
+            while blocks:
+                if blocks["type"] == "FunctionDef":
+                    bodies.append(blocks["inputs"]["body"])
+                blocks = blocks.get("next", {}).get("block")
+            assert len(bodies) == 2 and bodies[0] is bodies[1], bodies
+    result = py2blocks.py2blocks_dict("print(1, 1.0, True, [], {})")
+    data = py2blocks.encode_blocks(result, dedup=True)
+    assert json.dumps(py2blocks.decode_blocks(data)) == json.dumps(result)
+
+
+async def test_long_chains():
+    """
+    Ensure that modules (and bodies) with too many statements for json.dumps
+    to encode the chain of blocks, linked via "next", are still encoded as
+    exactly the same JSON, including a module of 100,000 statements, and
+    chains of blocks that contain very deep expressions.
+    """
+    import io
+
+    deep = "x = " + " + ".join(["a"] * 400) + "\n"
+    for python_code in [
+        "x = 1\n" * 3000,
+        "def f():\n" + "    x = 1\n" * 3000 + "f()\n" * 10,
+        deep * 5 + "x = 1\n" * 3000 + deep,
+    ]:
+        result = py2blocks.py2blocks(python_code, engine="stack")
+        output = io.StringIO()
+        py2blocks.write_blocks(
+            py2blocks.stream_blocks(python_code, engine="stack"), output
+        )
+        assert result == output.getvalue(), result[:100]
+        assert '"error"' not in result[:100], result[:100]
+    assert result.count('"next": {"block": ') == 3005, result[:100]
+    assert result.count('"type": "BinOp"') == 399 * 6, result[:100]
+    python_code = "x = 1\nprint(x)\n" * 50000
+    result = py2blocks.py2blocks(python_code)
+    start = '{"blocks": {"blocks": [{"type": "Assign", '
+    assert result.startswith(start), result[:100]
+    assert result.endswith("}}}" + "}}" * 99999 + "]}}"), result[-100:]
+    assert result.count('"next": {"block": {"type": "print_block"') == 50000
+    assert result.count('"next": {"block": {"type": "Assign"') == 49999
@@ -0,0 +1,1016 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the performance sensitive parts of py2blocks.
+
+Run all the benchmarks with:
+
+    python utils/benchmark.py
+
+Or run specific benchmarks by name:
+
+    python utils/benchmark.py dispatch
+"""
+
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+import textwrap
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import py2blocks  # noqa: E402
+
+# A small program, typical of the code written by students, that exercises
+# most of the supported (and some unsupported) node types.
+SAMPLE = """
+def average(numbers, default=0):
+    if not numbers:
+        return default
+    total = 0
+    for n in numbers:
+        total += n
+    return total / len(numbers)
+
+
+scores = [12, 15, 9, 20, 17]
+names = {"ada": 1, "grace": 2, **extra}
+result = average(scores, default=-1)
+passed = [s for s in scores if s >= 10]
+print(f"Average: {result:.2f}", len(passed), sep=", ")
+print(names["ada"], scores[1:3], scores[::2])
+label = "high" if result > 15 and len(passed) > 3 else "low"
+greeting = "Hello, " + names.get("ada", "nobody") + "!"
+ratio = (result - 10) * 2 / (1 + len(scores)) ** 2
+ok = 0 < result < 20 or not passed
+print(label, greeting, ratio, ok, sep=" | ")
+"""
+
+
+def sample_program(copies=50):
+    """
+    Return the source of a larger program made from copies of the sample.
+    """
+    return "\n".join(SAMPLE for _ in range(copies))
+
+
+def timeit(function, repeat=5, number=1):
+    """
+    Return the best time (in seconds) for a call to the function, taken from
+    repeat rounds of number calls.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def report(name, seconds, per=None, unit="call"):
+    """
+    Print the timing for a named measurement.
+    """
+    if per:
+        print(f"  {name:<40} {seconds * 1e9 / per:10.1f} ns/{unit}")
+    else:
+        print(f"  {name:<40} {seconds * 1e3:10.3f} ms")
+
+
+# The order of the isinstance checks in the chain that traverse_node used
+# before node handlers were dispatched by type.
+ISINSTANCE_CHAIN = (
+    ast.Pass,
+    ast.FunctionDef,
+    ast.Return,
+    ast.Constant,
+    ast.Expr,
+    ast.FormattedValue,
+    ast.JoinedStr,
+    (ast.List, ast.Tuple, ast.Set),
+    ast.Dict,
+    ast.Delete,
+    ast.AugAssign,
+    ast.Name,
+    ast.BinOp,
+    ast.BoolOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.IfExp,
+    ast.Attribute,
+    ast.NamedExpr,
+    ast.Subscript,
+    ast.Slice,
+    (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp),
+    (ast.Assign, ast.AnnAssign),
+    ast.Call,
+)
+
+
+def bench_dispatch():
+    """
+    Per-node cost of finding how to convert a node: the old chain of
+    isinstance checks against the NODE_HANDLERS lookup.
+    """
+    nodes = [
+        node
+        for node in ast.walk(ast.parse(sample_program()))
+        if isinstance(node, (ast.stmt, ast.expr))
+    ]
+
+    def isinstance_chain():
+        for node in nodes:
+            for rule in ISINSTANCE_CHAIN:
+                if isinstance(node, rule):
+                    break
+
+    def handler_lookup():
+        handlers = py2blocks.NODE_HANDLERS
+        catch_all = py2blocks.catch_all
+        for node in nodes:
+            handlers.get(type(node), catch_all)
+
+    report("isinstance chain", timeit(isinstance_chain), len(nodes), "node")
+    report("NODE_HANDLERS lookup", timeit(handler_lookup), len(nodes), "node")
+    tree = ast.parse(sample_program())
+    for engine in py2blocks.ENGINES:
+        report(
+            f"traverse ({engine} engine)",
+            timeit(lambda: py2blocks.traverse(tree, engine)),
+        )
+
+
+# A template in the style of those registered for the invent framework, with
+# field mappings, shadow blocks and keyword argument slots.
+TEMPLATE = {
+    "type": "invent_publish",
+    "fields": {"CHANNEL": "", "RETAIN": "FALSE"},
+    "field_mapping": {
+        "CHANNEL": {"arg_index": 0},
+        "RETAIN": {"kwarg_name": "retain"},
+    },
+    "inputs": {
+        "ARG0": {"shadow": {"type": "str", "fields": {"value": ""}}},
+        "ARG1": {"shadow": {"type": "str", "fields": {"value": "message"}}},
+        "KWARG_delay": {"shadow": {"type": "int", "fields": {"value": 0}}},
+    },
+    "extraState": {"options": [{"name": "retain"}, {"name": "delay"}]},
+}
+
+
+def bench_templates():
+    """
+    Per-call cost of building a block from a built-in template: the deep
+    copying apply_template against the builder from compile_template.
+    """
+    call = ast.parse("publish('news', message, delay=5, retain=True)")
+    node = call.body[0].value
+    converter = py2blocks.Converter()
+    arg_blocks = [converter.traverse_node(arg) for arg in node.args]
+    kwarg_blocks = [
+        (kw.arg, converter.traverse_node(kw.value)) for kw in node.keywords
+    ]
+    builder = py2blocks.compile_template(TEMPLATE)
+    assert builder(arg_blocks, kwarg_blocks) == py2blocks.apply_template(
+        TEMPLATE, arg_blocks, kwarg_blocks
+    )
+    number = 10_000
+    report(
+        "apply_template (deepcopy)",
+        timeit(
+            lambda: py2blocks.apply_template(
+                TEMPLATE, arg_blocks, kwarg_blocks
+            ),
+            number=number,
+        ),
+        1,
+    )
+    report(
+        "compiled builder",
+        timeit(lambda: builder(arg_blocks, kwarg_blocks), number=number),
+        1,
+    )
+    report(
+        "compile_template (once per template)",
+        timeit(lambda: py2blocks.compile_template(TEMPLATE), number=number),
+        1,
+    )
+
+
+def bench_nested_calls():
+    """
+    Cost of converting nested calls to a user-defined function, such as
+    f(f(f(x))), by depth of nesting. It should grow linearly with the depth.
+    """
+    for depth in (5, 10, 15, 20, 40, 80):
+        python_code = (
+            "def f(x):\n    return x\n" + "f(" * depth + "x" + ")" * depth
+        )
+        tree = ast.parse(python_code)
+        report(
+            f"depth {depth}",
+            timeit(lambda: py2blocks.traverse(tree)),
+            depth,
+            "call",
+        )
+
+
+def bench_catch_all():
+    """
+    Cost of converting a program full of calls to unknown functions (which
+    become catch_all blocks): converting the arguments before deciding the
+    call is a catch_all (as before) against deciding first.
+    """
+    unknown = (
+        "plot([x * 2 for x in range(10) if x], {'a': [1, 2, 3]}, "
+        "title=f'{name!r}: {value:>10}', scale=(1 + 2) * 3)\n"
+    )
+    tree = ast.parse(sample_program(10) + unknown * 500)
+    converter = py2blocks.Converter()
+
+    def convert_arguments_first(converter, node, block):
+        # How calls were handled before: convert all the arguments, then
+        # decide.
+        for arg in node.args:
+            yield arg
+        for keyword in node.keywords:
+            yield keyword.value
+        return (yield from handle_call(converter, node, block))
+
+    handle_call = py2blocks.NODE_HANDLERS[ast.Call]
+    py2blocks.register_node_handler(ast.Call, convert_arguments_first)
+    try:
+        seconds = timeit(lambda: converter.traverse(tree))
+        report("convert arguments, then decide", seconds)
+        print(f"    {converter.conversion_stats}")
+    finally:
+        py2blocks.register_node_handler(ast.Call, handle_call)
+    seconds = timeit(lambda: converter.traverse(tree))
+    report("decide first (will_catch_all)", seconds)
+    print(f"    {converter.conversion_stats}")
+
+
+# Code made up of statements that become catch_all blocks.
+UNSUPPORTED = """
+class Shape:
+    def __init__(self, sides):  # Store the number of sides.
+        self.sides = sides
+
+for shape in [Shape(3), Shape(4), Shape(5)]:
+    if shape.sides > 3:
+        print("Polygon with", shape.sides, "sides")
+    else:
+        print("Triangle")
+
+try:
+    import turtle
+except ImportError:
+    turtle = None
+
+with open("shapes.txt", "w") as f:
+    while True:
+        f.write("square\\n")
+        break
+"""
+
+
+def bench_catch_all_source():
+    """
+    Cost of converting code made up of statements that become catch_all
+    blocks: with the code regenerated via ast.unparse against the code taken
+    from the original source.
+    """
+    python_code = UNSUPPORTED * 200
+    tree = ast.parse(python_code)
+    report(
+        "ast.unparse (no source)",
+        timeit(lambda: py2blocks.traverse(tree)),
+    )
+    report(
+        "source segment",
+        timeit(lambda: py2blocks.traverse(tree, source=python_code)),
+    )
+    report(
+        "  (of which indexing the source)",
+        timeit(lambda: py2blocks.SourceIndex(python_code)),
+    )
+
+
+def depth(block):
+    """
+    Return the depth of nesting of the given (JSON) structure.
+    """
+    deepest = 0
+    pending = [(block, 1)]
+    while pending:
+        value, level = pending.pop()
+        deepest = max(deepest, level)
+        if isinstance(value, dict):
+            pending.extend((item, level + 1) for item in value.values())
+        elif isinstance(value, list):
+            pending.extend((item, level + 1) for item in value)
+    return deepest
+
+
+def bench_chains():
+    """
+    Cost of converting long chains of operations (a and b and ..., 0 < a <
+    b < ... and a + b + ...), nested (the default) and flattened.
+    """
+    for length in (10, 100, 400):
+        names = [f"x{i}" for i in range(length)]
+        python_code = "\n".join(
+            [
+                " and ".join(names),
+                " < ".join(names),
+                " + ".join(names),
+            ]
+        )
+        tree = ast.parse(python_code)
+        for flatten in (False, True):
+            seconds = timeit(
+                lambda: py2blocks.traverse(tree, "stack", flatten=flatten)
+            )
+            result = py2blocks.traverse(tree, "stack", flatten=flatten)
+            report(
+                f"length {length}, {'flattened' if flatten else 'nested'}"
+                f" (depth {depth(result)})",
+                seconds,
+                3 * length,
+                "item",
+            )
+
+
+def submissions(count):
+    """
+    Return a corpus of the given number of small programs, like a batch of
+    classroom submissions.
+    """
+    return [
+        sample_program(2).replace("average", f"average_{i}")
+        for i in range(count)
+    ]
+
+
+def bench_convert_many():
+    """
+    Throughput of converting a batch of 200 submissions with convert_many, by
+    number of worker threads. It scales with the number of cores on a
+    free-threaded (no GIL) build of Python, but not with the GIL.
+    """
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(
+        f"    Python {sys.version.split()[0]}, "
+        f"GIL {'enabled' if is_gil_enabled else 'disabled'}, "
+        f"{os.cpu_count()} cores"
+    )
+    sources = submissions(200)
+    serial = None
+    for workers in (1, 2, 4, 8):
+        seconds = timeit(
+            lambda: py2blocks.convert_many(sources, workers=workers),
+            repeat=3,
+        )
+        serial = serial or seconds
+        report(f"{workers} workers ({serial / seconds:.2f}x)", seconds)
+
+
+def bench_convert_many_processes():
+    """
+    Throughput of converting a corpus of 10,000 submissions with convert_many
+    and the "process" executor (a warm pool of worker processes, returning
+    JSON via shared memory), against converting each in turn.
+    """
+    cores = os.cpu_count()
+    print(f"    Python {sys.version.split()[0]}, {cores} cores")
+    sources = submissions(10_000)
+    seconds = timeit(lambda: py2blocks.convert_many(sources), repeat=1)
+    report("in turn", seconds)
+    print(f"    {len(sources) / seconds:.0f} files/s")
+    try:
+        start = time.perf_counter()
+        py2blocks.get_process_pool(cores)
+        py2blocks.convert_many(sources[:cores], cores, executor="process")
+        report("starting the pool", time.perf_counter() - start)
+        for chunksize in (None, 10, 1000):
+            seconds = timeit(
+                lambda: py2blocks.convert_many(
+                    sources, cores, executor="process", chunksize=chunksize
+                ),
+                repeat=1,
+            )
+            report(f"{cores} processes, chunksize {chunksize}", seconds)
+            print(f"    {len(sources) / seconds / cores:.0f} files/s per core")
+    finally:
+        py2blocks.shutdown_process_pool()
+
+
+def bench_parse():
+    """
+    Split of the cost of py2blocks between parsing, traversal and JSON
+    encoding for large programs, and the cost of py2blocks for code that
+    has already been parsed (passing its tree) or is in a warm parse cache.
+    """
+    for name, python_code in [
+        ("sample", sample_program(20)),
+        ("functions", functions_program()),
+    ]:
+        print(f"    {name}: {python_code.count(chr(10))} lines")
+        tree = ast.parse(python_code)
+        result = py2blocks.traverse(tree, source=python_code)
+        cache = py2blocks.ParseCache()
+        cache.parse(python_code)
+        for label, function in [
+            ("ast.parse", lambda: ast.parse(python_code)),
+            (
+                "traverse",
+                lambda: py2blocks.traverse(tree, source=python_code),
+            ),
+            ("json.dumps", lambda: json.dumps(result)),
+            ("py2blocks", lambda: py2blocks.py2blocks(python_code)),
+            (
+                "py2blocks, tree",
+                lambda: py2blocks.py2blocks(python_code, tree=tree),
+            ),
+            (
+                "py2blocks, warm parse cache",
+                lambda: py2blocks.py2blocks(python_code, parse_cache=cache),
+            ),
+        ]:
+            report(f"{name}, {label}", timeit(function, repeat=3))
+
+
+def bench_dict():
+    """
+    End-to-end time and peak memory (traced by tracemalloc, which is timed
+    separately) to get the Blockly JSON for a large program as Python
+    objects: by decoding the string from py2blocks (as a caller that sends
+    it on as objects must), against py2blocks_dict, which never encodes it.
+    """
+    import tracemalloc
+
+    for name, python_code in [
+        ("sample", sample_program(20)),
+        ("functions", functions_program()),
+    ]:
+        for label, function in [
+            (
+                "json.loads(py2blocks)",
+                lambda: json.loads(py2blocks.py2blocks(python_code)),
+            ),
+            ("py2blocks_dict", lambda: py2blocks.py2blocks_dict(python_code)),
+        ]:
+            seconds = timeit(function, repeat=3)
+            tracemalloc.start()
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report(f"{name}, {label}", seconds)
+            print(f"    peak {peak / 1024 / 1024:.1f} MB")
+
+
+def bench_stream():
+    """
+    Time to the first byte, total time and peak memory (traced by
+    tracemalloc, which is timed separately) to write the Blockly JSON for
+    a large generated program (of about 5000 and 20000 lines) to a file:
+    with py2blocks, and streamed via stream_blocks and write_blocks.
+    """
+    import tracemalloc
+
+    class File:
+        """
+        A file that only counts the characters written to it, and notes the
+        time of the first write.
+        """
+
+        def __init__(self):
+            self.size = 0
+            self.first = None
+
+        def write(self, text):
+            if self.first is None:
+                self.first = time.perf_counter()
+            self.size += len(text)
+
+    def write_py2blocks(python_code, file):
+        file.write(py2blocks.py2blocks(python_code))
+
+    def write_stream(python_code, file):
+        py2blocks.write_blocks(py2blocks.stream_blocks(python_code), file)
+
+    for count in (240, 900):
+        python_code = functions_program(count)
+        print(f"    {python_code.count(chr(10))} lines")
+        for name, write in [
+            ("py2blocks", write_py2blocks),
+            ("stream_blocks", write_stream),
+        ]:
+            file = File()
+            start = time.perf_counter()
+            write(python_code, file)
+            end = time.perf_counter()
+            tracemalloc.start()
+            write(python_code, File())
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            report(f"{name}, first byte", file.first - start)
+            report(f"{name}, total", end - start)
+            print(
+                f"    {file.size / 1024 / 1024:.1f} MB written, "
+                f"peak {peak / 1024 / 1024:.1f} MB"
+            )
+
+
+def bench_long_chains():
+    """
+    Cost of encoding the Blockly JSON for modules with long chains of top
+    level statements (linked via "next"), which json.dumps can only encode
+    up to a few hundred statements, so longer chains are encoded with an
+    explicit stack.
+    """
+    for count in (200, 5000, 100000):
+        python_code = "x = 1\nprint(x)\n" * (count // 2)
+        result = py2blocks.traverse(ast.parse(python_code), source=python_code)
+        seconds = timeit(lambda: py2blocks._dumps(result), repeat=3)
+        report(f"{count} statements, encode", seconds)
+        report(f"{count} statements, encode", seconds, per=count, unit="stmt")
+        if count == 200:
+            seconds = timeit(lambda: json.dumps(result), repeat=3)
+            report(f"{count} statements, json.dumps", seconds)
+
+
+def bench_buffer():
+    """
+    Throughput and peak memory (traced by tracemalloc, which is timed
+    separately) to encode the Blockly JSON for a large generated program
+    (of about 5000 lines), from the same AST: via json.dumps of the result
+    of traverse, and written into a reused io.StringIO or bytearray by
+    py2blocks_into.
+    """
+    import io
+    import tracemalloc
+
+    python_code = functions_program(240)
+    tree = ast.parse(python_code)
+    output = io.StringIO()
+    data = bytearray()
+    for name, convert in [
+        (
+            "json.dumps(traverse)",
+            lambda: json.dumps(py2blocks.traverse(tree, source=python_code)),
+        ),
+        (
+            "py2blocks_into, StringIO",
+            lambda: py2blocks.py2blocks_into(python_code, output, tree=tree),
+        ),
+        (
+            "py2blocks_into, bytearray",
+            lambda: py2blocks.py2blocks_into(python_code, data, tree=tree),
+        ),
+    ]:
+        seconds = timeit(convert, repeat=3)
+        tracemalloc.start()
+        convert()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report(name, seconds)
+        print(
+            f"    {len(python_code) / seconds / 1024 / 1024:.2f} MB/s of "
+            f"code, peak {peak / 1024 / 1024:.1f} MB"
+        )
+
+
+def bench_binary():
+    """
+    Size per block and time to encode (and decode) the Blockly JSON for the
+    sample program and a large generated program (of about 5000 lines):
+    as JSON, via json.dumps, and in the compact binary encoding, via
+    encode_blocks (and the pure Python reference decoder, decode_blocks).
+    """
+    for name, python_code in [
+        ("sample", SAMPLE),
+        ("5000 lines", functions_program(240)),
+    ]:
+        result = py2blocks.py2blocks_dict(python_code)
+        text = json.dumps(result)
+        data = py2blocks.encode_blocks(result)
+        count = text.count('"type": ')
+        print(
+            f"    {name}: {count} blocks, "
+            f"JSON {len(text) / count:.1f} bytes/block, "
+            f"binary {len(data) / count:.1f} bytes/block"
+        )
+        report(f"{name}, json.dumps", timeit(lambda: json.dumps(result)))
+        report(
+            f"{name}, encode_blocks",
+            timeit(lambda: py2blocks.encode_blocks(result)),
+        )
+        report(f"{name}, json.loads", timeit(lambda: json.loads(text)))
+        report(
+            f"{name}, decode_blocks",
+            timeit(lambda: py2blocks.decode_blocks(data)),
+        )
+
+
+def bench_dedup():
+    """
+    Total size and end-to-end time (converting and encoding, then decoding)
+    for a corpus of 200 submissions and a large generated program (of about
+    5000 lines): as JSON, and in the binary encoding without and with the
+    repeated subtrees deduplicated.
+    """
+    for name, sources in [
+        ("submissions", submissions(200)),
+        ("5000 lines", [functions_program(240)]),
+    ]:
+        print(f"    {name}:")
+        json_size = None
+        for label, encode, decode in [
+            ("JSON", py2blocks.py2blocks, json.loads),
+            ("binary", py2blocks.py2blocks_binary, py2blocks.decode_blocks),
+            (
+                "binary, dedup",
+                lambda code: py2blocks.py2blocks_binary(code, dedup=True),
+                py2blocks.decode_blocks,
+            ),
+        ]:
+            size = sum(len(encode(code)) for code in sources)
+            json_size = json_size or size
+            print(
+                f"    {label}: {size / 1024:.1f} KB "
+                f"({size / json_size:.0%} of JSON)"
+            )
+            report(
+                f"{label}, encode and decode",
+                timeit(
+                    lambda: [decode(encode(code)) for code in sources],
+                    repeat=3,
+                ),
+            )
+
+
+def keystrokes(python_code, count):
+    """
+    Return versions of the code as if it were being edited, one keystroke at
+    a time: each version changes a digit in a (different) number.
+    """
+    digits = [i for i, char in enumerate(python_code) if char.isdigit()]
+    versions = []
+    for n in range(count):
+        i = digits[(n * 7919) % len(digits)]
+        digit = str((int(python_code[i]) + 1) % 10)
+        python_code = python_code[:i] + digit + python_code[i + 1 :]
+        versions.append(python_code)
+    return versions
+
+
+def bench_statement_cache():
+    """
+    Per-keystroke cost of converting a program (of 240 statements) in an
+    editor that re-converts it on every keystroke: with a new session each
+    time against a session with a statement cache, both end-to-end and just
+    for traverse (without parsing or JSON encoding).
+    """
+    python_code = sample_program(20)
+    versions = keystrokes(python_code, 100)
+    trees = [ast.parse(version) for version in versions]
+
+    def run(name, convert, keystrokes):
+        start = time.perf_counter()
+        for keystroke in keystrokes:
+            convert(*keystroke)
+        seconds = (time.perf_counter() - start) / len(keystrokes)
+        report(name, seconds)
+
+    converter = py2blocks.Converter(cache_size=1000)
+    converter.convert(python_code)
+    run(
+        "py2blocks, no cache",
+        py2blocks.py2blocks,
+        [(version,) for version in versions],
+    )
+    run(
+        "py2blocks, statement cache",
+        converter.convert,
+        [(version,) for version in versions],
+    )
+    run(
+        "traverse, no cache",
+        lambda tree, version: py2blocks.traverse(tree, source=version),
+        list(zip(trees, versions)),
+    )
+    converter = py2blocks.Converter(cache_size=1000)
+    converter.convert(python_code)
+    hits = misses = 0
+
+    def traverse(tree, version):
+        nonlocal hits, misses
+        converter.traverse(tree, version)
+        hits += converter.conversion_stats["cache_hits"]
+        misses += converter.conversion_stats["cache_misses"]
+
+    run("traverse, statement cache", traverse, list(zip(trees, versions)))
+    print(f"    hit rate {hits / (hits + misses):.3f}")
+
+
+def bench_template_reload():
+    """
+    Cost of traversing a program (of 240 statements) again, in a session
+    with a statement cache, after a template is reloaded: unchanged (as when
+    a pack of templates is loaded again), or changed (which only converts
+    the statements that call it again), against no change at all and a new
+    session (as if the whole cache was cleared).
+    """
+    python_code = sample_program(20)
+    tree = ast.parse(python_code)
+    converter = py2blocks.Converter(cache_size=1000)
+    converter.register_builtin_block("len", {"type": "len_block"})
+    converter.traverse(tree, python_code)
+    versions = iter(range(1000000))
+
+    def reload(converter, changed):
+        template = {"type": "len_block"}
+        if changed:
+            template["extraState"] = {"version": next(versions)}
+        converter.register_builtin_block("len", template)
+        converter.traverse(tree, python_code)
+
+    def new_session():
+        session = py2blocks.Converter(cache_size=1000)
+        reload(session, False)
+        return session
+
+    for name, function in [
+        ("no change", lambda: converter.traverse(tree, python_code)),
+        ("same template reloaded", lambda: reload(converter, False)),
+        ("changed template", lambda: reload(converter, True)),
+        ("new session", new_session),
+    ]:
+        report(name, timeit(function, repeat=10))
+    stats = new_session().conversion_stats
+    print(f"    {stats['cache_hits']} hits, {stats['cache_misses']} misses")
+    reload(converter, True)
+    stats = converter.conversion_stats
+    print(
+        f"    changed template: {stats['cache_hits']} hits, "
+        f"{stats['cache_misses']} misses"
+    )
+
+
+def functions_program(count=240):
+    """
+    Return the source of a large program (of about 5500 lines, by default)
+    made from functions that each contain a copy of the sample.
+    """
+    return "\n".join(
+        f"def part_{n}():\n" + textwrap.indent(SAMPLE, "    ")
+        for n in range(count)
+    )
+
+
+def edit_trace(python_code, offsets, count):
+    """
+    Return the edits (and the code after each one) to the code for count
+    keystrokes, each changing the digit at one of the given offsets.
+    """
+    edits = []
+    for n in range(count):
+        i = offsets[(n * 7919) % len(offsets)]
+        digit = str((int(python_code[i]) + 1) % 10)
+        python_code = python_code[:i] + digit + python_code[i + 1 :]
+        edits.append((i, 1, digit, python_code))
+    return edits
+
+
+def run_edits(python_code, edits):
+    """
+    Print the per-keystroke time for the edits to the code (see edit_trace):
+    to parse the code, to convert it all again, and to convert the edit via
+    Converter.edit. Return the session the edits were made in.
+    """
+    converter = py2blocks.Converter()
+    for name, function in [
+        ("ast.parse", lambda offset, length, text, code: ast.parse(code)),
+        (
+            "convert",
+            lambda offset, length, text, code: converter.convert(code),
+        ),
+    ]:
+        start = time.perf_counter()
+        for edit in edits:
+            function(*edit)
+        report(name, (time.perf_counter() - start) / len(edits))
+    converter = py2blocks.Converter()
+    converter.convert(python_code)
+    start = time.perf_counter()
+    nodes = patched = 0
+    for offset, length, text, code in edits:
+        converter.edit(offset, length, text)
+        nodes += converter.conversion_stats["nodes"]
+        patched += converter.conversion_stats["nodes"] == 0
+    report("Converter.edit", (time.perf_counter() - start) / len(edits))
+    print(f"    {nodes / len(edits):.0f} nodes per edit, {patched} patched")
+    result = converter.document.result
+    report("json.dumps (of each result)", timeit(lambda: json.dumps(result)))
+    return converter
+
+
+def bench_edit():
+    """
+    Per-keystroke cost of converting a program (of about 5000 lines, in 240
+    functions) in an editor that sends each keystroke as an edit, against
+    converting the whole program, and against just parsing it. Most of the
+    time for each edit is spent encoding the whole result as JSON.
+    """
+    python_code = functions_program()
+    print(f"    {python_code.count(chr(10))} lines")
+    digits = [i for i, char in enumerate(python_code) if char.isdigit()]
+    run_edits(python_code, edit_trace(python_code, digits, 100))
+
+
+def bench_edit_token():
+    """
+    Per-keystroke cost of the same edits as the edit benchmark, except only
+    to the digits of numbers, which Converter.edit patches in place. Only
+    patching, without encoding the result as JSON, is timed separately.
+    """
+    python_code = functions_program()
+    digits = [
+        i
+        for match in re.finditer(r"\b\d+\b", python_code)
+        for i in range(match.start(), match.end())
+    ]
+    edits = edit_trace(python_code, digits, 100)
+    converter = run_edits(python_code, edits)
+    converter.convert(python_code)
+    document = converter.document
+    start = time.perf_counter()
+    for offset, length, text, code in edits:
+        converter._patch(document, offset, offset + length, text, code)
+        document = converter.document
+    report("Converter._patch", (time.perf_counter() - start) / len(edits))
+
+
+def bench_patch():
+    """
+    Size and cost of a patch (see diff_blocks) against the full Blockly JSON,
+    per keystroke, for the same edits as the edit benchmark, whether they're
+    converted via Converter.edit, or by converting the whole program again
+    in a session with a statement cache.
+    """
+    python_code = functions_program()
+    digits = [i for i, char in enumerate(python_code) if char.isdigit()]
+    edits = edit_trace(python_code, digits, 100)
+    for name, cache_size, convert in [
+        (
+            "Converter.edit",
+            0,
+            lambda converter, offset, length, text, code, patch: (
+                converter.edit(offset, length, text, patch=patch)
+            ),
+        ),
+        (
+            "convert, statement cache",
+            1000,
+            lambda converter, offset, length, text, code, patch: (
+                converter.convert(code, patch=patch)
+            ),
+        ),
+    ]:
+        sizes = {}
+        for patch in (False, True):
+            converter = py2blocks.Converter(cache_size=cache_size)
+            converter.convert(python_code)
+            size = 0
+            start = time.perf_counter()
+            for edit in edits:
+                size += len(convert(converter, *edit, patch))
+            seconds = (time.perf_counter() - start) / len(edits)
+            label = "patch" if patch else "full"
+            report(f"{name}, {label}", seconds)
+            sizes[label] = size / len(edits)
+        print(
+            f"    {sizes['full']:.0f} bytes in full, "
+            f"{sizes['patch']:.0f} bytes in a patch"
+        )
+    # Just the diff, after each Converter.edit.
+    converter = py2blocks.Converter()
+    converter.convert(python_code)
+    seconds = 0
+    for offset, length, text, code in edits:
+        previous = converter._previous
+        converter.edit(offset, length, text)
+        start = time.perf_counter()
+        stacks = py2blocks._stacks(converter.document.result)
+        py2blocks._diff_stacks(previous, stacks)
+        seconds += time.perf_counter() - start
+    report("diff (Converter.edit)", seconds / len(edits))
+
+
+def bench_ids():
+    """
+    Cost of giving every block a stable id (see Converter): for traverse on
+    a large program (of about 5000 lines), and per keystroke for the same
+    edits as the edit benchmark, sent as edits that return a patch.
+    """
+    python_code = functions_program()
+    tree = ast.parse(python_code)
+    digits = [i for i, char in enumerate(python_code) if char.isdigit()]
+    edits = edit_trace(python_code, digits, 20)
+    for ids in (False, True):
+        label = "ids" if ids else "no ids"
+        converter = py2blocks.Converter(ids=ids)
+        report(
+            f"traverse, {label}",
+            timeit(lambda: converter.traverse(tree, python_code), repeat=3),
+        )
+        converter.convert(python_code)
+        start = time.perf_counter()
+        for offset, length, text, code in edits:
+            converter.edit(offset, length, text, patch=True)
+        seconds = (time.perf_counter() - start) / len(edits)
+        report(f"Converter.edit, patch, {label}", seconds)
+
+
+def bench_disk_cache():
+    """
+    Per-conversion cost of converting a repeated corpus (each of 50
+    submissions, four times) with py2blocks: without a cache, with a cold
+    disk cache (a new file), and with a warm one (the same file, in a new
+    run). Finally, with a cold disk cache limited to a quarter of the size,
+    so the least recently used results are always evicted before they're
+    used again.
+    """
+    import tempfile
+
+    sources = submissions(50) * 4
+    start = time.perf_counter()
+    for code in sources:
+        py2blocks.py2blocks(code)
+    report("no cache", (time.perf_counter() - start) / len(sources))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cache.db")
+        for name in ("cold", "warm"):
+            cache = py2blocks.DiskCache(path)
+            start = time.perf_counter()
+            for code in sources:
+                py2blocks.py2blocks(code, cache=cache)
+            seconds = (time.perf_counter() - start) / len(sources)
+            report(f"disk cache, {name}", seconds)
+            print(f"    {cache.stats}")
+            cache.close()
+        size = os.path.getsize(path)
+        cache = py2blocks.DiskCache(
+            os.path.join(directory, "small.db"), max_size=size // 4
+        )
+        start = time.perf_counter()
+        for code in sources:
+            py2blocks.py2blocks(code, cache=cache)
+        seconds = (time.perf_counter() - start) / len(sources)
+        report("disk cache, cold, evicting", seconds)
+        print(f"    {cache.stats}")
+        cache.close()
+
+
+BENCHMARKS = {
+    "dispatch": bench_dispatch,
+    "templates": bench_templates,
+    "nested_calls": bench_nested_calls,
+    "catch_all": bench_catch_all,
+    "catch_all_source": bench_catch_all_source,
+    "chains": bench_chains,
+    "convert_many": bench_convert_many,
+    "convert_many_processes": bench_convert_many_processes,
+    "parse": bench_parse,
+    "dict": bench_dict,
+    "stream": bench_stream,
+    "long_chains": bench_long_chains,
+    "buffer": bench_buffer,
+    "binary": bench_binary,
+    "dedup": bench_dedup,
+    "statement_cache": bench_statement_cache,
+    "template_reload": bench_template_reload,
+    "edit": bench_edit,
+    "edit_token": bench_edit_token,
+    "patch": bench_patch,
+    "ids": bench_ids,
+    "disk_cache": bench_disk_cache,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "names", nargs="*", help=f"any of: {', '.join(BENCHMARKS)}"
+    )
+    args = parser.parse_args()
+    for name in args.names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+        print(f"{name}: {' '.join(BENCHMARKS[name].__doc__.split())}")
+        BENCHMARKS[name]()